@@ -12,66 +12,43 @@
 #       Output Location - Required Workspace
 ####################################################################################################################################
 
-import arcpy, math, sets
+import math
+import numpy
+import buildout_profile, zoning_rules
+
+# arcpy is only needed when this file is run as the ArcMap tool. The buildout math below is also used by
+# buildout_engine.py, which runs without an ArcGIS licence.
+try:
+	import arcpy
+except ImportError:
+	arcpy = None
 
 ####################################################################################################################################
 # Methods
 ####################################################################################################################################
 
-# Calculates the minimum lot sizes for each zone
-def minimumLotSize(zoningData, outputWorkspace):
-
-	carney_codes = {"RR-2" : 30000, "RR-1" : 18750, "AG" : 30000, "LR" : 125000, "MHR" : 5400, "HR" : 3500, "LC" : 3500, "GC" : 12500,
-					"GCR" : 12500, "LI-R" : 120000, "GI-R" : 250000, "IC" : 40000, "LI" : 120000, "OS" : 0} 
+# Calculates the minimum lot sizes for each zone. The rules are looked up in the zoning rules registry by
+# municipality name, or by the zoning dataset path.
+def minimumLotSize(zoningData, outputWorkspace, muniName=''):
+	rules = zoning_rules.loadRules(muniName, zoningData)
 
-	oldmans_codes = {'AR' : 87120, 'R' : 43560, 'C' : 43560, 'VR' : 10000, 'VC' : 10000, 'I' : 130680,
-					 'CI' : 130680, 'IPRA' : 130680, 'P' : 0}
-
-	fields = arcpy.ListFields(zoningData)
+	fields = [f.name for f in arcpy.ListFields(zoningData)]
 	if 'MINLOT' not in fields:
 		arcpy.AddField_management(zoningData, 'MINLOT', 'DOUBLE')
 	if 'RESDENSITY' not in fields:
 		arcpy.AddField_management(zoningData, 'RESDENSITY', 'DOUBLE')
-	
-	cursor = arcpy.UpdateCursor(zoningData)
-	
-	if 'CARNEY' in zoningData or 'CP' in zoningData:
+
+	with arcpy.da.UpdateCursor(zoningData, ['Zone_ID', 'MINLOT', 'RESDENSITY']) as cursor:
 		for row in cursor:
-			for code, size in carney_codes.iteritems():
-				if code == row.getValue('Zone_ID'):
-					row.setValue('MINLOT', size)
-					
-					# not preserved land
-					if size != 0:
-						row.setValue('RESDENSITY', size ** (-1))
-						
-					# preserved land
-					else:
-						row.setValue('RESDENSITY', size)
-					cursor.updateRow(row)
-		del row, cursor
-	
-	elif 'HOPEWELL' in zoningData:
-		for row in cursor: 
-			size = row.getValue('MINLOT')
-			if size != 0:
-				row.setValue('RESDENSITY', row.getValue('MINLOT') ** (-1))
+			if rules.usesExistingMinLot():
+				# the zoning data already has the minimum lot sizes
+				size = row[1]
+				values = (size, size ** (-1) if size != 0 else size)
 			else:
-				row.setValue('RESDENSITY', size)
-			cursor.updateRow(row)
-		del row, cursor
-	
-	elif 'OLDMAN' in zoningData:
-		for row in cursor:
-			for code, size in oldmans_codes.iteritems():
-				if code == row.getValue('Zone_ID'):
-					row.setValue('MINLOT', size)
-					if size != 0:
-						row.setValue('RESDENSITY', size ** (-1))
-					else:
-						row.setValue('RESDENSITY', size)
-					cursor.updateRow(row)
-		del row, cursor
+				values = rules.values(row[0])
+				if values is None:
+					continue
+			cursor.updateRow([row[0], values[0], values[1]])
 	
 	currentFile = arcpy.CopyFeatures_management(zoningData, outputWorkspace + '\\muni_minLotCopy')
 	return currentFile
@@ -128,310 +105,348 @@ def canSplit(NO3_val, CZ_val):
 	else:
 		return 0
 	
-# Calculate the buildout numbers
-def buildoutCalculations(featureClass, isPost):
+# Array versions of the three methods above, for whole columns at once. The results match the scalar
+# methods element by element.
+
+def currentZoningArray(minLot, shapeArea):
+	minLot = numpy.asarray(minLot, dtype='float64')
+	shapeArea = numpy.asarray(shapeArea, dtype='float64')
+	# preserved lands (minLot == 0) and lots that are too small cannot be split
+	split = (minLot != 0) & ((minLot * 2) < shapeArea)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		lots = numpy.floor(shapeArea / minLot)
+	return numpy.where(split, lots, 0).astype('int64')
+
+def nitrateArray(minLot, septicDensity, shapeArea, isSeptic, CZ_BO_numbers):
+	minLot = numpy.asarray(minLot, dtype='float64')
+	shapeArea = numpy.asarray(shapeArea, dtype='float64')
+	# converting from acres to sq. feet
+	septicDensitySqFt = numpy.asarray(septicDensity, dtype='float64') * 43560
+	split = (shapeArea > (minLot * 2)) & (shapeArea > (septicDensitySqFt * 2)) & (minLot != 0)
+	if numpy.any(split & (septicDensitySqFt == 0) & isSeptic):
+		raise ZeroDivisionError('septic density of 0 on a septic area that can be split')
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		lots = numpy.floor(shapeArea / septicDensitySqFt)
+	septicLots = numpy.where(split, lots, 0)
+	# Sewer areas keep the current zoning buildout number
+	return numpy.where(isSeptic, septicLots, CZ_BO_numbers).astype('int64')
+
+def canSplitArray(NO3_vals, CZ_vals):
+	return ((numpy.asarray(NO3_vals) + numpy.asarray(CZ_vals)) > 1).astype('int16')
+
+# Buildout numbers for whole columns of MINLOT, SEPDENS, Shape_Area and SYSTEM values. Returns the
+# current zoning buildout, nitrate buildout and can split arrays.
+def buildoutArrays(minLot, septicDensity, shapeArea, system):
+	isSeptic = numpy.asarray(system) == 'SEPTIC'
+	cz_BO = currentZoningArray(minLot, shapeArea)
+	NO3_BO = nitrateArray(minLot, septicDensity, shapeArea, isSeptic, cz_BO)
+	return cz_BO, NO3_BO, canSplitArray(NO3_BO, cz_BO)
+
+# Fields of the final result after PAMS_PIN and SYSTEM, in order, as (name, type, alias)
+FINAL_FIELDS = [('CANSP_PRE', 'SHORT', 'Can Split Pre-const. Erase'),
+				('CANSP_POST', 'SHORT', 'Can Split Post-const. Erase'),
+				('NO3BO_PRE', 'LONG', 'NO3 Buildout Pre-const. Erase'),
+				('NO3BO_POST', 'LONG', 'NO3 Buildout Post-const. Erase'),
+				('CZBO_PRE', 'LONG', 'Current Zoning Buildout Pre-const. Erase'),
+				('CZBO_POST', 'LONG', 'Current Zoning Buildout Post-const. Erase'),
+				('THINNESS', 'DOUBLE', 'Thinness Ratio')]
+
+# The final result values of dissolved parcels from their summed buildout numbers, area and perimeter.
+# Returns a dict of arrays keyed by the FINAL_FIELDS names. The can split flags are taken before the
+# 0's of the buildout numbers are changed to 1's.
+def finalResultArrays(CZ_pre, NO3_pre, CZ_post, NO3_post, shapeArea, shapeLength):
+	values = {'NO3BO_PRE': numpy.asarray(NO3_pre, dtype='int64'), 'NO3BO_POST': numpy.asarray(NO3_post, dtype='int64'),
+			  'CZBO_PRE': numpy.asarray(CZ_pre, dtype='int64'), 'CZBO_POST': numpy.asarray(CZ_post, dtype='int64')}
+	values['CANSP_PRE'] = canSplitArray(values['NO3BO_PRE'], values['CZBO_PRE'])
+	values['CANSP_POST'] = canSplitArray(values['NO3BO_POST'], values['CZBO_POST'])
+
+	# Change the 0's to 1's for the buildout numbers
+	for field in ['NO3BO_PRE', 'NO3BO_POST', 'CZBO_PRE', 'CZBO_POST']:
+		values[field] = numpy.where(values[field] == 0, 1, values[field])
+
+	# Thinness ratio
+	values['THINNESS'] = 4 * math.pi * numpy.asarray(shapeArea, dtype='float64') / numpy.asarray(shapeLength, dtype='float64') ** 2
+	return values
+
+# Number of features in a feature class or layer. Returned as a function, so that the profiler only counts
+# when it is on.
+def countOf(featureClass):
+	return lambda: int(arcpy.GetCount_management(featureClass).getOutput(0))
+
+# Groups (PAMS_PIN, SYSTEM) rows by pams pin and returns the pins that have more than one SYSTEM value
+def multiSystemPins(rows):
+	systems = {}
+	for pams_pin, system in rows:
+		systems.setdefault(pams_pin, set()).add(system)
+	return set(pin for pin, sysSet in systems.items() if len(sysSet) > 1)
+
+# Calculate the buildout numbers of the pre-constraint erasure areas (the post-constraint erasure
+# numbers are calculated along with the minimum lot filter, see modelSteps)
+def buildoutCalculations(featureClass):
         field_names = [f.name for f in arcpy.ListFields(featureClass)]
-        NO3_field = ''
-        CZ_field = ''
-        if isPost:    
-                if'CZBO_POST' not in field_names:
-                        arcpy.AddField_management(featureClass, 'CZBO_POST', 'LONG', '', '', '', 'CZ Buildout Post-const. Erase')
-                        CZ_field = 'CZBO_POST'
-                if'NO3BO_POST' not in field_names:
-                        arcpy.AddField_management(featureClass, 'NO3BO_POST', 'LONG', '', '', '', 'NO3 Buildout Post-const. Erase')
-                        NO3_field = 'NO3BO_POST'
-                        
-        else:
-                if'CZBO_PRE' not in field_names:
-                        arcpy.AddField_management(featureClass, 'CZBO_PRE', 'LONG', '', '', '', 'CZ Buildout Pre-const. Erase')
-                        CZ_field = 'CZBO_PRE'
-                if'NO3BO_PRE' not in field_names:
-                        arcpy.AddField_management(featureClass, 'NO3BO_PRE', 'LONG', '', '', '', 'NO3 Buildout Pre-const. Erase')
-                        NO3_field = 'NO3BO_PRE'
+        if'CZBO_PRE' not in field_names:
+                arcpy.AddField_management(featureClass, 'CZBO_PRE', 'LONG', '', '', '', 'CZ Buildout Pre-const. Erase')
+        if'NO3BO_PRE' not in field_names:
+                arcpy.AddField_management(featureClass, 'NO3BO_PRE', 'LONG', '', '', '', 'NO3 Buildout Pre-const. Erase')
 
         arcpy.AddMessage('Calculating buildout values...')
-        cursor = arcpy.UpdateCursor(featureClass)
-        for row in cursor: 
-
-                system = row.getValue('SYSTEM')
-                isSeptic = False
-                if system == 'SEPTIC':
-                        isSeptic = True
-                
-                sepdens = row.getValue('SEPDENS')
-                minLot = row.getValue('MINLOT')
-                area = row.getValue('Shape_Area')
-                cz_BO = currentZoning_BO(minLot, area)
-                NO3_BO = nitrate_BO(minLot, sepdens, area, isSeptic, cz_BO)
-
-                row.setValue(CZ_field, cz_BO)
-                row.setValue(NO3_field, NO3_BO)
-                
-                cursor.updateRow(row)
-        del row, cursor
+
+        # Read the needed columns in one go and do the math on the whole arrays
+        columns = arcpy.da.FeatureClassToNumPyArray(featureClass, ['OID@', 'MINLOT', 'SEPDENS', 'SHAPE@AREA', 'SYSTEM'])
+        cz_BO, NO3_BO, _ = buildoutArrays(columns['MINLOT'], columns['SEPDENS'], columns['SHAPE@AREA'], columns['SYSTEM'])
+        values = dict(zip(columns['OID@'].tolist(), zip(cz_BO.tolist(), NO3_BO.tolist())))
+
+        with arcpy.da.UpdateCursor(featureClass, ['OID@', 'CZBO_PRE', 'NO3BO_PRE']) as cursor:
+                for row in cursor:
+                        cursor.updateRow([row[0]] + list(values[row[0]]))
 
 ####################################################################################################################################
 ####################################################################################################################################
 ####################################################################################################################################
 # The following code is the overall model. The output generated here is what should be displayed in City Engine
 
-arcpy.env.overwriteOutput = True
-zoning = arcpy.GetParameterAsText(0)
-muniName = arcpy.GetParameterAsText(1)
-outputWorkspace = arcpy.GetParameterAsText(3)
-constraintsWorkspace = arcpy.GetParameterAsText(4)
-
-# An array that will contain all temp files that will be deleted at the very end
-deleteFiles = []
-
-# Merge the additional constraints
-add_constraints = ''
-if arcpy.GetParameterAsText(2):
-        arcpy.AddMessage('Clipping Optional Constraints...')
-        add_const_paths = []
-        count = 1
-        for constraint in arcpy.GetParameterAsText(2).split(';'):
-                file_name = 'muni_op_constraint_%s'%(count)
-                add_const_paths.append(arcpy.Clip_analysis(constraint, zoning, file_name))
-                deleteFiles.append(file_name)
-                count += 1
-        add_constraints = arcpy.Merge_management(add_const_paths, 'muni_add_const')
-        deleteFiles.append(add_constraints)
-                
-
-arcpy.env.workspace = constraintsWorkspace
-
-inputs = ['nhd_waterbodies', 'NO3_densities',  'openspace_county', 'openspace_state',  'parcels',  'preserved_farms', 
-		  'swqs',  'water_purveyors',  'wetlands', 'Land_Use_Land_Cover_2012', 'sewer_service_area']
-
-# Clip inputs to the municipality area
-arcpy.AddMessage('Clipping Inputs...')	  
-for file in inputs:
-	deleteFiles.append(arcpy.Clip_analysis(file, zoning, outputWorkspace + '\\muni_' + file))
-
-arcpy.env.workspace = outputWorkspace
-	
-wetlands = 'muni_wetlands'
-parcels = 'muni_parcels'
-waterbodies = 'muni_nhd_waterbodies'
-NO3_densities = 'muni_NO3_densities'
-OS_State = 'muni_openspace_state'
-OS_County = 'muni_openspace_county'
-swqs = 'muni_swqs'
-landUse = 'muni_Land_Use_Land_Cover_2012'
-farms = 'muni_preserved_farms'
-sewer_area = 'muni_sewer_service_area'
-wp = 'muni_water_purveyors'
-
-# Calculate minimum lot size values for the individual zones
-arcpy.AddMessage('Calculating minimum lot sizes...')
-zoning = minimumLotSize(zoning, arcpy.GetParameterAsText(3))
-deleteFiles.append(zoning)
-
-# Selecting zoned open space (may differ from other OS)
-zoned_OS = arcpy.Select_analysis(zoning, 'muni_zoned_OS', '\"MINLOT\" = 0')
-deleteFiles.append(zoned_OS)
-
-# Create zoning by parcels
-arcpy.AddMessage('Appending zoning data...')
-currentFile = arcpy.Identity_analysis(parcels, zoning, 'muni_zoning_by_parcels')
-deleteFiles.append(currentFile)
-
-# Delete areas that are coincident with streets
-arcpy.SelectLayerByAttribute_management(arcpy.MakeFeatureLayer_management(currentFile, 'zone_lyr'), 'NEW_SELECTION',
-										'\"FID_muni_parcels\" = -1')
-arcpy.DeleteFeatures_management('zone_lyr')
-
-# Minimum Lot Size Select
-# currentFile = arcpy.Select_analysis(currentFile, 'muni_meet_minimum', '\"Shape_Area\" >= \"MINLOT\"')
-
-# Append the sewer service data
-arcpy.AddMessage('Identifying sewer and septic areas...')
-currentFile = arcpy.Identity_analysis(currentFile, sewer_area, 'muni_sewer_service_ID')
-deleteFiles.append(currentFile)
-field_names = [f.name for f in arcpy.ListFields(currentFile)]
-if 'SYSTEM' not in field_names:
-        arcpy.AddField_management(currentFile, 'SYSTEM', 'TEXT')
-
-cursor = arcpy.UpdateCursor(currentFile)
-for row in cursor:
-	if row.getValue('FID_muni_sewer_service_area') == -1:
-		row.setValue('SYSTEM', 'SEPTIC')
-	else:
-		row.setValue('SYSTEM', 'SEWER')
-	cursor.updateRow(row)
-del row, cursor
-
-# Getting field names
-field_names = [f.name for f in arcpy.ListFields(currentFile)]
-
-# Append the Nitrate Dilution watershed data
-currentFile = arcpy.Identity_analysis(currentFile, NO3_densities, 'muni_appended_NO3_densities')
-deleteFiles.append(currentFile) 
-
-# Delete any geometry that doesn't line up
-arcpy.MakeFeatureLayer_management(currentFile, 'lyr')
-arcpy.SelectLayerByAttribute_management('lyr', 'NEW_SELECTION', '\"FID_muni_NO3_densities\" = -1')
-arcpy.DeleteFeatures_management('lyr')
-
-# Calculate buildout for pre-constraint erasure areas
-buildoutCalculations(currentFile, False)
-
-# Creating the Surface Water Antideg. buffers
-arcpy.SelectLayerByAttribute_management(arcpy.MakeFeatureLayer_management(swqs, 'swqs_lyr'), 'NEW_SELECTION', '\"ANTIDEG\" = \'C1\'')
-c1_buffers = arcpy.Buffer_analysis('swqs_lyr', 'muni_C1_buffer', '300 Feet')
-arcpy.SelectLayerByAttribute_management('swqs_lyr', 'NEW_SELECTION', '\"ANTIDEG\" = \'C2\'')
-c2_buffers = arcpy.Buffer_analysis('swqs_lyr', 'muni_C2_buffer', '50 Feet')
-deleteFiles.append(c1_buffers)
-deleteFiles.append(c2_buffers)
-
-# Creating the Urban land use layer
-urban_lu = arcpy.Select_analysis(landUse, 'muni_urban_lu', '\"TYPE12\" = \'URBAN\'')
-deleteFiles.append(urban_lu)
-
-# Creating the constraints layer and erasing the constraints
-constraintsFiles = [urban_lu, c1_buffers, c2_buffers, wetlands, waterbodies, OS_State, OS_County, zoned_OS, farms]
-if add_constraints != '':
-        constraintsFiles.append(add_constraints) # optional constraints
-constraints = arcpy.Merge_management(constraintsFiles, 'muni_constraints')
-currentFile = arcpy.Erase_analysis(currentFile, constraints, 'muni_constraints_erased')
-deleteFiles.append(constraints)
-deleteFiles.append(currentFile)
-
-# Taking out anything that doesn't meet minimum lot size
-currentFile = arcpy.Select_analysis(currentFile, 'muni_minimumLot_met', '\"Shape_Area\" >= \"MINLOT\"')
-deleteFiles.append(currentFile)
-
-# Cleaning up ugly fields
-#uglyFieldManagement(currentFile)
-
-# Calculate buildout for post-constraint erasure areas
-buildoutCalculations(currentFile, True)
-
-# Finding parcels that are contained in both sewer and septic areas. Those that do will be assigned a 
-# 'SEWER/SEPTIC' value in the "SYSTEM" field, allowing for a clean dissolve on pams pin. 
-arcpy.AddMessage('Finding multi-system parcels...')
-arcpy.MakeFeatureLayer_management(currentFile, 'pams_lyr')
-cursor = arcpy.UpdateCursor('pams_lyr')
-for row in cursor:
-	if row.getValue('SYSTEM') != 'SEWER/SEPTIC':
-		pams_pin = row.getValue('PAMS_PIN')
-		arcpy.SelectLayerByAttribute_management('pams_lyr', 'NEW_SELECTION', '\"PAMS_PIN\" = \'%s\''%(pams_pin))
-		sysSet = set()
-		subCursor = arcpy.SearchCursor('pams_lyr')
-		for subRow in subCursor:
-			sysSet.add(subRow.getValue('SYSTEM'))
-		del subRow, subCursor
-		if len(sysSet) > 1:
-			arcpy.CalculateField_management('pams_lyr', 'SYSTEM', '\'SEWER/SEPTIC\'', 'PYTHON_9.3')
-		arcpy.SelectLayerByAttribute_management('pams_lyr', 'CLEAR_SELECTION')
-	cursor.updateRow(row)
-del row, cursor
-
-# Dissolve parts of parcels on pams pin, sum the buildout numbers								        
-currentFile = arcpy.Dissolve_management(currentFile, 'muni_result_combined', ['PAMS_PIN', 'SYSTEM'], [['CZBO_POST', 'SUM'], ['NO3BO_POST', 'SUM'], ['CZBO_PRE', 'SUM'], ['NO3BO_PRE', 'SUM']])
-deleteFiles.append(currentFile)
-
-arcpy.AddField_management(currentFile, 'CANSP_PRE', 'SHORT', '', '', '', 'Can Split Pre-const. Erase')
-arcpy.AddField_management(currentFile, 'CANSP_POST', 'SHORT', '', '', '', 'Can Split Post-const. Erase')
-arcpy.AddField_management(currentFile, 'NO3BO_PRE', 'LONG', '', '', '', 'NO3 Buildout Pre-const. Erase')
-arcpy.AddField_management(currentFile, 'NO3BO_POST', 'LONG', '', '', '', 'NO3 Buildout Post-const. Erase')
-arcpy.AddField_management(currentFile, 'CZBO_PRE', 'LONG', '', '', '', 'Current Zoning Buildout Pre-const. Erase')
-arcpy.AddField_management(currentFile, 'CZBO_POST', 'LONG', '', '', '', 'Current Zoning Buildout Post-const. Erase')
-
-cursor = arcpy.UpdateCursor(currentFile)
-for row in cursor:
-	row.setValue('NO3BO_POST', row.getValue('SUM_NO3BO_POST'))
-	row.setValue('NO3BO_PRE', row.getValue('SUM_NO3BO_PRE'))
-	row.setValue('CZBO_POST', row.getValue('SUM_CZBO_POST'))
-	row.setValue('CZBO_PRE', row.getValue('SUM_CZBO_PRE'))
-	row.setValue('CANSP_PRE', canSplit(row.getValue('NO3BO_PRE'), row.getValue('CZBO_PRE')))
-	row.setValue('CANSP_POST', canSplit(row.getValue('NO3BO_POST'), row.getValue('CZBO_POST')))
-	cursor.updateRow(row)
-del row, cursor
-
-arcpy.DeleteField_management(currentFile, 'SUM_CZBO_POST')
-arcpy.DeleteField_management(currentFile, 'SUM_CZBO_PRE')
-arcpy.DeleteField_management(currentFile, 'SUM_NO3BO_POST')
-arcpy.DeleteField_management(currentFile, 'SUM_NO3BO_PRE')
-
-# Change the 0's to 1's for the buildout numbers
-cursor = arcpy.UpdateCursor(currentFile)
-for row in cursor:
-	if row.getValue('CZBO_PRE') == 0:
-		row.setValue('CZBO_PRE', 1)
-	if row.getValue('CZBO_POST') == 0:
-		row.setValue('CZBO_POST', 1)
-	if row.getValue('NO3BO_PRE') == 0:
-		row.setValue('NO3BO_PRE', 1)
-	if row.getValue('NO3BO_POST') == 0:
-		row.setValue('NO3BO_POST', 1)
-	
-	cursor.updateRow(row)
-del row, cursor
-
-# Appending water purveyor and watershed data
-##currentFile = arcpy.Identity_analysis(currentFile, wp, 'muni_appended_wps')
-##deleteFiles.append(currentFile)
-##currentFile = arcpy.Identity_analysis(currentFile, NO3_densities, 'muni_appended_wsheds')
-##deleteFiles.append(currentFile)
-
-
-### Doing some ugly fields management for the appended data
-##goodFields = ['OBJECTID', 'Shape', 'Shape_Area', 'Shape_Length', 'HUC11', 'W_NAME', 'SEPDENS', 'AVGRECHRG', 'PURVNAME']
-##fields = [field.name for field in arcpy.ListFields(wp)] # water purveyor fields
-##fields.extend([field.name for field in arcpy.ListFields(NO3_densities)]) # watershed fields
-##
-##for f in fields:
-##        if f not in goodFields:
-##                arcpy.DeleteField_management(currentFile, f)
-##                
-##fields = [field.name for field in arcpy.ListFields(currentFile)]
-##
-##for f in fields: # deleting other ugly fields
-##        if 'FID' in f or '_1' in f:
-##                arcpy.DeleteField_management(currentFile, f)
-
-# Thinness ratio
-arcpy.AddField_management(currentFile, 'THINNESS', 'DOUBLE')
-arcpy.CalculateField_management(currentFile, 'THINNESS', '4 * math.pi * !Shape_Area!/(!Shape_Length! ** (2))', 'PYTHON_9.3')
-
-# Rename the final file
-currentFile = arcpy.Rename_management(currentFile, '%s_final_result'%(muniName))
-
-# Deleting temp files
-arcpy.AddMessage('Deleting temp files...')
-for file in deleteFiles:
-	arcpy.Delete_management(file)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+# The scratch datasets of a model run. In memory mode they are kept in the 'in_memory' workspace and never
+# written to disk, otherwise they are muni_* feature classes in the output workspace. Everything made through
+# path() or passed to add() is deleted by delete().
+class ScratchWorkspace(object):
+	def __init__(self, outputWorkspace, inMemory=True):
+		self.inMemory = inMemory
+		self.workspace = 'in_memory' if inMemory else outputWorkspace
+		self.datasets = []
+
+	# Path of a named scratch dataset
+	def path(self, name):
+		path = self.workspace + '\\' + name
+		self.datasets.append(path)
+		return path
+
+	# Marks a dataset or layer made some other way as scratch
+	def add(self, dataset):
+		self.datasets.append(dataset)
+		return dataset
+
+	def delete(self):
+		for dataset in reversed(self.datasets):
+			if arcpy.Exists(dataset):
+				arcpy.Delete_management(dataset)
+		self.datasets = []
+
+# Runs the whole model for one municipality. additionalConstraints is a ';' separated list of
+# feature classes (or an empty string). The stages are timed by the profiler, if one is given (see
+# buildout_profile.py). With an exportPath the final result is also written there as GeoParquet (or as
+# Arrow for a .arrow path), see buildout_export.py.
+#
+# Only the final result is written to the output workspace. The intermediates are kept in memory (or, with
+# inMemory=False, in the output workspace) and are deleted when the run ends, whether it succeeds or not.
+def runModel(zoning, muniName, additionalConstraints, outputWorkspace, constraintsWorkspace, profiler=None,
+			 exportPath=None, inMemory=True):
+	arcpy.env.overwriteOutput = True
+	profiler = profiler or buildout_profile.disabled()
+	scratch = ScratchWorkspace(outputWorkspace, inMemory)
+	try:
+		modelSteps(scratch, zoning, muniName, additionalConstraints, outputWorkspace, constraintsWorkspace,
+				   profiler, exportPath)
+	finally:
+		# Deleting temp files
+		profiler.begin('delete_temp_files')
+		arcpy.AddMessage('Deleting temp files...')
+		scratch.delete()
+		profiler.end()
+
+# The steps of the model, see runModel. Every intermediate goes to the scratch workspace.
+def modelSteps(scratch, zoning, muniName, additionalConstraints, outputWorkspace, constraintsWorkspace, profiler,
+			   exportPath=None):
+	# Merge the additional constraints
+	profiler.begin('clip_additional_constraints')
+	add_constraints = ''
+	if additionalConstraints:
+		arcpy.AddMessage('Clipping Optional Constraints...')
+		add_const_paths = []
+		count = 1
+		for constraint in additionalConstraints.split(';'):
+			file_name = scratch.path('muni_op_constraint_%s'%(count))
+			add_const_paths.append(arcpy.Clip_analysis(constraint, zoning, file_name))
+			count += 1
+		add_constraints = arcpy.Merge_management(add_const_paths, scratch.path('muni_add_const'))
+
+
+	arcpy.env.workspace = constraintsWorkspace
+
+	inputs = ['nhd_waterbodies', 'NO3_densities',  'openspace_county', 'openspace_state',  'parcels',  'preserved_farms', 
+			  'swqs',  'water_purveyors',  'wetlands', 'Land_Use_Land_Cover_2012', 'sewer_service_area']
+
+	# Clip inputs to the municipality area
+	profiler.begin('clip_inputs')
+	arcpy.AddMessage('Clipping Inputs...')	  
+	clipped = {}
+	for file in inputs:
+		clipped[file] = scratch.path('muni_' + file)
+		arcpy.Clip_analysis(file, zoning, clipped[file])
+
+	arcpy.env.workspace = outputWorkspace
+
+	wetlands = clipped['wetlands']
+	parcels = clipped['parcels']
+	waterbodies = clipped['nhd_waterbodies']
+	NO3_densities = clipped['NO3_densities']
+	OS_State = clipped['openspace_state']
+	OS_County = clipped['openspace_county']
+	swqs = clipped['swqs']
+	landUse = clipped['Land_Use_Land_Cover_2012']
+	farms = clipped['preserved_farms']
+	sewer_area = clipped['sewer_service_area']
+	wp = clipped['water_purveyors']
+
+	# Calculate minimum lot size values for the individual zones
+	profiler.begin('minimum_lot_sizes')
+	arcpy.AddMessage('Calculating minimum lot sizes...')
+	zoning = scratch.add(minimumLotSize(zoning, scratch.workspace, muniName))
+
+	# Selecting zoned open space (may differ from other OS)
+	zoned_OS = arcpy.Select_analysis(zoning, scratch.path('muni_zoned_OS'), '\"MINLOT\" = 0')
+
+	# Create zoning by parcels
+	profiler.begin('identity_zoning', countOf(parcels))
+	arcpy.AddMessage('Appending zoning data...')
+	currentFile = arcpy.Identity_analysis(parcels, zoning, scratch.path('muni_zoning_by_parcels'))
+
+	# Delete areas that are coincident with streets
+	arcpy.SelectLayerByAttribute_management(arcpy.MakeFeatureLayer_management(currentFile, scratch.add('zone_lyr')), 'NEW_SELECTION',
+											'\"FID_muni_parcels\" = -1')
+	arcpy.DeleteFeatures_management('zone_lyr')
+
+	# Minimum Lot Size Select
+	# currentFile = arcpy.Select_analysis(currentFile, 'muni_meet_minimum', '\"Shape_Area\" >= \"MINLOT\"')
+
+	# Append the sewer service data
+	profiler.end(countOf(currentFile))
+	profiler.begin('identity_sewer', countOf(currentFile))
+	arcpy.AddMessage('Identifying sewer and septic areas...')
+	currentFile = arcpy.Identity_analysis(currentFile, sewer_area, scratch.path('muni_sewer_service_ID'))
+	field_names = [f.name for f in arcpy.ListFields(currentFile)]
+	if 'SYSTEM' not in field_names:
+		arcpy.AddField_management(currentFile, 'SYSTEM', 'TEXT')
+
+	cursor = arcpy.UpdateCursor(currentFile)
+	for row in cursor:
+		if row.getValue('FID_muni_sewer_service_area') == -1:
+			row.setValue('SYSTEM', 'SEPTIC')
+		else:
+			row.setValue('SYSTEM', 'SEWER')
+		cursor.updateRow(row)
+	del row, cursor
+
+	# Getting field names
+	field_names = [f.name for f in arcpy.ListFields(currentFile)]
+
+	# Append the Nitrate Dilution watershed data
+	profiler.end(countOf(currentFile))
+	profiler.begin('identity_NO3', countOf(currentFile))
+	currentFile = arcpy.Identity_analysis(currentFile, NO3_densities, scratch.path('muni_appended_NO3_densities'))
+
+	# Delete any geometry that doesn't line up
+	arcpy.MakeFeatureLayer_management(currentFile, scratch.add('lyr'))
+	arcpy.SelectLayerByAttribute_management('lyr', 'NEW_SELECTION', '\"FID_muni_NO3_densities\" = -1')
+	arcpy.DeleteFeatures_management('lyr')
+
+	# Calculate buildout for pre-constraint erasure areas
+	profiler.end(countOf(currentFile))
+	profiler.begin('buildout_pre', countOf(currentFile))
+	buildoutCalculations(currentFile)
+
+	# Creating the Surface Water Antideg. buffers
+	profiler.begin('constraints')
+	arcpy.SelectLayerByAttribute_management(arcpy.MakeFeatureLayer_management(swqs, scratch.add('swqs_lyr')), 'NEW_SELECTION', '\"ANTIDEG\" = \'C1\'')
+	c1_buffers = arcpy.Buffer_analysis('swqs_lyr', scratch.path('muni_C1_buffer'), '300 Feet')
+	arcpy.SelectLayerByAttribute_management('swqs_lyr', 'NEW_SELECTION', '\"ANTIDEG\" = \'C2\'')
+	c2_buffers = arcpy.Buffer_analysis('swqs_lyr', scratch.path('muni_C2_buffer'), '50 Feet')
+
+	# Creating the Urban land use layer
+	urban_lu = arcpy.Select_analysis(landUse, scratch.path('muni_urban_lu'), '\"TYPE12\" = \'URBAN\'')
+
+	# Creating the constraints layer and erasing the constraints
+	constraintsFiles = [urban_lu, c1_buffers, c2_buffers, wetlands, waterbodies, OS_State, OS_County, zoned_OS, farms]
+	if add_constraints != '':
+		constraintsFiles.append(add_constraints) # optional constraints
+	constraints = arcpy.Merge_management(constraintsFiles, scratch.path('muni_constraints'))
+	profiler.end(countOf(constraints))
+	profiler.begin('erase', countOf(currentFile))
+	currentFile = arcpy.Erase_analysis(currentFile, constraints, scratch.path('muni_constraints_erased'))
+
+	# Taking out anything that doesn't meet minimum lot size and calculating the buildout for the
+	# post-constraint erasure areas of what is left. The areas are read once and worked out on whole
+	# arrays, and one cursor pass then deletes the small pieces and writes the numbers of the rest
+	# (in_memory feature classes have no Shape_Area field to select on).
+	profiler.end(countOf(currentFile))
+	profiler.begin('minimum_lot_filter', countOf(currentFile))
+	arcpy.AddField_management(currentFile, 'CZBO_POST', 'LONG', '', '', '', 'CZ Buildout Post-const. Erase')
+	arcpy.AddField_management(currentFile, 'NO3BO_POST', 'LONG', '', '', '', 'NO3 Buildout Post-const. Erase')
+	columns = arcpy.da.FeatureClassToNumPyArray(currentFile, ['OID@', 'SHAPE@AREA', 'MINLOT', 'SEPDENS', 'SYSTEM'],
+												null_value={'MINLOT': numpy.nan, 'SEPDENS': numpy.nan, 'SYSTEM': ''})
+	# pieces with no MINLOT (NaN) are taken out too
+	keep = columns['SHAPE@AREA'] >= columns['MINLOT']
+	columns = columns[keep]
+	cz_BO, NO3_BO, _ = buildoutArrays(columns['MINLOT'], columns['SEPDENS'], columns['SHAPE@AREA'], columns['SYSTEM'])
+	values = dict(zip(columns['OID@'].tolist(), zip(cz_BO.tolist(), NO3_BO.tolist())))
+	with arcpy.da.UpdateCursor(currentFile, ['OID@', 'CZBO_POST', 'NO3BO_POST']) as cursor:
+		for row in cursor:
+			if row[0] in values:
+				cursor.updateRow([row[0]] + list(values[row[0]]))
+			else:
+				cursor.deleteRow()
+
+	# Cleaning up ugly fields
+	#uglyFieldManagement(currentFile)
+
+	# Finding parcels that are contained in both sewer and septic areas. Those that do will be assigned a 
+	# 'SEWER/SEPTIC' value in the "SYSTEM" field, allowing for a clean dissolve on pams pin. 
+	profiler.begin('multi_system', countOf(currentFile))
+	arcpy.AddMessage('Finding multi-system parcels...')
+	with arcpy.da.SearchCursor(currentFile, ['PAMS_PIN', 'SYSTEM']) as cursor:
+		multiPins = multiSystemPins(cursor)
+	if multiPins:
+		with arcpy.da.UpdateCursor(currentFile, ['PAMS_PIN', 'SYSTEM']) as cursor:
+			for row in cursor:
+				if row[0] in multiPins:
+					cursor.updateRow([row[0], 'SEWER/SEPTIC'])
+
+	# Dissolve parts of parcels on pams pin, sum the buildout numbers								        
+	profiler.begin('dissolve', countOf(currentFile))
+	currentFile = arcpy.Dissolve_management(currentFile, scratch.path('muni_result_combined'), ['PAMS_PIN', 'SYSTEM'], [['CZBO_POST', 'SUM'], ['NO3BO_POST', 'SUM'], ['CZBO_PRE', 'SUM'], ['NO3BO_PRE', 'SUM']])
+	profiler.end(countOf(currentFile))
+
+	# Build the final result in one pass: the schema is created empty and every dissolved parcel is written
+	# once with its summed buildout numbers, can split flags, 0's changed to 1's and thinness ratio
+	profiler.begin('finalise', countOf(currentFile))
+	arcpy.AddMessage('Writing final result...')
+	with arcpy.da.SearchCursor(currentFile, ['SHAPE@', 'PAMS_PIN', 'SYSTEM', 'SUM_CZBO_PRE', 'SUM_NO3BO_PRE', 'SUM_CZBO_POST',
+											 'SUM_NO3BO_POST', 'SHAPE@AREA', 'SHAPE@LENGTH']) as cursor:
+		rows = list(cursor)
+	columns = list(zip(*rows)) if rows else [[]] * 9
+	values = finalResultArrays(*columns[3:9])
+
+	textFields = dict((f.name, f.length) for f in arcpy.ListFields(currentFile) if f.name in ('PAMS_PIN', 'SYSTEM'))
+	finalFile = arcpy.CreateFeatureclass_management(outputWorkspace, '%s_final_result'%(muniName), 'POLYGON',
+													spatial_reference=arcpy.Describe(currentFile).spatialReference)
+	arcpy.AddField_management(finalFile, 'PAMS_PIN', 'TEXT', '', '', textFields['PAMS_PIN'])
+	arcpy.AddField_management(finalFile, 'SYSTEM', 'TEXT', '', '', textFields['SYSTEM'])
+	for name, fieldType, alias in FINAL_FIELDS:
+		arcpy.AddField_management(finalFile, name, fieldType, '', '', '', alias)
+
+	fieldNames = [name for name, _, _ in FINAL_FIELDS]
+	with arcpy.da.InsertCursor(finalFile, ['SHAPE@', 'PAMS_PIN', 'SYSTEM'] + fieldNames) as cursor:
+		for n, row in enumerate(rows):
+			cursor.insertRow(list(row[:3]) + [values[name][n].item() for name in fieldNames])
+	del rows, columns, values
+	currentFile = finalFile
+	profiler.end(countOf(currentFile))
+
+	if exportPath:
+		profiler.begin('export')
+		import buildout_export
+		buildout_export.writeTable(buildout_export.featureClassTable(finalFile), exportPath)
+		profiler.end()
+
+if __name__ == '__main__':
+	runtimeParams = [arcpy.GetParameterAsText(i) for i in range(5)]
+	runModel(*runtimeParams)
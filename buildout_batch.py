@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+################################################################################
+# Statewide batch runner for the buildout model
+#
+# Description:
+#   Runs buildout_engine.runBuildout for many municipalities across a pool of
+# worker processes. Every municipality gets its own scratch workspace so the
+# muni_* intermediates of different runs can't overwrite each other. The
+# results are merged into one output (with a MUNICIPALITY field) and a
+# timing/status report is written next to it.
+#
+# Zoning data is looked up in the zoning workspace under the municipality name
+# with spaces replaced by underscores (e.g. Oldmans_Township), see zoningLayer.
+#
+# Example:
+#   python buildout_batch.py --county Salem zoning.gpkg constraints.gpkg
+#       salem_buildout.gpkg --processes 4
+################################################################################
+
+import argparse, csv, multiprocessing, os, shutil, tempfile, time, traceback
+
+import buildout_engine, buildout_profile, clip_cache, zoning_rules
+
+REPORT_FIELDS = ['MUNICIPALITY', 'STATUS', 'SECONDS', 'FEATURES', 'OUTPUT', 'ERROR']
+
+# Name of a municipality's zoning layer in the zoning workspace
+def zoningLayer(muniName):
+    return muniName.strip().replace(' ', '_')
+
+# Runs one municipality in its own scratch workspace and returns its report row,
+# with the path of its result in the scratch workspace as RESULT. This is the
+# function the worker processes run, so it never raises.
+def runMunicipality(job):
+    muniName = job['municipality']
+    started = time.time()
+    row = {'MUNICIPALITY': muniName, 'STATUS': 'OK', 'FEATURES': '', 'OUTPUT': '', 'RESULT': '', 'ERROR': ''}
+    try:
+        scratch = tempfile.mkdtemp(prefix=zoningLayer(muniName) + '_', dir=job['scratchRoot'])
+        profiler = buildout_profile.RunProfiler() if job['stageReports'] else None
+        if job['backend'] == 'arcpy':
+            import arcpy
+            outputPath = arcpy.CreateFileGDB_management(scratch, 'scratch.gdb').getOutput(0)
+            zoningSource = os.path.join(job['zoningWorkspace'], zoningLayer(muniName))
+            name = buildout_engine.runBuildout(zoningSource, zoningLayer(muniName), job['constraintsWorkspace'],
+                                               outputPath, job['additionalConstraints'], backend='arcpy',
+                                               profiler=profiler)
+            row['RESULT'] = os.path.join(outputPath, name)
+            row['FEATURES'] = int(arcpy.GetCount_management(row['RESULT']).getOutput(0))
+        else:
+            zoningSource = buildout_engine.layerSource(job['zoningWorkspace'], zoningLayer(muniName))
+            outputPath = os.path.join(scratch, '%s_final_result.parquet' % zoningLayer(muniName))
+            cache = None
+            if job['cacheDir']:
+                cache = clip_cache.ClipCache(job['cacheDir'], job['cacheBytes'])
+            result = buildout_engine.runBuildout(zoningSource, muniName, job['constraintsWorkspace'],
+                                                 outputPath, job['additionalConstraints'],
+                                                 cache=cache, region=job['region'], profiler=profiler,
+                                                 maskDir=job['maskDir'], parcelCachePath=job['parcelCache'],
+                                                 pipelined=job['pipelined'])
+            row['RESULT'] = outputPath
+            row['FEATURES'] = len(result)
+        if profiler is not None:
+            profiler.write(os.path.join(job['stageReports'], zoningLayer(muniName) + '.json'),
+                           {'municipality': muniName})
+    except Exception:
+        row['STATUS'] = 'FAILED'
+        row['ERROR'] = traceback.format_exc().strip().splitlines()[-1]
+    row['SECONDS'] = round(time.time() - started, 3)
+    return row
+
+# Merges the per-municipality results into the consolidated output. GeoParquet
+# and Arrow outputs get the fixed schema of buildout_export.RESULT_SCHEMA plus
+# the MUNICIPALITY field.
+def mergeResults(rows, outputPath, backend='open'):
+    done = [row for row in rows if row['STATUS'] == 'OK']
+    if not done:
+        return None
+    if outputPath.lower().endswith(('.parquet', '.arrow')):
+        import buildout_export
+        read = buildout_export.featureClassTable if backend == 'arcpy' else buildout_export.readTable
+        table = buildout_export.mergedTable([(row['MUNICIPALITY'], read(row['RESULT'])) for row in done])
+        buildout_export.writeTable(table, outputPath)
+        return table
+    if backend == 'arcpy':
+        import arcpy
+        for row in done:
+            arcpy.AddField_management(row['RESULT'], 'MUNICIPALITY', 'TEXT')
+            arcpy.CalculateField_management(row['RESULT'], 'MUNICIPALITY', repr(row['MUNICIPALITY']), 'PYTHON_9.3')
+        return arcpy.Merge_management([row['RESULT'] for row in done], outputPath)
+
+    import geopandas, pandas
+    frames = [buildout_engine.readLayer(row['RESULT']).assign(MUNICIPALITY=row['MUNICIPALITY'])
+              for row in done]
+    merged = geopandas.GeoDataFrame(pandas.concat(frames, ignore_index=True), crs=frames[0].crs)
+    buildout_engine.writeLayer(merged, outputPath)
+    return merged
+
+# Writes every municipality's result into the partitioned dataset at root,
+# replacing its earlier result there (see buildout_export.py)
+def exportToDataset(rows, root, backend='open'):
+    import buildout_export
+    for row in rows:
+        if row['STATUS'] != 'OK':
+            continue
+        if backend == 'arcpy':
+            table = buildout_export.featureClassTable(row['RESULT'])
+        else:
+            table = buildout_export.readTable(row['RESULT'])
+        buildout_export.appendToDataset(table, root, row['MUNICIPALITY'])
+
+def writeReport(rows, reportPath):
+    with open(reportPath, 'w') as reportFile:
+        writer = csv.DictWriter(reportFile, REPORT_FIELDS, lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict((field, row.get(field, '')) for field in REPORT_FIELDS))
+
+# Bounding box of the zoning of every registered municipality of a county in
+# the zoning workspace (municipalities whose zoning can't be read are left
+# out), or None if there is none
+def countyRegion(county, zoningWorkspace):
+    bounds = []
+    for muniName in zoning_rules.municipalitiesInCounty(county):
+        try:
+            source = buildout_engine.layerSource(zoningWorkspace, zoningLayer(muniName))
+            bounds.append(buildout_engine.readLayer(source).total_bounds)
+        except Exception:
+            continue
+    if not bounds:
+        return None
+    return (min(b[0] for b in bounds), min(b[1] for b in bounds),
+            max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+# The county region (see countyRegion) of each municipality of the batch, by
+# municipality. The region doesn't depend on which municipalities are in the
+# batch, so the clip cache extracts and masks of a county are reused by later
+# batches, and the clip cache clips each municipality from its county extract.
+def countyRegions(municipalities, zoningWorkspace):
+    counties = {}
+    for entry in zoning_rules.loadRegistry():
+        counties[entry['MUNICIPALITY'].lower()] = entry['COUNTY']
+    countyBounds = {}
+    regions = {}
+    for muniName in municipalities:
+        county = counties.get(muniName.strip().lower())
+        if not county:
+            continue
+        if county not in countyBounds:
+            countyBounds[county] = countyRegion(county, zoningWorkspace)
+        if countyBounds[county] is not None:
+            regions[muniName] = countyBounds[county]
+    return regions
+
+# Runs every municipality and returns the report rows, in the order given. With
+# a cacheDir the clipped inputs are kept in a clip_cache.ClipCache of at most
+# cacheBytes. With stageReports, a JSON report of the stage timings of each
+# municipality is written to that folder. With a datasetRoot the results are
+# also written into that partitioned dataset. With a maskDir the statewide
+# constraints come from one constraint_mask mask per county, which is built
+# before the municipalities are run. With a parcelCache (a parcel_cache.py
+# SQLite file) unchanged parcels are taken from the results of earlier runs.
+# With pipelined, each municipality is run with buildout_scheduler.py.
+def runBatch(municipalities, zoningWorkspace, constraintsWorkspace, outputPath, reportPath=None,
+             processes=None, additionalConstraints='', backend='open', scratchRoot=None, keepScratch=False,
+             cacheDir=None, cacheBytes=clip_cache.DEFAULT_MAX_BYTES, stageReports=None, datasetRoot=None,
+             maskDir=None, parcelCache=None, pipelined=False):
+    ownScratch = scratchRoot is None
+    if ownScratch:
+        scratchRoot = tempfile.mkdtemp(prefix='buildout_batch_')
+    if stageReports and not os.path.isdir(stageReports):
+        os.makedirs(stageReports)
+    regions = {}
+    if (cacheDir or maskDir) and backend == 'open':
+        regions = countyRegions(municipalities, zoningWorkspace)
+    if maskDir and backend == 'open':
+        import constraint_mask
+        store = constraint_mask.MaskStore(maskDir)
+        for region in set(regions.values()):
+            store.mask(constraintsWorkspace, region)
+    jobs = [{'municipality': muniName, 'zoningWorkspace': zoningWorkspace,
+             'constraintsWorkspace': constraintsWorkspace, 'additionalConstraints': additionalConstraints,
+             'backend': backend, 'scratchRoot': scratchRoot, 'cacheDir': cacheDir, 'cacheBytes': cacheBytes,
+             'region': regions.get(muniName), 'stageReports': stageReports, 'maskDir': maskDir,
+             'parcelCache': parcelCache, 'pipelined': pipelined}
+            for muniName in municipalities]
+
+    pool = multiprocessing.Pool(processes, maxtasksperchild=1)
+    try:
+        rows = pool.map(runMunicipality, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    mergeResults(rows, outputPath, backend)
+    for row in rows:
+        if row['STATUS'] == 'OK':
+            row['OUTPUT'] = outputPath
+    if datasetRoot:
+        exportToDataset(rows, datasetRoot, backend)
+    writeReport(rows, reportPath or os.path.splitext(outputPath)[0] + '_report.csv')
+    if ownScratch and not keepScratch:
+        shutil.rmtree(scratchRoot, ignore_errors=True)
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the buildout model for many municipalities.')
+    parser.add_argument('zoningWorkspace')
+    parser.add_argument('constraintsWorkspace')
+    parser.add_argument('output')
+    parser.add_argument('--municipalities', nargs='+', default=[])
+    parser.add_argument('--county', help='run every registered municipality in this county')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--report')
+    parser.add_argument('--constraints', default='', help="additional constraints, separated by ';'")
+    parser.add_argument('--backend', choices=['open', 'arcpy'], default='open')
+    parser.add_argument('--scratch', help='folder for the per-municipality scratch workspaces')
+    parser.add_argument('--keep-scratch', action='store_true')
+    parser.add_argument('--cache', help='folder for the clipped input cache')
+    parser.add_argument('--cache-size', type=float, default=clip_cache.DEFAULT_MAX_BYTES / 1024.0 ** 2,
+                        help='size limit of the clipped input cache, in MB')
+    parser.add_argument('--stage-reports', help='folder for the stage timing report of each municipality')
+    parser.add_argument('--dataset', help='partitioned GeoParquet dataset the results are also written to')
+    parser.add_argument('--masks', help='folder for the county constraint masks')
+    parser.add_argument('--parcel-cache', help='SQLite file of cached parcel results')
+    parser.add_argument('--pipelined', action='store_true',
+                        help='read the inputs and run the overlay and constraints concurrently')
+    args = parser.parse_args()
+
+    municipalities = list(args.municipalities)
+    if args.county:
+        municipalities += zoning_rules.municipalitiesInCounty(args.county)
+    if not municipalities:
+        parser.error('no municipalities given')
+
+    rows = runBatch(municipalities, args.zoningWorkspace, args.constraintsWorkspace, args.output, args.report,
+                    args.processes, args.constraints, args.backend, args.scratch, args.keep_scratch,
+                    args.cache, int(args.cache_size * 1024 ** 2), args.stage_reports, args.dataset,
+                    args.masks, args.parcel_cache, args.pipelined)
+    for row in rows:
+        print('%-30s %-7s %8.1fs %s' % (row['MUNICIPALITY'], row['STATUS'], row['SECONDS'], row['ERROR']))
+
+if __name__ == '__main__':
+    main()
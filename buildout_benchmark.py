@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+################################################################################
+# Benchmarks for the buildout engine
+#
+# Description:
+#   Generates synthetic municipalities (parcels, zoning, sewer service area, NO3
+# densities and constraint layers) of a given number of parcels and constraint
+# density, runs the model and point generation on them and appends the time
+# and throughput of every stage to a JSON lines results file. Each record
+# carries the git commit, the seed and the library versions it was run with, so
+# results can be compared across commits.
+#
+# The stages are timed without memory tracing (it slows them down). Their peak
+# Python memory is measured by one more, untimed run of each municipality,
+# which --no-memory leaves out.
+#
+# The synthetic data is made from a seeded random generator, so the same
+# (parcels, constraint density, seed) always gives the same layers. They are
+# written once to '<workdir>/synthetic_<parcels>_<density>_<seed>' as GeoParquet
+# files and reused by later runs.
+#
+# Constraint density is the share of the municipality covered by constraint
+# features (wetlands, water, open space, preserved farms, urban land use) and
+# also decides how many streams cross it.
+#
+# Usage:
+#   python buildout_benchmark.py --parcels 1000 10000 100000 --constraint-density 0.05 0.2
+#   python buildout_benchmark.py --summary
+################################################################################
+
+import argparse, json, math, os, platform, shutil, subprocess, tempfile, time
+import geopandas, numpy, pandas, pyogrio, shapely
+
+import buildout_engine, buildout_point_generation, buildout_profile, zoning_rules
+
+CRS = 'EPSG:3424' # NJ state plane feet
+DEFAULT_RESULTS = 'benchmark_results.jsonl'
+DEFAULT_WORKDIR = os.path.join(tempfile.gettempdir(), 'buildout_benchmark')
+
+# Zones of the synthetic municipalities as (Zone_ID, MINLOT, share of zones)
+SYNTHETIC_ZONES = [('R-1', 10000, 0.25), ('R-2', 20000, 0.25), ('RR', 43560, 0.2),
+                   ('AG', 87120, 0.2), ('C', 5000, 0.05), ('OS', 0, 0.05)]
+ZONE_BLOCK = 10 # zones are blocks of ZONE_BLOCK x ZONE_BLOCK parcels
+PARCEL_SIDE = (100.0, 400.0) # range of the parcel widths and heights, in feet
+
+# Share of the constraint area taken by each constraint layer
+CONSTRAINT_SHARES = [('wetlands', 0.4), ('nhd_waterbodies', 0.1), ('openspace_state', 0.1),
+                     ('openspace_county', 0.1), ('preserved_farms', 0.1), ('urban_land_use', 0.2)]
+CONSTRAINT_FEATURE_PARCELS = 5 # size of a constraint feature, in average parcels
+STREAM_PARCELS = 500 # parcels per stream at a constraint density of 1
+SEWER_SHARE = 0.3 # about this share of the municipality is sewered
+NO3_STRIPS = 4
+
+def syntheticRules():
+    zones, minLots, _ = zip(*SYNTHETIC_ZONES)
+    return zoning_rules.ZoningRules('Synthetic', list(zones), minLots, [numpy.nan] * len(zones),
+                                    [minLot == 0 for minLot in minLots])
+
+def _frame(columns, geoms):
+    return geopandas.GeoDataFrame(columns, geometry=geoms, crs=CRS)
+
+# Boxes of the given area centred on random points of the extent
+def _randomBoxes(rng, count, area, width, height):
+    x, y = rng.uniform(0, width, count), rng.uniform(0, height, count)
+    side = math.sqrt(area) * rng.uniform(0.5, 1.5, count)
+    return shapely.box(x - side / 2, y - side / 2, x + side / 2, y + side / 2)
+
+# Roughly round polygons of the given area centred on random points
+def _randomBlobs(rng, count, area, width, height):
+    points = shapely.points(rng.uniform(0, width, count), rng.uniform(0, height, count))
+    radius = math.sqrt(area / math.pi) * rng.uniform(0.5, 1.5, count)
+    return shapely.buffer(points, radius, quad_segs=4)
+
+# Streams crossing the municipality from west to east
+def _randomStreams(rng, count, width, height):
+    vertices = 10
+    x = numpy.linspace(0, width, vertices)
+    lines = []
+    for _ in range(count):
+        y = rng.uniform(0, height) + numpy.cumsum(rng.normal(0, height / 50.0, vertices))
+        lines.append(shapely.linestrings(x, numpy.clip(y, 0, height)))
+    return numpy.array(lines, dtype=object)
+
+# The zoning and INPUTS layers of a synthetic municipality with parcelCount
+# parcels. The zoning does not have MINLOT yet, see syntheticRules.
+def syntheticMunicipality(parcelCount, constraintDensity=0.1, seed=0):
+    rng = numpy.random.default_rng(seed)
+    columns = int(math.ceil(math.sqrt(parcelCount)))
+    rows = int(math.ceil(parcelCount / float(columns)))
+    xEdges = numpy.concatenate([[0.0], numpy.cumsum(rng.uniform(PARCEL_SIDE[0], PARCEL_SIDE[1], columns))])
+    yEdges = numpy.concatenate([[0.0], numpy.cumsum(rng.uniform(PARCEL_SIDE[0], PARCEL_SIDE[1], rows))])
+    width, height = xEdges[-1], yEdges[-1]
+
+    # parcels fill the grid row by row, the last row may be short (the zoning
+    # still covers all of it)
+    cell = numpy.arange(parcelCount)
+    row, column = cell // columns, cell % columns
+    parcels = _frame({'PAMS_PIN': ['SYN_%d' % n for n in cell]},
+                     shapely.box(xEdges[column], yEdges[row], xEdges[column + 1], yEdges[row + 1]))
+
+    # zones are blocks of parcels
+    zoneColumns = numpy.arange(0, columns, ZONE_BLOCK)
+    zoneRows = numpy.arange(0, rows, ZONE_BLOCK)
+    zoneColumn, zoneRow = [a.ravel() for a in numpy.meshgrid(zoneColumns, zoneRows)]
+    zoneIds, _, shares = zip(*SYNTHETIC_ZONES)
+    zoning = _frame({'Zone_ID': rng.choice(zoneIds, len(zoneColumn), p=shares)},
+                    shapely.box(xEdges[zoneColumn], yEdges[zoneRow],
+                                xEdges[numpy.minimum(zoneColumn + ZONE_BLOCK, columns)],
+                                yEdges[numpy.minimum(zoneRow + ZONE_BLOCK, rows)]))
+
+    area = width * height
+    parcelArea = area / parcelCount
+    # overlapping sewer disks are merged so no piece falls in two of them
+    sewerCount = max(1, parcelCount // 2000)
+    sewer = shapely.get_parts(shapely.union_all(
+        _randomBlobs(rng, sewerCount, SEWER_SHARE * area / sewerCount, width, height)))
+    strips = numpy.linspace(0, width, NO3_STRIPS + 1)
+    no3 = _frame({'SEPDENS': numpy.round(rng.uniform(1.0, 4.0, NO3_STRIPS), 1)},
+                 shapely.box(strips[:-1], 0, strips[1:], height))
+
+    layers = {'parcels': parcels,
+              'sewer_service_area': _frame({'SSA': ['SYNTHETIC'] * len(sewer)}, sewer),
+              'NO3_densities': no3,
+              'water_purveyors': _frame({'PURVNAME': ['SYNTHETIC']}, [shapely.box(0, 0, width, height)])}
+    featureArea = CONSTRAINT_FEATURE_PARCELS * parcelArea
+    for name, share in CONSTRAINT_SHARES:
+        count = max(1, int(round(constraintDensity * share * area / featureArea)))
+        if name in ('wetlands', 'nhd_waterbodies'):
+            layers[name] = _frame({}, _randomBlobs(rng, count, featureArea, width, height))
+        elif name == 'urban_land_use':
+            # half of the land use features are urban, the rest don't constrain
+            types = numpy.array(['URBAN', 'FOREST'] * count)
+            layers['Land_Use_Land_Cover_2012'] = _frame(
+                {'TYPE12': types}, _randomBoxes(rng, 2 * count, featureArea, width, height))
+        else:
+            layers[name] = _frame({}, _randomBoxes(rng, count, featureArea, width, height))
+    streams = max(1, int(round(constraintDensity * parcelCount / STREAM_PARCELS)))
+    layers['swqs'] = _frame({'ANTIDEG': rng.choice(['C1', 'C2', 'FW2'], streams, p=[0.3, 0.4, 0.3])},
+                            _randomStreams(rng, streams, width, height))
+    return zoning, layers
+
+def fixtureName(parcelCount, constraintDensity, seed):
+    return 'synthetic_%d_%s_%d' % (parcelCount, ('%g' % constraintDensity).replace('.', '_'), seed)
+
+# Writes a synthetic municipality to a folder of GeoParquet files (a workspace
+# for buildout_engine.layerSource), or reuses the one already there. Returns the
+# workspace.
+def writeFixture(workdir, parcelCount, constraintDensity=0.1, seed=0):
+    workspace = os.path.join(workdir, fixtureName(parcelCount, constraintDensity, seed))
+    if os.path.exists(os.path.join(workspace, 'zoning.parquet')):
+        return workspace
+    partial = workspace + '.partial'
+    if os.path.isdir(partial):
+        shutil.rmtree(partial)
+    os.makedirs(partial)
+    zoning, layers = syntheticMunicipality(parcelCount, constraintDensity, seed)
+    for name, frame in layers.items():
+        buildout_engine.writeLayer(frame, os.path.join(partial, name + '.parquet'))
+    # zoning last, it marks the fixture as complete
+    buildout_engine.writeLayer(zoning, os.path.join(partial, 'zoning.parquet'))
+    os.rename(partial, workspace)
+    return workspace
+
+# Runs the model (and point generation) on a synthetic workspace and returns the
+# RunProfiler with the stage timings. Memory tracing slows the stages down, so
+# it is only turned on (traceMemory) for a run that measures memory, not time.
+# The result is written to a temporary folder, the fixture is left as it is.
+def benchmarkRun(workspace, points=True, seed=0, traceMemory=False):
+    profiler = buildout_profile.RunProfiler(traceMemory=traceMemory)
+    with profiler.stage('minimum_lot_sizes') as stage:
+        zoning = buildout_engine.minimumLotSizes(
+            buildout_engine.readLayer(buildout_engine.layerSource(workspace, 'zoning')), syntheticRules())
+        boundary = zoning.geometry.union_all()
+        stage.out(len(zoning))
+    with profiler.stage('clip_inputs') as stage:
+        layers = buildout_engine.clipInputs(workspace, boundary)
+        stage.out(len(layers['parcels']))
+    result = buildout_engine.buildoutFromLayers(zoning, layers, profiler=profiler)
+    outputDir = tempfile.mkdtemp(prefix='buildout_benchmark_result_')
+    try:
+        with profiler.stage('write_result', len(result)):
+            buildout_engine.writeResult(result, os.path.join(outputDir, 'result.parquet'))
+    finally:
+        shutil.rmtree(outputDir, ignore_errors=True)
+    if points:
+        with profiler.stage('point_generation', len(zoning)) as stage:
+            stage.out(len(buildout_point_generation.generatePoints(zoning, seed)))
+    return profiler
+
+def gitCommit():
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=root).decode().strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                          cwd=root).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(changes)
+
+def environment():
+    versions = dict((module.__name__, module.__version__) for module in (numpy, pandas, shapely, geopandas, pyogrio))
+    versions['python'] = platform.python_version()
+    return {'platform': platform.platform(), 'processor': platform.processor() or platform.machine(),
+            'cpus': os.cpu_count(), 'versions': versions}
+
+# One benchmark record: the run's stages with their throughput (input features
+# per second) and where and how it was run. The stages' PEAK_PYTHON_MB come from
+# the separate memory run memoryProfiler, if there is one.
+def benchmarkRecord(profiler, parcelCount, constraintDensity, seed, fixtureSeconds, memoryProfiler=None):
+    commit, dirty = gitCommit()
+    peaks = {}
+    if memoryProfiler is not None:
+        peaks = dict((record['STAGE'], record['PEAK_PYTHON_MB']) for record in memoryProfiler.records)
+    stages = []
+    for record in profiler.records:
+        record = dict(record)
+        record['PEAK_PYTHON_MB'] = peaks.get(record['STAGE'])
+        features = record['FEATURES_IN'] if record['FEATURES_IN'] is not None else record['FEATURES_OUT']
+        record['FEATURES_PER_SECOND'] = round(features / record['SECONDS'], 1) \
+            if features is not None and record['SECONDS'] > 0 else None
+        stages.append(record)
+    total = profiler.totalSeconds()
+    return {'commit': commit, 'dirty': dirty, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'parcels': parcelCount, 'constraint_density': constraintDensity, 'seed': seed,
+            'fixture_seconds': round(fixtureSeconds, 3), 'total_seconds': total,
+            'parcels_per_second': round(parcelCount / total, 1) if total > 0 else None,
+            'stages': stages, 'environment': environment()}
+
+# Benchmarks every parcel count and constraint density. The timed runs are done
+# without memory tracing; with memory, one more run of each municipality
+# measures the memory of its stages.
+def runBenchmarks(parcelCounts, constraintDensities, seed=0, repeat=1, workdir=DEFAULT_WORKDIR,
+                  resultsPath=DEFAULT_RESULTS, points=True, memory=True):
+    records = []
+    for parcelCount in parcelCounts:
+        for constraintDensity in constraintDensities:
+            started = time.time()
+            workspace = writeFixture(workdir, parcelCount, constraintDensity, seed)
+            fixtureSeconds = time.time() - started
+            memoryProfiler = benchmarkRun(workspace, points, seed, traceMemory=True) if memory else None
+            for _ in range(repeat):
+                record = benchmarkRecord(benchmarkRun(workspace, points, seed), parcelCount, constraintDensity,
+                                         seed, fixtureSeconds, memoryProfiler)
+                with open(resultsPath, 'a') as resultsFile:
+                    resultsFile.write(json.dumps(record) + '\n')
+                print('%8d parcels  density %-5g %8.2fs  %10.1f parcels/s' % (
+                    parcelCount, constraintDensity, record['total_seconds'], record['parcels_per_second'] or 0))
+                records.append(record)
+    return records
+
+# Best total time of every (commit, parcels, constraint density, seed) in a
+# results file
+def summarize(resultsPath=DEFAULT_RESULTS):
+    with open(resultsPath) as resultsFile:
+        records = [json.loads(line) for line in resultsFile if line.strip()]
+    rows = pandas.DataFrame([{'COMMIT': (record['commit'] or '')[:10] + ('+' if record['dirty'] else ''),
+                              'PARCELS': record['parcels'], 'DENSITY': record['constraint_density'],
+                              'SEED': record['seed'], 'SECONDS': record['total_seconds'],
+                              'PARCELS_PER_SECOND': record['parcels_per_second']} for record in records])
+    keys = ['PARCELS', 'DENSITY', 'SEED', 'COMMIT']
+    return rows.groupby(keys, sort=False).agg(RUNS=('SECONDS', 'size'), SECONDS=('SECONDS', 'min'),
+                                              PARCELS_PER_SECOND=('PARCELS_PER_SECOND', 'max')).sort_index()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the buildout engine on synthetic municipalities.')
+    parser.add_argument('--parcels', nargs='+', type=int, default=[1000, 10000],
+                        help='parcel counts of the synthetic municipalities')
+    parser.add_argument('--constraint-density', nargs='+', type=float, default=[0.1],
+                        help='shares of the municipality covered by constraints')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each municipality')
+    parser.add_argument('--workdir', default=DEFAULT_WORKDIR, help='folder for the synthetic data')
+    parser.add_argument('--results', default=DEFAULT_RESULTS, help='JSON lines file the results are added to')
+    parser.add_argument('--no-points', action='store_true', help='leave point generation out')
+    parser.add_argument('--no-memory', action='store_true', help='leave the memory measuring run out')
+    parser.add_argument('--summary', action='store_true', help='only summarize the results file')
+    args = parser.parse_args()
+
+    if not args.summary:
+        runBenchmarks(args.parcels, args.constraint_density, args.seed, args.repeat, args.workdir,
+                      args.results, not args.no_points, not args.no_memory)
+    print(summarize(args.results).to_string())
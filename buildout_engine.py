@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+################################################################################
+# NJ Zoning Buildout Analysis - open data engine
+#
+# Description:
+#   Importable version of the buildout model in buildout_analysis.py that runs
+# without an ArcGIS licence. Layers are read from GeoPackages, folders of
+# shapefiles or GeoParquet files, and the clips, identities, erase and
+# dissolve are done with geopandas/shapely. The original arcpy model is still
+# available through runBuildout(..., backend='arcpy').
+#
+# Input system parameters:
+#   sys.argv[1] = zoning GIS data for the town ('file.gpkg|layer' for a
+#                 layer inside a GeoPackage)
+#   sys.argv[2] = the municipality name
+#   sys.argv[3] = the constraints workspace (.gpkg or folder)
+#   sys.argv[4] = the output file (.gpkg, .shp, .parquet or .arrow)
+#   sys.argv[5] = optional additional constraints, separated by ';'
+#   sys.argv[6] = optional run report with the time of each stage (.json or
+#                 .csv)
+################################################################################
+
+import os, sys
+import geopandas, pandas
+
+import buildout_overlay, buildout_profile, zoning_rules
+from buildout_analysis import FINAL_FIELDS, buildoutArrays, finalResultArrays, multiSystemPins
+
+# The statewide layers that are clipped to the municipality
+INPUTS = ['nhd_waterbodies', 'NO3_densities', 'openspace_county',
+          'openspace_state', 'parcels', 'preserved_farms', 'swqs',
+          'water_purveyors', 'wetlands', 'Land_Use_Land_Cover_2012',
+          'sewer_service_area']
+
+# Surface water antidegradation buffers, in the units of the data (NJ state
+# plane feet)
+C1_BUFFER = 300
+C2_BUFFER = 50
+
+# Field layout of the final result, in the order the arcpy model adds them
+BUILDOUT_FIELDS = ['CZBO_PRE', 'NO3BO_PRE', 'CZBO_POST', 'NO3BO_POST']
+RESULT_FIELDS = ['PAMS_PIN', 'SYSTEM'] + [name for name, _, _ in FINAL_FIELDS]
+
+ARROW_BLOCK = 100000 # geometries of an Arrow file tested against a bbox at a time
+PARQUET_ROW_GROUP = 50000 # features per GeoParquet row group, the unit a bbox read skips or reads
+
+################################################################################
+# Reading and writing layers
+################################################################################
+
+# Splits a 'path|layer' source string into its path and layer name
+def splitSource(source):
+    if '|' in source:
+        path, layer = source.split('|', 1)
+        return path, layer
+    return source, None
+
+# Returns the source string for a named layer in a workspace. A workspace is
+# either a GeoPackage or a folder of .parquet/.gpkg/.shp files.
+def layerSource(workspace, name):
+    if workspace.lower().endswith('.gpkg'):
+        return '%s|%s' % (workspace, name)
+    for ext in ('.parquet', '.gpkg', '.shp'):
+        path = os.path.join(workspace, name + ext)
+        if os.path.exists(path):
+            return path
+    raise IOError('Layer %s was not found in %s' % (name, workspace))
+
+# Reads a layer. With a bbox only the features whose bounding boxes touch it
+# are returned. GeoParquet files with a bbox covering column (writeLayer writes
+# one) are filtered while they are read, without loading the rest of the file,
+# other GeoParquet files are read whole and then filtered. Arrow files are
+# memory mapped and their geometries are tested ARROW_BLOCK at a time.
+def readLayer(source, bbox=None):
+    path, layer = splitSource(source)
+    if path.lower().endswith('.arrow'):
+        import buildout_export
+        if bbox is None:
+            return buildout_export.readResult(path)
+        table = buildout_export.readTable(path)
+        return buildout_export.toGeoDataFrame(table.filter(_bboxMask(table.column(buildout_export.GEOMETRY_COLUMN),
+                                                                     bbox)))
+    if path.lower().endswith('.parquet'):
+        if bbox is not None and hasBboxCovering(path):
+            return geopandas.read_parquet(path, bbox=tuple(bbox))
+        frame = geopandas.read_parquet(path)
+        if bbox is not None:
+            frame = frame.iloc[frame.sindex.query(_bboxGeometry(bbox))]
+        return frame
+    return geopandas.read_file(path, layer=layer, bbox=bbox)
+
+# Whether a GeoParquet file has a bbox covering column, so that readLayer can
+# filter it while it is read
+def hasBboxCovering(path):
+    import json, pyarrow.parquet
+    geo = json.loads((pyarrow.parquet.read_schema(path).metadata or {}).get(b'geo', b'{}'))
+    return any('covering' in column for column in geo.get('columns', {}).values())
+
+# Writes a layer. With append the features are added to an existing
+# GeoPackage layer or shapefile.
+def writeLayer(frame, source, append=False):
+    path, layer = splitSource(source)
+    mode = 'a' if append else 'w'
+    if path.lower().endswith('.parquet'):
+        if append:
+            raise ValueError('Features can not be appended to %s' % path)
+        frame.to_parquet(path, write_covering_bbox=True, row_group_size=PARQUET_ROW_GROUP)
+    elif path.lower().endswith('.gpkg'):
+        frame.to_file(path, layer=layer or os.path.splitext(os.path.basename(path))[0],
+                      driver='GPKG', mode=mode)
+    else:
+        frame.to_file(path, mode=mode)
+
+# Writes a final result. GeoParquet and Arrow files get the fixed schema of
+# buildout_export.RESULT_SCHEMA, other formats are written by writeLayer (with
+# append, see writeLayer).
+def writeResult(result, source, append=False):
+    if splitSource(source)[0].lower().endswith(('.parquet', '.arrow')):
+        if append:
+            raise ValueError('Results can not be appended to %s' % splitSource(source)[0])
+        import buildout_export
+        buildout_export.writeResult(result, splitSource(source)[0])
+    else:
+        writeLayer(result, source, append)
+
+def _bboxGeometry(bbox):
+    from shapely.geometry import box
+    return box(*bbox)
+
+# Which WKB geometries of an Arrow column have bounding boxes that touch bbox
+def _bboxMask(column, bbox):
+    import numpy, shapely
+    mask = []
+    for start in range(0, len(column), ARROW_BLOCK):
+        wkb = column.slice(start, ARROW_BLOCK).to_numpy(zero_copy_only=False)
+        xmin, ymin, xmax, ymax = shapely.bounds(shapely.from_wkb(wkb)).T
+        mask.append((xmin <= bbox[2]) & (xmax >= bbox[0]) & (ymin <= bbox[3]) & (ymax >= bbox[1]))
+    return numpy.concatenate(mask) if mask else numpy.zeros(0, dtype=bool)
+
+################################################################################
+# Model steps
+################################################################################
+
+# Returns a copy of the zoning data with MINLOT and RESDENSITY filled in from
+# the compiled zoning rules (see zoning_rules.py)
+def minimumLotSizes(zoning, rules):
+    zoning = zoning.copy()
+    existing = zoning['MINLOT'].values if 'MINLOT' in zoning else None
+    minLots, densities = rules.apply(zoning['Zone_ID'].values, existing)
+    zoning['MINLOT'] = minLots
+    zoning['RESDENSITY'] = densities
+    missing = zoning.loc[zoning['MINLOT'].isnull(), 'Zone_ID'].unique()
+    if len(missing):
+        raise ValueError('No minimum lot size for zones: %s' % ', '.join(map(str, missing)))
+    return zoning
+
+# Clips every layer to the municipal boundary
+def clipLayers(layers, boundary):
+    return dict((name, geopandas.clip(frame, boundary)) for name, frame in layers.items())
+
+# Calculates the buildout numbers for each piece, into the given fields. areas
+# are the piece areas, if they are already known.
+def buildoutCalculations(pieces, czField, no3Field, areas=None):
+    if areas is None:
+        areas = pieces.geometry.area.values
+    czbo, no3bo, _ = buildoutArrays(pieces['MINLOT'].values, pieces['SEPDENS'].values,
+                                    areas, pieces['SYSTEM'].values)
+    pieces[czField] = czbo
+    pieces[no3Field] = no3bo
+    return pieces
+
+# Parcel x zoning x sewer service area x NO3 densities, with the buildout
+# numbers before any constraints are erased
+def parcelPieces(parcels, zoning, sewerArea, no3Densities):
+    pieces = buildout_overlay.overlayParcels(parcels, zoning, sewerArea, no3Densities)
+    return buildoutCalculations(pieces, 'CZBO_PRE', 'NO3BO_PRE')
+
+# Names of the constraint sources, in the order they are merged
+CONSTRAINT_SOURCES = ['urban_land_use', 'c1_buffers', 'c2_buffers', 'wetlands', 'nhd_waterbodies',
+                      'openspace_state', 'openspace_county', 'zoned_open_space', 'preserved_farms',
+                      'additional_constraints']
+
+# The geometries of one of the CONSTRAINT_SOURCES
+def constraintSource(name, layers, zoning=None, addConstraints=None, c1Buffer=C1_BUFFER, c2Buffer=C2_BUFFER):
+    if name == 'urban_land_use':
+        landUse = layers['Land_Use_Land_Cover_2012']
+        return landUse.geometry[landUse['TYPE12'] == 'URBAN']
+    if name in ('c1_buffers', 'c2_buffers'):
+        swqs = layers['swqs']
+        antideg, distance = ('C1', c1Buffer) if name == 'c1_buffers' else ('C2', c2Buffer)
+        return swqs.geometry[swqs['ANTIDEG'] == antideg].buffer(distance)
+    if name == 'zoned_open_space':
+        return zoning.geometry[zoning['MINLOT'] == 0]
+    if name == 'additional_constraints':
+        return addConstraints.geometry
+    return layers[name].geometry
+
+# The constraint geometries for the municipality as (name, geometries) pairs:
+# urban land use, C1/C2 buffers, wetlands, water, open space, zoned open space,
+# preserved farms and any additional constraints. sources limits them to the
+# named CONSTRAINT_SOURCES, and only the layers those need have to be given.
+def constraintSources(layers, zoning=None, addConstraints=None, c1Buffer=C1_BUFFER, c2Buffer=C2_BUFFER,
+                      sources=None):
+    names = [name for name in CONSTRAINT_SOURCES if sources is None or name in sources]
+    if addConstraints is None and 'additional_constraints' in names:
+        names.remove('additional_constraints') # optional constraints
+    return [(name, constraintSource(name, layers, zoning, addConstraints, c1Buffer, c2Buffer)) for name in names]
+
+# All constraint geometries for the municipality merged into one layer. sources
+# limits them to the named CONSTRAINT_SOURCES; with none of them the layer is
+# empty.
+def constraintGeometries(layers, zoning, addConstraints=None, c1Buffer=C1_BUFFER, c2Buffer=C2_BUFFER,
+                         sources=None):
+    parts = [geopandas.GeoSeries(part.values, crs=zoning.crs)
+             for name, part in constraintSources(layers, zoning, addConstraints, c1Buffer, c2Buffer, sources)]
+    if not parts:
+        return geopandas.GeoDataFrame(geometry=geopandas.GeoSeries([], crs=zoning.crs), crs=zoning.crs)
+    geoms = pandas.concat(parts, ignore_index=True)
+    return geopandas.GeoDataFrame(geometry=geoms, crs=zoning.crs)
+
+# Erases the constraints, drops anything that doesn't meet the minimum lot size
+# and calculates the post-erase buildout numbers, all from the areas measured
+# once during the erase
+def erasedPieces(pieces, constraints):
+    pieces, areas = buildout_overlay.eraseFiltered(pieces, constraints.geometry.values, pieces['MINLOT'].values)
+    return buildoutCalculations(pieces, 'CZBO_POST', 'NO3BO_POST', areas)
+
+# Labels the parcels that are in both sewer and septic areas as 'SEWER/SEPTIC',
+# allowing for a clean dissolve on pams pin
+def markMultiSystem(pieces):
+    multiPins = multiSystemPins(zip(pieces['PAMS_PIN'], pieces['SYSTEM']))
+    pieces.loc[pieces['PAMS_PIN'].isin(multiPins), 'SYSTEM'] = 'SEWER/SEPTIC'
+    return pieces
+
+# Dissolves the pieces on pams pin and builds the final result fields in one
+# pass (see buildout_analysis.finalResultArrays). Pieces without a pams pin are
+# dissolved into one feature, as ArcGIS Dissolve does.
+def dissolveResult(pieces):
+    result = pieces.dissolve(by=['PAMS_PIN', 'SYSTEM'],
+                             aggfunc=dict((f, 'sum') for f in BUILDOUT_FIELDS),
+                             as_index=False, dropna=False)
+    values = finalResultArrays(result['CZBO_PRE'].values, result['NO3BO_PRE'].values,
+                               result['CZBO_POST'].values, result['NO3BO_POST'].values,
+                               result.geometry.area.values, result.geometry.length.values)
+    result = result[['PAMS_PIN', 'SYSTEM', result.geometry.name]].assign(**values)
+    return result[RESULT_FIELDS + [result.geometry.name]]
+
+# Runs the model on layers that are already in memory. layers holds the INPUTS
+# clipped to the municipality and zoning must already have MINLOT/RESDENSITY.
+# Each stage is timed by the profiler, if one is given (see buildout_profile.py).
+# If intermediates is a dict, the parcel pieces, constraints and erased pieces
+# are kept in it by name. With a county constraint mask (see constraint_mask.py)
+# layers only has to hold the constraint_mask.RUN_LAYERS.
+#
+# With a parcel_cache.ParcelCache, parcels whose pieces are in the cache are not
+# overlaid or erased again and the pieces of the others are added to it. The
+# parcel_pieces intermediate then only holds the parcels that were not cached.
+def buildoutFromLayers(zoning, layers, addConstraints=None, profiler=None, intermediates=None, mask=None,
+                       parcelCache=None):
+    profiler = profiler or buildout_profile.disabled()
+    parcels = layers['parcels']
+    with profiler.stage('constraints') as stage:
+        if mask is not None:
+            import constraint_mask
+            constraints = constraint_mask.withMask(mask, layers, zoning, addConstraints)
+        else:
+            constraints = constraintGeometries(layers, zoning, addConstraints)
+        stage.out(len(constraints))
+    if parcelCache is not None:
+        import parcel_cache
+        with profiler.stage('parcel_cache', len(parcels)) as stage:
+            pins, keys = parcel_cache.parcelKeys(parcels, zoning, layers['sewer_service_area'],
+                                                 layers['NO3_densities'], constraints)
+            cached, missing = parcelCache.get(keys, parcels.crs)
+            missingPins = [pin for pin, miss in zip(pins, missing) if miss]
+            missingKeys = [key for key, miss in zip(keys, missing) if miss]
+            parcels = parcels[parcels['PAMS_PIN'].map(parcel_cache.pinText).isin(set(missingPins))]
+            stage.out(len(parcels))
+    with profiler.stage('overlay', len(parcels)) as stage:
+        pieces = parcelPieces(parcels, zoning, layers['sewer_service_area'], layers['NO3_densities'])
+        stage.out(len(pieces))
+    with profiler.stage('erase', len(pieces)) as stage:
+        overlaid = pieces
+        pieces = erasedPieces(pieces, constraints)
+        stage.out(len(pieces))
+    if parcelCache is not None:
+        with profiler.stage('parcel_cache_store', len(pieces)) as stage:
+            parcelCache.put(missingPins, missingKeys, pieces)
+            if len(cached):
+                pieces = pandas.concat([cached.drop(columns='AREA'), pieces], ignore_index=True)
+            stage.out(len(pieces))
+    if intermediates is not None:
+        intermediates.update(parcel_pieces=overlaid, constraints=constraints, erased_pieces=pieces)
+    with profiler.stage('multi_system', len(pieces)) as stage:
+        pieces = markMultiSystem(pieces)
+        stage.out(len(pieces))
+    with profiler.stage('dissolve', len(pieces)) as stage:
+        result = dissolveResult(pieces)
+        stage.out(len(result))
+    return result
+
+################################################################################
+# Entry points
+################################################################################
+
+# Reads the INPUTS clipped to the municipal boundary. With a ClipCache (see
+# clip_cache.py) the clips are reused between runs, and region is the bounding
+# box of a larger area (e.g. the county) whose extract is cached and shared.
+# names limits the layers read to some of the INPUTS.
+def clipInputs(constraintsWorkspace, boundary, cache=None, region=None, names=INPUTS):
+    sources = [(name, layerSource(constraintsWorkspace, name)) for name in names]
+    if cache is not None:
+        return dict((name, cache.clip(source, boundary, region)) for name, source in sources)
+    layers = dict((name, readLayer(source, bbox=boundary.bounds)) for name, source in sources)
+    return clipLayers(layers, boundary)
+
+# Reads everything the model needs for one municipality: the zoning with its
+# minimum lot sizes, the clipped INPUTS and the clipped additional constraints
+# (None if there are none)
+def loadMunicipality(zoningSource, muniName, constraintsWorkspace, additionalConstraints='',
+                     cache=None, region=None, profiler=None, names=INPUTS):
+    profiler = profiler or buildout_profile.disabled()
+    with profiler.stage('minimum_lot_sizes') as stage:
+        rules = zoning_rules.loadRules(muniName, zoningSource)
+        zoning = minimumLotSizes(readLayer(zoningSource), rules)
+        boundary = zoning.geometry.union_all()
+        bbox = tuple(zoning.total_bounds)
+        stage.out(len(zoning))
+    with profiler.stage('clip_inputs') as stage:
+        layers = clipInputs(constraintsWorkspace, boundary, cache, region, names)
+        stage.out(sum(len(frame) for frame in layers.values()))
+
+    addConstraints = None
+    if additionalConstraints:
+        with profiler.stage('clip_additional_constraints') as stage:
+            frames = [geopandas.clip(readLayer(source, bbox=bbox), boundary)
+                      for source in additionalConstraints.split(';')]
+            addConstraints = pandas.concat(frames, ignore_index=True)
+            stage.out(len(addConstraints))
+    return zoning, layers, addConstraints
+
+# Reads, clips and runs the whole model for one municipality with the open data
+# backend and returns the final result. With a constraint_mask.MaskStore the
+# statewide constraints come from the mask of the region (or of the zoning's
+# bounding box without one), which is built the first time it is needed.
+# parcelCache is passed on to buildoutFromLayers.
+def openBuildout(zoningSource, muniName, constraintsWorkspace, additionalConstraints='',
+                 cache=None, region=None, profiler=None, intermediates=None, maskStore=None, parcelCache=None):
+    names = INPUTS
+    if maskStore is not None:
+        import constraint_mask
+        names = constraint_mask.RUN_LAYERS
+    zoning, layers, addConstraints = loadMunicipality(zoningSource, muniName, constraintsWorkspace,
+                                                      additionalConstraints, cache, region, profiler, names)
+    mask = None
+    if maskStore is not None:
+        with (profiler or buildout_profile.disabled()).stage('constraint_mask') as stage:
+            mask = maskStore.mask(constraintsWorkspace, region or tuple(zoning.total_bounds))
+            stage.out(len(mask))
+    return buildoutFromLayers(zoning, layers, addConstraints, profiler, intermediates, mask, parcelCache)
+
+# Runs the model for one municipality. With the open backend the result is
+# written to outputPath, with the arcpy backend outputPath is the output
+# workspace and the result is the '<muniName>_final_result' feature class.
+# cache and region are passed on to clipInputs, and the stages of either
+# backend are timed by the profiler if one is given.
+#
+# Results written as .parquet or .arrow have the fixed columnar schema of
+# buildout_export.py. exportPath is an extra .parquet/.arrow copy of the result
+# (for the arcpy backend, whose output stays a feature class), and the open
+# backend writes its intermediate layers as GeoParquet to intermediatesDir.
+# The open backend takes its statewide constraints from the county masks kept
+# in maskDir, if one is given (see constraint_mask.py), and reuses the parcel
+# results in the parcel_cache.py SQLite file parcelCachePath. With pipelined,
+# the input reads and the overlay and constraint branches run concurrently (see
+# buildout_scheduler.py), which doesn't work with a parcel cache.
+def runBuildout(zoningSource, muniName, constraintsWorkspace, outputPath,
+                additionalConstraints='', backend='open', cache=None, region=None, profiler=None,
+                exportPath=None, intermediatesDir=None, maskDir=None, parcelCachePath=None, pipelined=False):
+    if backend == 'arcpy':
+        import buildout_analysis
+        if buildout_analysis.arcpy is None:
+            raise ImportError('The arcpy backend needs an ArcGIS installation')
+        buildout_analysis.runModel(zoningSource, muniName, additionalConstraints,
+                                   outputPath, constraintsWorkspace, profiler, exportPath)
+        return '%s_final_result' % muniName
+
+    if backend != 'open':
+        raise ValueError('Unknown backend: %s' % backend)
+    if pipelined and parcelCachePath:
+        raise ValueError('A pipelined run cannot use the parcel cache')
+    intermediates = {} if intermediatesDir else None
+    maskStore = None
+    if maskDir:
+        import constraint_mask
+        maskStore = constraint_mask.MaskStore(maskDir)
+    parcelCache = None
+    if parcelCachePath:
+        import parcel_cache
+        parcelCache = parcel_cache.ParcelCache(parcelCachePath)
+    try:
+        if pipelined:
+            import buildout_scheduler
+            result = buildout_scheduler.pipelinedBuildout(zoningSource, muniName, constraintsWorkspace,
+                                                          additionalConstraints, cache, region, profiler,
+                                                          intermediates, maskStore)
+        else:
+            result = openBuildout(zoningSource, muniName, constraintsWorkspace, additionalConstraints,
+                                  cache, region, profiler, intermediates, maskStore, parcelCache)
+    finally:
+        if parcelCache is not None:
+            parcelCache.close()
+    with (profiler or buildout_profile.disabled()).stage('write_result', len(result)):
+        writeResult(result, outputPath)
+        if exportPath:
+            writeResult(result, exportPath)
+        if intermediates:
+            import buildout_export
+            buildout_export.writeIntermediates(intermediates, intermediatesDir)
+    return result
+
+if __name__ == '__main__':
+    extraConstraints = sys.argv[5] if len(sys.argv) > 5 else ''
+    runProfiler = buildout_profile.RunProfiler() if len(sys.argv) > 6 else None
+    runBuildout(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], extraConstraints, profiler=runProfiler)
+    if runProfiler is not None:
+        runProfiler.write(sys.argv[6], {'municipality': sys.argv[2]})
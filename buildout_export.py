@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+################################################################################
+# Columnar export of buildout results
+#
+# Description:
+#   Writes final results with a fixed Arrow schema (RESULT_SCHEMA), either as
+# GeoParquet or as an uncompressed Arrow IPC file that readers can memory map
+# and use without copying. Results of many municipalities are kept in one
+# dataset partitioned by municipality ('<root>/MUNICIPALITY=<name>/...'), where
+# writing a municipality again replaces its partition. The intermediate layers
+# of an engine run (see buildout_engine.buildoutFromLayers) can be written
+# next to it as GeoParquet.
+#
+# Geometries are stored as WKB in the 'geometry' column, described by GeoParquet
+# 1.0 'geo' metadata.
+#
+# Input system parameters:
+#   sys.argv[1] = a final result (.gpkg, .shp or .parquet, or a geodatabase
+#                 feature class with arcpy)
+#   sys.argv[2] = the municipality name
+#   sys.argv[3] = root folder of the partitioned dataset
+################################################################################
+
+import json, os, sys
+import pyarrow, pyarrow.dataset, pyarrow.ipc, pyarrow.parquet
+
+from buildout_analysis import FINAL_FIELDS
+
+GEOMETRY_COLUMN = 'geometry'
+PARTITION_FIELD = 'MUNICIPALITY'
+_ARROW_TYPES = {'SHORT': pyarrow.int16(), 'LONG': pyarrow.int32(), 'DOUBLE': pyarrow.float64()}
+
+# Columns of an exported result, in order
+RESULT_SCHEMA = pyarrow.schema([pyarrow.field('PAMS_PIN', pyarrow.string()),
+                                pyarrow.field('SYSTEM', pyarrow.string())] +
+                               [pyarrow.field(name, _ARROW_TYPES[fieldType]) for name, fieldType, _ in FINAL_FIELDS] +
+                               [pyarrow.field(GEOMETRY_COLUMN, pyarrow.binary())])
+
+# GeoParquet metadata for the geometry column. crs is a pyproj CRS, or anything
+# pyproj.CRS accepts (WKT, 'EPSG:3424', ...).
+def geoMetadata(crs=None, geometryTypes=('Polygon', 'MultiPolygon')):
+    column = {'encoding': 'WKB', 'geometry_types': list(geometryTypes)}
+    if crs is not None:
+        import pyproj
+        column['crs'] = pyproj.CRS.from_user_input(crs).to_json_dict()
+    return {b'geo': json.dumps({'version': '1.0.0', 'primary_column': GEOMETRY_COLUMN,
+                                'columns': {GEOMETRY_COLUMN: column}}).encode('utf-8')}
+
+# The Arrow table of a final result GeoDataFrame, with RESULT_SCHEMA
+def resultTable(result):
+    import shapely
+    columns = [pyarrow.array(result[field.name].values, type=field.type, from_pandas=True)
+               for field in RESULT_SCHEMA if field.name != GEOMETRY_COLUMN]
+    columns.append(pyarrow.array(shapely.to_wkb(result.geometry.values), type=pyarrow.binary()))
+    return pyarrow.Table.from_arrays(columns, schema=RESULT_SCHEMA.with_metadata(geoMetadata(result.crs)))
+
+# The Arrow table of an arcpy final result feature class, with RESULT_SCHEMA.
+# Read straight from a cursor, so it does not need geopandas.
+def featureClassTable(featureClass):
+    import arcpy
+    names = [field.name for field in RESULT_SCHEMA if field.name != GEOMETRY_COLUMN]
+    with arcpy.da.SearchCursor(featureClass, names + ['SHAPE@WKB']) as cursor:
+        rows = [row[:-1] + (bytes(row[-1]),) for row in cursor]
+    columns = list(zip(*rows)) if rows else [[]] * len(RESULT_SCHEMA)
+    spatialReference = arcpy.Describe(featureClass).spatialReference
+    crs = 'EPSG:%d' % spatialReference.factoryCode if spatialReference.factoryCode else None
+    arrays = [pyarrow.array(values, type=field.type) for values, field in zip(columns, RESULT_SCHEMA)]
+    return pyarrow.Table.from_arrays(arrays, schema=RESULT_SCHEMA.with_metadata(geoMetadata(crs)))
+
+# Writes a result table as GeoParquet, or as an uncompressed Arrow IPC file
+# (for memory mapped reads) if path ends in .arrow
+def writeTable(table, path):
+    temp = path + '.partial'
+    if path.lower().endswith('.arrow'):
+        with pyarrow.OSFile(temp, 'wb') as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    else:
+        pyarrow.parquet.write_table(table, temp)
+    os.replace(temp, path)
+
+def writeResult(result, path):
+    writeTable(resultTable(result), path)
+
+# Reads an exported result as an Arrow table. Arrow IPC files are memory mapped
+# and not copied; Parquet files are read through a memory map.
+def readTable(path, columns=None):
+    if path.lower().endswith('.arrow'):
+        table = pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r')).read_all()
+        return table.select(columns) if columns else table
+    return pyarrow.parquet.read_table(path, columns=columns, memory_map=True)
+
+# A GeoDataFrame from an exported result table
+def toGeoDataFrame(table):
+    import geopandas
+    geo = json.loads((table.schema.metadata or {}).get(b'geo', b'{}'))
+    crs = geo.get('columns', {}).get(GEOMETRY_COLUMN, {}).get('crs')
+    frame = table.drop_columns([GEOMETRY_COLUMN]).to_pandas()
+    geometry = geopandas.GeoSeries.from_wkb(table.column(GEOMETRY_COLUMN).to_numpy(zero_copy_only=False))
+    return geopandas.GeoDataFrame(frame, geometry=geometry.values, crs=crs)
+
+def readResult(path):
+    return toGeoDataFrame(readTable(path))
+
+################################################################################
+# Partitioned datasets
+################################################################################
+
+def _partitioning():
+    return pyarrow.dataset.partitioning(pyarrow.schema([(PARTITION_FIELD, pyarrow.string())]), flavor='hive')
+
+# Writes one municipality's result table into the dataset at root, replacing
+# any earlier result of that municipality
+def appendToDataset(table, root, municipality):
+    table = table.append_column(PARTITION_FIELD, pyarrow.array([municipality] * len(table), pyarrow.string()))
+    pyarrow.dataset.write_dataset(table, root, format='parquet', partitioning=_partitioning(),
+                                  basename_template='part-{i}.parquet',
+                                  existing_data_behavior='delete_matching')
+
+# One table of the result tables of many municipalities, given as
+# (municipality, table) pairs, with their names in a PARTITION_FIELD column
+def mergedTable(tables):
+    return pyarrow.concat_tables([table.append_column(PARTITION_FIELD, pyarrow.array([municipality] * len(table),
+                                                                                     pyarrow.string()))
+                                  for municipality, table in tables])
+
+# Reads the results of the given municipalities (all of them by default) from
+# the dataset at root. Only the partitions of those municipalities are read.
+def readDataset(root, municipalities=None, columns=None):
+    dataset = pyarrow.dataset.dataset(root, format='parquet', partitioning=_partitioning())
+    rowFilter = None
+    if municipalities is not None:
+        rowFilter = pyarrow.dataset.field(PARTITION_FIELD).isin(list(municipalities))
+    if columns is not None and GEOMETRY_COLUMN not in columns:
+        columns = list(columns) + [GEOMETRY_COLUMN]
+    table = dataset.to_table(columns=columns, filter=rowFilter)
+    # the partition files all carry the same geo metadata
+    metadata = dict(RESULT_SCHEMA.metadata or {})
+    for fragment in dataset.get_fragments(filter=rowFilter):
+        metadata = fragment.physical_schema.metadata or metadata
+        break
+    return table.replace_schema_metadata(metadata)
+
+# Reads the results of every registered municipality of a county
+def readCounty(root, county, columns=None):
+    import zoning_rules
+    return readDataset(root, zoning_rules.municipalitiesInCounty(county), columns)
+
+# Writes the intermediate layers of an engine run (name -> GeoDataFrame) to
+# '<folder>/<name>.parquet'
+def writeIntermediates(intermediates, folder):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    for name, frame in intermediates.items():
+        frame.to_parquet(os.path.join(folder, name + '.parquet'))
+
+if __name__ == '__main__':
+    resultSource = sys.argv[1]
+    if resultSource.lower().endswith(('.gpkg', '.shp', '.parquet')) or '|' in resultSource:
+        import buildout_engine
+        table = resultTable(buildout_engine.readLayer(resultSource))
+    else:
+        table = featureClassTable(resultSource)
+    appendToDataset(table, sys.argv[3], sys.argv[2])
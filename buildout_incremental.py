@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+################################################################################
+# Incremental re-runs of the buildout model
+#
+# Description:
+#   Keeps a fingerprint of every input feature next to a municipality's final
+# result ('<output>_state.parquet'). On the next run the zoning, parcels and
+# constraint features are fingerprinted again and compared with the stored
+# ones. Only the PAMS_PINs touched by a feature that was added, removed or
+# changed are run through the overlays, erase, buildout and dissolve again, and
+# their rows replace the old ones in the result. Without a previous state the
+# whole municipality is run.
+#
+# Input system parameters: the same as buildout_engine.py
+################################################################################
+
+import hashlib, os, sys
+import geopandas, numpy, pandas, shapely
+
+import buildout_engine
+
+# The attributes that the model reads from each layer. A feature is considered
+# changed when its geometry or one of these values changes.
+MODEL_COLUMNS = {'zoning': ['Zone_ID', 'MINLOT', 'RESDENSITY'], 'parcels': ['PAMS_PIN'],
+                 'NO3_densities': ['SEPDENS'], 'swqs': ['ANTIDEG'],
+                 'Land_Use_Land_Cover_2012': ['TYPE12']}
+
+# Layers that don't change the model's result
+IGNORED_LAYERS = ['water_purveyors']
+
+def statePath(outputPath):
+    return os.path.splitext(outputPath)[0] + '_state.parquet'
+
+# Hash of each feature's geometry and model attributes
+def featureHashes(frame, columns):
+    wkb = shapely.to_wkb(shapely.normalize(numpy.asarray(frame.geometry.values, dtype=object)))
+    values = [frame[column].values for column in columns]
+    hashes = []
+    for i, geometry in enumerate(wkb):
+        digest = hashlib.sha1(geometry)
+        for column in values:
+            digest.update(repr(column[i]).encode('utf-8'))
+        hashes.append(digest.hexdigest())
+    return hashes
+
+# One row per input feature: LAYER, HASH, PAMS_PIN (parcels only) and geometry
+def inputState(zoning, layers, addConstraints=None):
+    frames = dict(layers)
+    frames['zoning'] = zoning
+    if addConstraints is not None:
+        frames['additional_constraints'] = addConstraints
+    states = []
+    for name, frame in sorted(frames.items()):
+        if name in IGNORED_LAYERS or not len(frame):
+            continue
+        state = geopandas.GeoDataFrame({'LAYER': name, 'HASH': featureHashes(frame, MODEL_COLUMNS.get(name, []))},
+                                       geometry=frame.geometry.values, crs=zoning.crs)
+        state['PAMS_PIN'] = frame['PAMS_PIN'].values if name == 'parcels' else None
+        states.append(state)
+    return geopandas.GeoDataFrame(pandas.concat(states, ignore_index=True), crs=zoning.crs)
+
+# The features that are only in one of the two states (added, removed or changed)
+def changedFeatures(oldState, newState):
+    oldKeys = set(zip(oldState['LAYER'], oldState['HASH']))
+    newKeys = set(zip(newState['LAYER'], newState['HASH']))
+    removed = oldState[[key not in newKeys for key in zip(oldState['LAYER'], oldState['HASH'])]]
+    added = newState[[key not in oldKeys for key in zip(newState['LAYER'], newState['HASH'])]]
+    return pandas.concat([removed, added], ignore_index=True)
+
+# PAMS_PINs whose result may differ: parcels that changed themselves and parcels
+# touched by a changed zoning, sewer, NO3 or constraint feature
+def affectedPins(changed, parcels):
+    pins = set(changed.loc[changed['LAYER'] == 'parcels', 'PAMS_PIN'])
+    others = changed[changed['LAYER'] != 'parcels']
+    if len(others) and len(parcels):
+        geoms = numpy.asarray(others.geometry.values, dtype=object)
+        # the stream buffers reach past the stream itself
+        streams = (others['LAYER'] == 'swqs').values
+        geoms[streams] = shapely.buffer(geoms[streams], max(buildout_engine.C1_BUFFER, buildout_engine.C2_BUFFER))
+        tree = shapely.STRtree(numpy.asarray(parcels.geometry.values, dtype=object))
+        _, parcelIndex = tree.query(geoms, predicate='intersects')
+        pins.update(parcels['PAMS_PIN'].values[numpy.unique(parcelIndex)])
+    return pins
+
+# Runs the model again for the features that changed since the last run and
+# merges them into the previous result. Returns the result and the PAMS_PINs
+# that were recomputed (None for a full run).
+def runIncremental(zoningSource, muniName, constraintsWorkspace, outputPath, additionalConstraints='',
+                   cache=None, region=None):
+    zoning, layers, addConstraints = buildout_engine.loadMunicipality(
+        zoningSource, muniName, constraintsWorkspace, additionalConstraints, cache, region)
+    newState = inputState(zoning, layers, addConstraints)
+
+    if not (os.path.exists(outputPath) and os.path.exists(statePath(outputPath))):
+        result = buildout_engine.buildoutFromLayers(zoning, layers, addConstraints)
+        pins = None
+    else:
+        previous = buildout_engine.readLayer(outputPath)
+        parcels = layers['parcels']
+        pins = affectedPins(changedFeatures(geopandas.read_parquet(statePath(outputPath)), newState), parcels)
+        result = previous[~previous['PAMS_PIN'].isin(pins)]
+        subset = parcels[parcels['PAMS_PIN'].isin(pins)]
+        if len(subset):
+            partLayers = dict(layers, parcels=subset)
+            refreshed = buildout_engine.buildoutFromLayers(zoning, partLayers, addConstraints)
+            result = pandas.concat([result, refreshed.to_crs(previous.crs)], ignore_index=True)
+        result = geopandas.GeoDataFrame(result, crs=previous.crs)
+
+    buildout_engine.writeResult(result, outputPath)
+    newState.to_parquet(statePath(outputPath))
+    return result, pins
+
+if __name__ == '__main__':
+    extraConstraints = sys.argv[5] if len(sys.argv) > 5 else ''
+    result, pins = runIncremental(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4], extraConstraints)
+    if pins is None:
+        print('Ran all %d parcels' % len(result))
+    else:
+        print('Recomputed %d parcels' % len(pins))
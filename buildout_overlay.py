@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+################################################################################
+# Spatially indexed overlays for the buildout engine
+#
+# Description:
+#   Identity and erase overlays built on shapely STR-trees. Each parcel piece is
+# only tested against the zoning/sewer/NO3/constraint polygons whose bounding
+# boxes it touches. Pieces with no candidates are passed through untouched,
+# pieces that lie fully inside a polygon take its attributes (or, for the
+# erase, are dropped) without any geometry being cut, and only pieces on a
+# boundary are intersected. The three identities of the model are done in one
+# pass over plain arrays, without building an intermediate layer for each.
+################################################################################
+
+import numpy, shapely
+import geopandas
+
+POLYGON_TYPES = (shapely.GeometryType.POLYGON, shapely.GeometryType.MULTIPOLYGON)
+ZONING_COLUMNS = ['Zone_ID', 'MINLOT', 'RESDENSITY']
+
+# Keeps the polygonal part of each geometry (intersections of polygons can also
+# give lines and points where they touch). Returns the geometries and a mask of
+# the ones with any area left.
+def polygonal(geoms):
+    geoms = numpy.array(geoms, dtype=object)
+    types = shapely.get_type_id(geoms)
+    for i in numpy.nonzero(types == shapely.GeometryType.GEOMETRYCOLLECTION)[0]:
+        parts = [part for part in shapely.get_parts(geoms[i]) if shapely.get_type_id(part) in POLYGON_TYPES]
+        geoms[i] = shapely.multipolygons(parts) if parts else shapely.Polygon()
+    keep = numpy.isin(shapely.get_type_id(geoms), POLYGON_TYPES) & (shapely.area(geoms) > 0)
+    return geoms, keep
+
+# Union of the candidate geometries of each piece. pieceIndex must be sorted.
+# Returns the pieces that have candidates and the union for each of them.
+def groupedUnion(pieceIndex, geoms):
+    pieces, starts = numpy.unique(pieceIndex, return_index=True)
+    ends = numpy.append(starts[1:], len(pieceIndex))
+    unions = numpy.empty(len(pieces), dtype=object)
+    for n, (start, end) in enumerate(zip(starts, ends)):
+        unions[n] = geoms[start] if end - start == 1 else shapely.union_all(geoms[start:end])
+    return pieces, unions
+
+# Sorted (piece, layer feature) index pairs whose geometries intersect
+def candidatePairs(pieceGeoms, layerGeoms):
+    tree = shapely.STRtree(layerGeoms)
+    pieceIndex, layerIndex = tree.query(pieceGeoms, predicate='intersects')
+    order = numpy.argsort(pieceIndex, kind='stable')
+    return pieceIndex[order], layerIndex[order]
+
+# Identity of pieces (geometry array plus a dict of attribute arrays) against a
+# layer. Returns the new geometries, the index of the piece each one came from
+# and the index of the layer feature it falls in (-1 outside the layer). With
+# keepOutside=False the parts of pieces outside the layer are left out, which
+# is the same as the model's identity followed by deleting FID = -1.
+def identityIndex(pieceGeoms, layerGeoms, keepOutside=True):
+    pieceIndex, layerIndex = candidatePairs(pieceGeoms, layerGeoms)
+    within = shapely.within(pieceGeoms[pieceIndex], layerGeoms[layerIndex])
+
+    # only boundary pieces are cut, pieces fully inside a feature keep their shape
+    geoms = pieceGeoms[pieceIndex].copy()
+    cut = ~within
+    geoms[cut] = shapely.intersection(pieceGeoms[pieceIndex[cut]], layerGeoms[layerIndex[cut]])
+    geoms, keep = polygonal(geoms)
+    outGeoms, outPieces, outLayer = [geoms[keep]], [pieceIndex[keep]], [layerIndex[keep]]
+
+    if keepOutside:
+        covered = numpy.zeros(len(pieceGeoms), dtype=bool)
+        covered[pieceIndex[within]] = True
+        # pieces with no candidates are entirely outside the layer
+        outside = numpy.ones(len(pieceGeoms), dtype=bool)
+        outside[pieceIndex] = False
+        outIds = numpy.nonzero(outside)[0]
+        outGeoms.append(pieceGeoms[outIds])
+        outPieces.append(outIds)
+        outLayer.append(numpy.full(len(outIds), -1))
+
+        # boundary pieces keep the part that is outside every candidate
+        partial = ~covered[pieceIndex]
+        ids, unions = groupedUnion(pieceIndex[partial], layerGeoms[layerIndex[partial]])
+        rest, keep = polygonal(shapely.difference(pieceGeoms[ids], unions))
+        outGeoms.append(rest[keep])
+        outPieces.append(ids[keep])
+        outLayer.append(numpy.full(keep.sum(), -1))
+
+    geoms = numpy.concatenate(outGeoms)
+    pieces = numpy.concatenate(outPieces).astype('int64')
+    layer = numpy.concatenate(outLayer).astype('int64')
+    order = numpy.lexsort((layer, pieces))
+    return geoms[order], pieces[order], layer[order]
+
+# Identity of pieces against a layer, carrying the given layer columns over
+def identity(geoms, columns, layer, layerColumns, keepOutside=True):
+    layerGeoms = numpy.asarray(layer.geometry.values, dtype=object)
+    geoms, pieceIndex, layerIndex = identityIndex(geoms, layerGeoms, keepOutside)
+    columns = dict((name, values[pieceIndex]) for name, values in columns.items())
+    inside = layerIndex >= 0
+    for name in layerColumns:
+        values = numpy.asarray(layer[name].values)
+        if values.dtype.kind in 'iub':
+            values = values.astype('float64')
+        column = numpy.full(len(geoms), numpy.nan if values.dtype.kind == 'f' else None,
+                            dtype=values.dtype if values.dtype.kind == 'f' else object)
+        column[inside] = values[layerIndex[inside]]
+        columns[name] = column
+    return geoms, columns, inside
+
+# Parcel x zoning x sewer service area x NO3 densities in one pass. Parcel area
+# outside the zoning or NO3 layers is dropped, the sewer service area only
+# decides SYSTEM. zoningColumns are the zoning fields carried over.
+def overlayParcels(parcels, zoning, sewerArea, no3Densities, zoningColumns=ZONING_COLUMNS):
+    geoms = numpy.asarray(parcels.geometry.values, dtype=object)
+    columns = {'PAMS_PIN': numpy.asarray(parcels['PAMS_PIN'].values, dtype=object)}
+    geoms, columns, _ = identity(geoms, columns, zoning, zoningColumns, False)
+    geoms, columns, sewered = identity(geoms, columns, sewerArea, [])
+    columns['SYSTEM'] = numpy.where(sewered, 'SEWER', 'SEPTIC').astype(object)
+    geoms, columns, _ = identity(geoms, columns, no3Densities, ['SEPDENS'], False)
+    return geopandas.GeoDataFrame(columns, geometry=geoms, crs=parcels.crs)
+
+# Erases the constraint geometries from an array of piece geometries. Pieces
+# with no candidate constraints are kept as they are, pieces inside a
+# constraint are dropped and only the rest are cut. Returns the new geometries
+# and a mask of the dropped pieces.
+def erasedGeometries(pieceGeoms, constraintGeoms):
+    pieceGeoms = numpy.asarray(pieceGeoms, dtype=object)
+    constraintGeoms = numpy.asarray(constraintGeoms, dtype=object)
+    pieceIndex, constraintIndex = candidatePairs(pieceGeoms, constraintGeoms)
+
+    inside = shapely.within(pieceGeoms[pieceIndex], constraintGeoms[constraintIndex])
+    dropped = numpy.zeros(len(pieceGeoms), dtype=bool)
+    dropped[pieceIndex[inside]] = True
+
+    partial = ~dropped[pieceIndex]
+    ids, unions = groupedUnion(pieceIndex[partial], constraintGeoms[constraintIndex[partial]])
+    geoms = pieceGeoms.copy()
+    geoms[ids], keep = polygonal(shapely.difference(pieceGeoms[ids], unions))
+    dropped[ids[~keep]] = True
+    return geoms, dropped
+
+# The erase with the minimum lot filter done in the same pass: the area of each
+# remaining piece is measured once, and pieces smaller than their minArea are
+# dropped along with the erased ones before the layer is copied. Returns the
+# pieces and their post-erase areas.
+def eraseFiltered(pieces, constraintGeoms, minArea):
+    geoms, dropped = erasedGeometries(pieces.geometry.values, constraintGeoms)
+    areas = numpy.zeros(len(geoms))
+    areas[~dropped] = shapely.area(geoms[~dropped])
+    kept = ~dropped & (areas >= numpy.asarray(minArea, dtype=float))
+    result = pieces[kept].copy()
+    result[pieces.geometry.name] = geopandas.GeoSeries(geoms[kept], index=result.index, crs=pieces.crs)
+    return result, areas[kept]
@@ -8,135 +8,372 @@
 # zoning minimum lot size standards. This model is a more visual alternative
 # to the NJDEP buildout estimation model.
 #
+#   Each zone gets a lattice of points spaced sqrt(MINLOT) apart (the label
+# points of a fishnet over the zone's extent), built as coordinate arrays and
+# kept only where they fall inside the zone. Without arcpy the same points are
+# made with geopandas (see buildout_engine.py for the supported formats).
+#
 # Input system parameters:
 #   sys.argv[1] = zoning GIS data for the town
 #   sys.argv[2] = the desired name modifier for the output file
 #   sys.argv[3] = the output workspace
+#   sys.argv[4] = optional random seed for the point offsets, the same seed
+#                 always gives the same points
+#   sys.argv[5] = optional 'true' to keep offset points inside their zone
+#   sys.argv[6] = optional CZBO_POST or NO3BO_POST: instead of the zoning
+#                 lattice, place that many points inside every parcel of the
+#                 final result given as sys.argv[1] ('<muni>_final_result')
 ################################################################################
 
 # libraries and constants
-import arcpy, math, sets, random, sys
-MINLOT_ROW_INDEX = 2 # used for modifying point geoms. 
+import math, os, sys
+import numpy, shapely # shapely 2.0 or later, with arcpy too (see README.md)
+
+# arcpy is optional, see openPoints
+try:
+    import arcpy
+except ImportError:
+    arcpy = None
+
 WIGGLE_FACTOR = .2 # the amount of simulated natural movement for the
                    # generated points, .2 or lower is recommended
+LATTICE_BLOCK = 1000000 # lattice points tested against a zone at a time
+JITTER_ATTEMPTS = 10 # offsets tried for a point that has to stay inside its zone
+
+# Parcel point placement, see parcelPoints
+COUNT_FIELDS = ['CZBO_POST', 'NO3BO_POST']
+PLACEMENT_TRIES = 4 # lattices tried for a parcel before random points
+SPACING_SHRINK = .8 # each lattice is this much finer than the one before
+MAX_BOX_RATIO = 20 # parcels that fill less of their bounding box go straight to random points
+REJECTION_ROUNDS = 20
+MAX_PARCEL_DRAWS = 100000 # random points drawn for one parcel in a round
+MAX_ROUND_DRAWS = 1000000 # lattice or random points tested at a time, over all parcels
+
+# The fishnet label points of a zone: the centres of sqrt(minLot) cells laid
+# from the lower left of the zone's extent, kept where they fall inside the
+# zone. Returns the x and y arrays. Big lattices are tested in blocks of rows
+# so they never have to be in memory all at once.
+def latticePoints(geometry, minLot):
+    if minLot <= 0 or shapely.is_empty(geometry):
+        return numpy.empty(0), numpy.empty(0)
+    spacing = math.sqrt(minLot)
+    xmin, ymin, xmax, ymax = shapely.bounds(geometry)
+    xs = xmin + (numpy.arange(max(1, int(math.ceil((xmax - xmin) / spacing)))) + 0.5) * spacing
+    rows = max(1, int(math.ceil((ymax - ymin) / spacing)))
+    blockRows = max(1, LATTICE_BLOCK // len(xs))
+    shapely.prepare(geometry)
+    outX, outY = [], []
+    for start in range(0, rows, blockRows):
+        ys = ymin + (numpy.arange(start, min(rows, start + blockRows)) + 0.5) * spacing
+        x, y = [a.ravel() for a in numpy.meshgrid(xs, ys)]
+        inside = shapely.contains_xy(geometry, x, y)
+        outX.append(x[inside])
+        outY.append(y[inside])
+    return numpy.concatenate(outX), numpy.concatenate(outY)
+
+# Lattice points for every zone with a minimum lot size (some preserved zones
+# are marked with a 0 for minimum lot size in our data). Returns the x and y
+# arrays and the index of the zone each point is in.
+def fishnetPoints(geoms, minLots):
+    outX, outY, outZones = [], [], []
+    for n, (geometry, minLot) in enumerate(zip(geoms, minLots)):
+        x, y = latticePoints(geometry, minLot)
+        outX.append(x)
+        outY.append(y)
+        outZones.append(numpy.full(len(x), n, dtype='int64'))
+    if not outX:
+        return numpy.empty(0), numpy.empty(0), numpy.empty(0, dtype='int64')
+    return numpy.concatenate(outX), numpy.concatenate(outY), numpy.concatenate(outZones)
+
+# Moves every point by up to wiggleFactor * sqrt(MINLOT) in x and in y, to
+# simulate natural movement. The offsets come from a random generator seeded
+# with seed, so the same seed gives the same points. With zoneGeoms (the zone
+# of each point) offsets that leave the zone are drawn again, and points that
+# can't be moved inside it in JITTER_ATTEMPTS tries stay where they are.
+# Returns the new x and y arrays.
+def jitterPoints(x, y, minLots, seed=None, zoneGeoms=None, wiggleFactor=WIGGLE_FACTOR):
+    rng = numpy.random.default_rng(seed)
+    offset = wiggleFactor * numpy.sqrt(numpy.asarray(minLots, dtype='float64'))
+    x = numpy.asarray(x, dtype='float64')
+    y = numpy.asarray(y, dtype='float64')
+    newX = x + rng.uniform(-offset, offset)
+    newY = y + rng.uniform(-offset, offset)
+    if zoneGeoms is None:
+        return newX, newY
+
+    zoneGeoms = numpy.asarray(zoneGeoms, dtype=object)
+    shapely.prepare(zoneGeoms)
+    outside = numpy.nonzero(~shapely.contains_xy(zoneGeoms, newX, newY))[0]
+    for _ in range(JITTER_ATTEMPTS):
+        if not len(outside):
+            break
+        newX[outside] = x[outside] + rng.uniform(-offset[outside], offset[outside])
+        newY[outside] = y[outside] + rng.uniform(-offset[outside], offset[outside])
+        outside = outside[~shapely.contains_xy(zoneGeoms[outside], newX[outside], newY[outside])]
+    newX[outside] = x[outside]
+    newY[outside] = y[outside]
+    return newX, newY
+
+# The buildout points of a zoning GeoDataFrame that has Zone_ID and MINLOT, as a
+# point GeoDataFrame with the Zone_ID and MINLOT of the zone each point is in.
+# The points are offset with jitterPoints.
+def generatePoints(zoning, seed=None, keepInside=False, wiggleFactor=WIGGLE_FACTOR):
+    import geopandas
+    zones = zoning.dissolve(by=['Zone_ID', 'MINLOT'], as_index=False)
+    geoms = zones.geometry.values
+    x, y, zoneIndex = fishnetPoints(geoms, zones['MINLOT'].values.astype('float64'))
+    x, y = jitterPoints(x, y, zones['MINLOT'].values[zoneIndex], seed,
+                        numpy.asarray(geoms, dtype=object)[zoneIndex] if keepInside else None, wiggleFactor)
+    return geopandas.GeoDataFrame({'Zone_ID': zones['Zone_ID'].values[zoneIndex],
+                                   'MINLOT': zones['MINLOT'].values[zoneIndex]},
+                                  geometry=geopandas.points_from_xy(x, y), crs=zoning.crs)
+
+# Positions of the members of consecutive groups of the given sizes: the group
+# of each member and its rank within the group
+def _groupRanks(sizes):
+    sizes = numpy.asarray(sizes, dtype='int64')
+    owner = numpy.repeat(numpy.arange(len(sizes)), sizes)
+    starts = numpy.cumsum(sizes) - sizes
+    return owner, numpy.arange(sizes.sum()) - starts[owner]
+
+# Consecutive slices of groups of the given sizes that add up to no more than
+# budget (a group bigger than budget gets a slice of its own)
+def _batches(sizes, budget):
+    ends = numpy.cumsum(sizes)
+    start = 0
+    while start < len(ends):
+        offset = ends[start - 1] if start else 0
+        stop = max(start + 1, int(numpy.searchsorted(ends, offset + budget, side='right')))
+        yield slice(start, stop)
+        start = stop
+
+# Exactly counts[i] points inside each parcel geometry geoms[i]. Each parcel
+# first gets a lattice spaced so that about counts[i] cells fit in it, which is
+# made SPACING_SHRINK times finer (up to PLACEMENT_TRIES times) until enough of
+# its points fall inside, and counts[i] of them are taken evenly. Parcels that
+# are too thin for a lattice get random points from their bounding box that are
+# kept when they fall inside (seeded with seed), and any parcel still short
+# after REJECTION_ROUNDS gets copies of a point on its surface. The parcels
+# are done together in every round, in batches of at most MAX_ROUND_DRAWS
+# points. Parcels with no or an empty geometry get no points, their indexes
+# are added to skipped if it is given. Returns the x and y arrays and the index
+# of the parcel of each point, ordered by parcel.
+def parcelPoints(geoms, counts, seed=None, skipped=None):
+    rng = numpy.random.default_rng(seed)
+    geoms = numpy.asarray(geoms, dtype=object)
+    counts = numpy.maximum(numpy.nan_to_num(numpy.asarray(counts, dtype='float64')), 0).astype('int64')
+    blank = shapely.is_missing(geoms) | shapely.is_empty(geoms)
+    if skipped is not None:
+        skipped.extend(numpy.nonzero(blank & (counts > 0))[0].tolist())
+    counts[blank] = 0
+    shapely.prepare(geoms)
+    xmin, ymin, xmax, ymax = shapely.bounds(geoms).T
+    area = shapely.area(geoms)
+    placed = numpy.zeros(len(geoms), dtype='int64')
+    outX, outY, outParcels = [], [], []
+
+    def keep(parcels, x, y):
+        outX.append(x)
+        outY.append(y)
+        outParcels.append(parcels)
+        placed[:] += numpy.bincount(parcels, minlength=len(geoms))
+
+    # places need points on a lattice of each parcel, if enough of it falls
+    # inside, and returns which parcels are done
+    def lattice(parcels, spacing, columns, rows, need):
+        # the lattice is centred on the parcel's bounding box
+        xStart = (xmin[parcels] + xmax[parcels] - (columns - 1) * spacing) / 2.0
+        yStart = (ymin[parcels] + ymax[parcels] - (rows - 1) * spacing) / 2.0
+        owner, rank = _groupRanks(columns * rows)
+        x = xStart[owner] + (rank % columns[owner]) * spacing[owner]
+        y = yStart[owner] + (rank // columns[owner]) * spacing[owner]
+        inside = shapely.contains_xy(geoms[parcels[owner]], x, y)
+        owner, x, y = owner[inside], x[inside], y[inside]
+        found = numpy.bincount(owner, minlength=len(parcels))
+
+        # take need of the found points, evenly spread over them
+        done = found >= need
+        _, rank = _groupRanks(found)
+        chosen = done[owner] & ((rank * need[owner]) // numpy.maximum(found[owner], 1) !=
+                                ((rank + 1) * need[owner]) // numpy.maximum(found[owner], 1))
+        keep(parcels[owner[chosen]], x[chosen], y[chosen])
+        return done
+
+    # keeps up to need of draws random points in each parcel's bounding box
+    def rejection(parcels, draws, need):
+        owner, _ = _groupRanks(draws)
+        x = rng.uniform(xmin[parcels[owner]], xmax[parcels[owner]])
+        y = rng.uniform(ymin[parcels[owner]], ymax[parcels[owner]])
+        inside = shapely.contains_xy(geoms[parcels[owner]], x, y)
+        owner, x, y = owner[inside], x[inside], y[inside]
+        _, rank = _groupRanks(numpy.bincount(owner, minlength=len(parcels)))
+        chosen = rank < need[owner]
+        keep(parcels[owner[chosen]], x[chosen], y[chosen])
+
+    # lattices for parcels that are not much thinner than their bounding box
+    boxArea = numpy.maximum((xmax - xmin) * (ymax - ymin), 1e-9)
+    pending = numpy.nonzero((counts > 0) & (area > 0) & (boxArea / numpy.maximum(area, 1e-9) < MAX_BOX_RATIO))[0]
+    spacing = numpy.sqrt(area[pending] / numpy.maximum(counts[pending], 1))
+    for _ in range(PLACEMENT_TRIES):
+        if not len(pending):
+            break
+        columns = numpy.maximum(numpy.ceil((xmax[pending] - xmin[pending]) / spacing), 1).astype('int64')
+        rows = numpy.maximum(numpy.ceil((ymax[pending] - ymin[pending]) / spacing), 1).astype('int64')
+        done = numpy.zeros(len(pending), dtype=bool)
+        for batch in _batches(columns * rows, MAX_ROUND_DRAWS):
+            done[batch] = lattice(pending[batch], spacing[batch], columns[batch], rows[batch],
+                                  counts[pending[batch]])
+        pending, spacing = pending[~done], spacing[~done] * SPACING_SHRINK
+
+    # random points in the bounding box of the rest
+    for _ in range(REJECTION_ROUNDS):
+        pending = numpy.nonzero((counts > placed) & (area > 0))[0]
+        if not len(pending):
+            break
+        need = counts[pending] - placed[pending]
+        ratio = boxArea[pending] / numpy.maximum(area[pending], 1e-9)
+        draws = numpy.minimum(numpy.ceil(need * ratio * 2).astype('int64') + 4, MAX_PARCEL_DRAWS)
+        for batch in _batches(draws, MAX_ROUND_DRAWS):
+            rejection(pending[batch], draws[batch], need[batch])
 
-def stripDash(string):
-    newString = ''
-    if '-' in string:
-        parts = string.split('-')
-        for part in parts:
-            newString += part
-        return newString
+    # whatever is left (slivers) is put on the surface
+    short = numpy.nonzero(counts > placed)[0]
+    if len(short):
+        surface = shapely.point_on_surface(geoms[short])
+        owner, _ = _groupRanks(counts[short] - placed[short])
+        keep(short[owner], shapely.get_x(surface)[owner], shapely.get_y(surface)[owner])
 
-    # no dashes found, return original input
+    if not outX:
+        return numpy.empty(0), numpy.empty(0), numpy.empty(0, dtype='int64')
+    x, y, parcels = numpy.concatenate(outX), numpy.concatenate(outY), numpy.concatenate(outParcels)
+    order = numpy.argsort(parcels, kind='stable')
+    return x[order], y[order], parcels[order]
+
+# Buildout points for the parcels of a final result GeoDataFrame (see
+# buildout_engine.py): countField (CZBO_POST or NO3BO_POST) points inside each
+# parcel, with the parcel's PAMS_PIN, SYSTEM and count. The PAMS_PINs of
+# parcels with no geometry are added to skipped if it is given.
+def generateParcelPoints(result, countField='CZBO_POST', seed=None, skipped=None):
+    import geopandas
+    blank = []
+    x, y, parcels = parcelPoints(result.geometry.values, result[countField].values, seed, blank)
+    if skipped is not None:
+        skipped.extend(result['PAMS_PIN'].values[blank].tolist())
+    return geopandas.GeoDataFrame({'PAMS_PIN': result['PAMS_PIN'].values[parcels],
+                                   'SYSTEM': result['SYSTEM'].values[parcels],
+                                   countField: result[countField].values[parcels]},
+                                  geometry=geopandas.points_from_xy(x, y), crs=result.crs)
+
+# Open data version of the tool. Zoning without MINLOT gets it from the zoning
+# rules registry (see zoning_rules.py). Writes '<outFileName>_FISHNET' to the
+# output workspace (a GeoPackage or a folder) and returns the points.
+def openPoints(zoningSource, outFileName, outputWorkspace, seed=None, keepInside=False):
+    import buildout_engine, zoning_rules
+    zoning = buildout_engine.readLayer(zoningSource)
+    if 'MINLOT' not in zoning:
+        zoning = buildout_engine.minimumLotSizes(zoning, zoning_rules.loadRules(outFileName, zoningSource))
+    points = generatePoints(zoning, seed, keepInside)
+    _writeOpen(points, outputWorkspace, '%s_FISHNET'%(outFileName))
+    return points
+
+# Open data version of the parcel mode: countField points in each parcel of the
+# final result, written as '<outFileName>_<countField>_POINTS'
+def openParcelPoints(resultSource, outFileName, outputWorkspace, countField='CZBO_POST', seed=None):
+    import buildout_engine
+    skipped = []
+    points = generateParcelPoints(buildout_engine.readLayer(resultSource), countField, seed, skipped)
+    if skipped:
+        print('Skipped %d parcels with no geometry: %s'%(len(skipped), ', '.join(str(pin) for pin in skipped)))
+    _writeOpen(points, outputWorkspace, '%s_%s_POINTS'%(outFileName, countField))
+    return points
+
+def _writeOpen(points, outputWorkspace, fileName):
+    import buildout_engine
+    if outputWorkspace.lower().endswith('.gpkg'):
+        buildout_engine.writeLayer(points, '%s|%s'%(outputWorkspace, fileName))
     else:
-        return string
-        
-if __name__ == '__main__':
-    # Output workspace and input system params. 
-    zoning = arcpy.Dissolve_management(sys.argv[1], 'dissolved_zoning', ['Zone_ID', 'MINLOT'])
-    outFileName = sys.argv[2]
-    arcpy.env.workspace = sys.argv[3] 
+        buildout_engine.writeLayer(points, os.path.join(outputWorkspace, fileName + '.gpkg'))
+
+# ArcMap version of the tool. The zones are read as WKB, their lattice points
+# are made and offset in memory and written to the output in one go.
+def arcpyPoints(zoningPath, outFileName, outputWorkspace, seed=None, keepInside=False):
+    zoning = arcpy.Dissolve_management(zoningPath, 'dissolved_zoning', ['Zone_ID', 'MINLOT'])
+    arcpy.env.workspace = outputWorkspace
     arcpy.env.overwriteOutput = True
 
     # global variables
     prj = arcpy.Describe(zoning).spatialReference
-    
-    # Grabbing the name of the shape field from the zoning data
-    shapeFieldName = arcpy.Describe(zoning).shapeFieldName
-    points = [] # contains all point files that are to be created
-    clips = [] # contains all clipped point files
-    arcpy.AddMessage('Creating zone fishnets...')
 
-    # Calculating the fishnets
-    cur = arcpy.SearchCursor(zoning)
-    for row in cur:
-        minLot = row.getValue('MINLOT')
-        if minLot > 0: # some preserved zones are marked with a 0 for minimum lot size in our data
-            zoneText = stripDash(row.getValue('Zone_ID'))
-            arcpy.AddMessage(zoneText)
-
-            # Grabbing the needed information to create zone-specific fishnets. 
-            extent = row.getValue(shapeFieldName).extent
-            origin = str(extent.lowerLeft)
-            upperRight = str(extent.upperRight)
-            yax = str(extent.XMin) + ' ' + str(extent.YMax + 10)
-
-            val = math.sqrt(minLot)
-
-            # Create and delete a fishnet for this zone. It is getting deleted because
-            # the generated label points file is the only needed file.
-            arcpy.Delete_management(arcpy.CreateFishnet_management('net_%s'%(zoneText), origin,
-                                                                   yax, val, val, 0, 0, upperRight,
-                                                                   'LABELS', zoning, 'POLYLINE'))
-            
-            points.append('net_%s_label'%(zoneText)) # add it to the list of points files
-    del row, cur
-                
-    # clipping fishnets to the bounds of the zones
-    arcpy.MakeFeatureLayer_management(zoning, 'zlyr')
-    cur = arcpy.SearchCursor(zoning)
-    arcpy.AddMessage('Creating clipped nets...')
-    for row in cur:
-        minLot = row.getValue('MINLOT')
-        
-        if minLot != 0:
-            zoneID = row.getValue('Zone_ID')
-            zoneText = stripDash(zoneID)
-            arcpy.SelectLayerByAttribute_management('zlyr', 'NEW_SELECTION', '"Zone_ID" = \'%s\''%(zoneID))
-            clips.append(arcpy.Clip_analysis('net_%s_label'%(zoneText), 'zlyr', 'fishnet_%s'%(zoneText)))   
-    del row, cur
-
-    # Merging the clipped points
-    arcpy.AddMessage('Merging fishnets...')
-    arcpy.Merge_management(clips, 'fishnet_points_merged')
-
-    # Deleting all of the temp files
-    arcpy.AddMessage('Deleting temp files...')
-    for fc in clips:
-        arcpy.Delete_management(fc)
-    for fc in points:
-        arcpy.Delete_management(fc)
-
-    # Appending the original zoning data
-    fileName = '%s_FISHNET'%(outFileName)
-    arcpy.Identity_analysis('fishnet_points_merged', zoning, fileName)
-    arcpy.Delete_management('fishnet_points_merged')
-    arcpy.Delete_management(zoning) 
+    arcpy.AddMessage('Creating zone fishnets...')
+    with arcpy.da.SearchCursor(zoning, ['SHAPE@WKB', 'Zone_ID', 'MINLOT']) as cursor:
+        zones = [(shapely.from_wkb(bytes(row[0])), row[1], row[2] or 0) for row in cursor]
+    geoms = numpy.empty(len(zones), dtype=object)
+    geoms[:] = [zone[0] for zone in zones]
+    minLots = numpy.array([zone[2] for zone in zones] or [0.0], dtype='float64')
+    x, y, zoneIndex = fishnetPoints(geoms, minLots)
 
     # Moving the points based on WIGGLE_FACTOR
     arcpy.AddMessage('Offsetting points...')
-    with arcpy.da.UpdateCursor(fileName, ["SHAPE@X", "SHAPE@Y", "MINLOT"]) as cursor:
-        for row in cursor:
-            offset = WIGGLE_FACTOR * math.sqrt(row[MINLOT_ROW_INDEX])
-            # setting the x and y offets using random number generation
-            xOff = 0
-            yOff = 0
-            randInt = random.randrange(2)
-            if randInt > 0:
-                xOff += random.uniform(0, offset)
-            else:
-                xOff -= random.uniform(0, offset)
-                
-            randInt = random.randrange(2)
-            if randInt > 0:
-                yOff += random.uniform(0, offset)
-            else:
-                yOff -= random.uniform(0, offset)
-
-            row[0] = row[0] + xOff
-            row[1] = row[1] + yOff
-
-            
-            try:
-                cursor.updateRow(row) # update the geometry
-            except(TypeError):
-                arcpy.AddMessage('STILL MESSED UP')
-
-    arcpy.DefineProjection_management(fileName, prj) # setting the projection to that of the zoning data
-                
-
-
-    
-    
-    
+    x, y = jitterPoints(x, y, minLots[zoneIndex], seed, geoms[zoneIndex] if keepInside else None)
+
+    # Writing the points with the zoning data appended
+    fileName = '%s_FISHNET'%(outFileName)
+    zoneIdLength = max([len(zone[1] or '') for zone in zones] + [1])
+    points = numpy.empty(len(x), dtype=[('X', 'f8'), ('Y', 'f8'), ('Zone_ID', 'U%d'%(zoneIdLength)),
+                                        ('MINLOT', 'f8')])
+    points['X'] = x
+    points['Y'] = y
+    points['Zone_ID'] = numpy.array([zone[1] or '' for zone in zones] or [''])[zoneIndex]
+    points['MINLOT'] = minLots[zoneIndex]
+    if arcpy.Exists(fileName):
+        arcpy.Delete_management(fileName)
+    arcpy.da.NumPyArrayToFeatureClass(points, fileName, ['X', 'Y'], prj)
+    arcpy.Delete_management(zoning)
+
+# ArcMap version of the parcel mode, for a '<muni>_final_result' feature class
+def arcpyParcelPoints(resultPath, outFileName, outputWorkspace, countField='CZBO_POST', seed=None):
+    arcpy.env.workspace = outputWorkspace
+    arcpy.env.overwriteOutput = True
+    prj = arcpy.Describe(resultPath).spatialReference
+
+    arcpy.AddMessage('Placing parcel points...')
+    with arcpy.da.SearchCursor(resultPath, ['SHAPE@WKB', 'PAMS_PIN', 'SYSTEM', countField]) as cursor:
+        parcels = [(shapely.from_wkb(bytes(row[0])) if row[0] is not None else None, row[1] or '', row[2] or '',
+                    row[3] or 0) for row in cursor]
+    geoms = numpy.empty(len(parcels), dtype=object)
+    geoms[:] = [parcel[0] for parcel in parcels]
+    skipped = []
+    x, y, parcelIndex = parcelPoints(geoms, [parcel[3] for parcel in parcels], seed, skipped)
+    if skipped:
+        arcpy.AddWarning('Skipped %d parcels with no geometry: %s'%(len(skipped),
+                                                                   ', '.join(parcels[n][1] for n in skipped)))
+
+    fileName = '%s_%s_POINTS'%(outFileName, countField)
+    pins = numpy.array([parcel[1] for parcel in parcels] or [''])
+    systems = numpy.array([parcel[2] for parcel in parcels] or [''])
+    points = numpy.empty(len(x), dtype=[('X', 'f8'), ('Y', 'f8'), ('PAMS_PIN', pins.dtype), ('SYSTEM', systems.dtype),
+                                        (countField, 'i4')])
+    points['X'] = x
+    points['Y'] = y
+    points['PAMS_PIN'] = pins[parcelIndex]
+    points['SYSTEM'] = systems[parcelIndex]
+    points[countField] = numpy.array([parcel[3] for parcel in parcels] or [0])[parcelIndex]
+    if arcpy.Exists(fileName):
+        arcpy.Delete_management(fileName)
+    arcpy.da.NumPyArrayToFeatureClass(points, fileName, ['X', 'Y'], prj)
+
+if __name__ == '__main__':
+    pointSeed = int(sys.argv[4]) if len(sys.argv) > 4 and sys.argv[4] not in ('', '#') else None
+    inside = len(sys.argv) > 5 and sys.argv[5].lower() == 'true'
+    countField = sys.argv[6] if len(sys.argv) > 6 and sys.argv[6] not in ('', '#') else None
+    if countField is not None:
+        if countField not in COUNT_FIELDS:
+            raise ValueError('The point count field must be one of %s'%(', '.join(COUNT_FIELDS)))
+        if arcpy is not None:
+            arcpyParcelPoints(sys.argv[1], sys.argv[2], sys.argv[3], countField, pointSeed)
+        else:
+            openParcelPoints(sys.argv[1], sys.argv[2], sys.argv[3], countField, pointSeed)
+    elif arcpy is not None:
+        arcpyPoints(sys.argv[1], sys.argv[2], sys.argv[3], pointSeed, inside)
+    else:
+        openPoints(sys.argv[1], sys.argv[2], sys.argv[3], pointSeed, inside)
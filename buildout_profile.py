@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+################################################################################
+# Stage timing for the buildout model
+#
+# Description:
+#   Records the wall time, feature counts in and out and memory use of each
+# named stage of a run, and writes them as a JSON or CSV run report. With a
+# profileDir every stage is also run under cProfile and its stats are dumped
+# to '<profileDir>/<number>_<stage>.prof'.
+#
+# Stages are either wrapped in 'with profiler.stage(name):' or, in straight
+# line script code like the ArcMap model, started with begin(name) and closed
+# by end() or by the next begin(). Stages run concurrently are added afterwards
+# with record().
+#
+# Memory: PEAK_PYTHON_MB is the peak of memory allocated through Python
+# (including numpy) during the stage, when traceMemory is on; MAX_RSS_MB is
+# the peak resident size of the whole process so far. Tracing slows the stages
+# down several times, so it is off by default, and it only runs while a stage
+# is open: each stage starts it and its end() stops it again (unless something
+# else had already started it).
+################################################################################
+
+import cProfile, csv, json, os, time
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+REPORT_FIELDS = ['STAGE', 'SECONDS', 'FEATURES_IN', 'FEATURES_OUT', 'PEAK_PYTHON_MB', 'MAX_RSS_MB']
+
+def maxRssMB():
+    if resource is None:
+        return None
+    # kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)
+
+class _Stage(object):
+    def __init__(self, profiler, name, featuresIn):
+        self.profiler = profiler
+        self.name = name
+        self.featuresIn = featuresIn
+
+    def __enter__(self):
+        self.profiler.begin(self.name, self.featuresIn)
+        return self
+
+    # Sets the number of features the stage produced
+    def out(self, featuresOut):
+        self.profiler.featuresOut = featuresOut
+
+    def __exit__(self, excType, excValue, traceback):
+        self.profiler.end()
+        return False
+
+class RunProfiler(object):
+    def __init__(self, enabled=True, traceMemory=False, profileDir=None):
+        self.enabled = enabled
+        self.traceMemory = traceMemory and tracemalloc is not None
+        self.profileDir = profileDir
+        self.records = []
+        self.current = None
+        self.featuresOut = None
+        self._profile = None
+        self._tracing = False # whether this profiler started tracemalloc
+        if enabled and profileDir and not os.path.isdir(profileDir):
+            os.makedirs(profileDir)
+
+    def stage(self, name, featuresIn=None):
+        return _Stage(self, name, featuresIn)
+
+    # Starts a stage, closing the one before it. featuresIn (and featuresOut in
+    # end) may be a function, which is only called when the profiler is on.
+    def begin(self, name, featuresIn=None):
+        if not self.enabled:
+            return
+        if self.current is not None:
+            self.end()
+        if callable(featuresIn):
+            featuresIn = featuresIn()
+        self.current = {'STAGE': name, 'FEATURES_IN': featuresIn, 'FEATURES_OUT': None,
+                        'STARTED': time.time()}
+        self.featuresOut = None
+        if self.traceMemory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            tracemalloc.reset_peak()
+        if self.profileDir:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def end(self, featuresOut=None):
+        if not self.enabled or self.current is None:
+            return
+        if self._profile is not None:
+            self._profile.disable()
+            name = '%02d_%s.prof' % (len(self.records) + 1, self.current['STAGE'].replace(' ', '_'))
+            self._profile.dump_stats(os.path.join(self.profileDir, name))
+            self._profile = None
+        record = self.current
+        record['SECONDS'] = round(time.time() - record.pop('STARTED'), 4)
+        if featuresOut is None:
+            featuresOut = self.featuresOut
+        record['FEATURES_OUT'] = featuresOut() if callable(featuresOut) else featuresOut
+        record['PEAK_PYTHON_MB'] = None
+        if self.traceMemory:
+            record['PEAK_PYTHON_MB'] = round(tracemalloc.get_traced_memory()[1] / 1024.0 ** 2, 1)
+            if self._tracing:
+                tracemalloc.stop()
+                self._tracing = False
+        record['MAX_RSS_MB'] = maxRssMB()
+        self.records.append(record)
+        self.current = None
+
+    # Adds a stage that was timed elsewhere, e.g. one of several stages run at
+    # the same time (see buildout_scheduler.py)
+    def record(self, name, seconds, featuresIn=None, featuresOut=None):
+        if not self.enabled:
+            return
+        self.records.append({'STAGE': name, 'SECONDS': round(seconds, 4), 'FEATURES_IN': featuresIn,
+                             'FEATURES_OUT': featuresOut, 'PEAK_PYTHON_MB': None, 'MAX_RSS_MB': maxRssMB()})
+
+    def totalSeconds(self):
+        return round(sum(record['SECONDS'] for record in self.records), 4)
+
+    # Writes the run report, as CSV if path ends in .csv and JSON otherwise.
+    # info is written along with the stages (JSON only).
+    def write(self, path, info=None):
+        self.end()
+        if path.lower().endswith('.csv'):
+            with open(path, 'w') as reportFile:
+                writer = csv.DictWriter(reportFile, REPORT_FIELDS, lineterminator='\n')
+                writer.writeheader()
+                for record in self.records:
+                    writer.writerow(record)
+        else:
+            report = dict(info or {})
+            report['stages'] = self.records
+            report['total_seconds'] = self.totalSeconds()
+            with open(path, 'w') as reportFile:
+                json.dump(report, reportFile, indent=2)
+
+# The profiler to use when none is given
+def disabled():
+    return RunProfiler(enabled=False)
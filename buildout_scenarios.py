@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+################################################################################
+# Scenario sweeps for the buildout model
+#
+# Description:
+#   Evaluates many zoning/constraint alternatives for one municipality in one
+# pass. The parcel x zoning x sewer x NO3 overlay is done once, the constraint
+# erase once for every distinct constraint setup, and the buildout numbers of
+# all scenarios are then calculated together as (scenarios x pieces) arrays.
+#
+# A scenario is a dict with these (optional) keys:
+#   name        - label for the scenario's columns
+#   rules       - name of a rules file in the zoning_rules folder whose minimum
+#                 lot sizes replace the municipality's for the zones it has
+#   minLots     - {Zone_ID: minimum lot size} replacing the zoning rules (after
+#                 any rules file)
+#   c1Buffer    - C1 stream buffer distance (default 300)
+#   c2Buffer    - C2 stream buffer distance (default 50)
+#   constraints - {source name: False} to leave constraint sources out, see
+#                 buildout_engine.CONSTRAINT_SOURCES
+#
+# Input system parameters:
+#   sys.argv[1] = zoning GIS data for the town
+#   sys.argv[2] = the municipality name
+#   sys.argv[3] = the constraints workspace
+#   sys.argv[4] = JSON file with a list of scenarios
+#   sys.argv[5] = the output CSV file
+################################################################################
+
+import json, os, sys
+import numpy, pandas, shapely
+
+import buildout_engine, buildout_overlay, zoning_rules
+from buildout_analysis import canSplitArray, currentZoningArray, nitrateArray
+
+SCENARIO_FIELDS = ['CZBO_PRE', 'NO3BO_PRE', 'CZBO_POST', 'NO3BO_POST', 'CANSP_PRE', 'CANSP_POST']
+
+def scenarioName(scenario, number):
+    return scenario.get('name') or 'scenario_%d' % (number + 1)
+
+# Minimum lot size of each zoning feature under a scenario
+def scenarioMinLots(zoning, scenario):
+    minLots = zoning['MINLOT'].values.astype('float64').copy()
+    if scenario.get('rules'):
+        # only rules files of the registry folder can be named
+        rules = zoning_rules.compileRules(os.path.join(zoning_rules.RULES_DIR, os.path.basename(scenario['rules'])))
+        positions = rules.lookup(zoning['Zone_ID'].values)
+        known = positions >= 0
+        minLots[known] = rules.minLots[positions[known]]
+    overrides = scenario.get('minLots') or {}
+    unknown = set(overrides) - set(zoning['Zone_ID'])
+    if unknown:
+        raise ValueError('Unknown zones in scenario %s: %s' % (scenario.get('name'), ', '.join(sorted(unknown))))
+    for zone, size in overrides.items():
+        minLots[(zoning['Zone_ID'] == zone).values] = float(size)
+    return minLots
+
+# The settings that decide the erased geometry. Scenarios that share them share
+# one erase.
+def constraintSetup(scenario, zoneMinLots):
+    enabled = scenario.get('constraints') or {}
+    unknown = set(enabled) - set(buildout_engine.CONSTRAINT_SOURCES)
+    if unknown:
+        raise ValueError('Unknown constraints in scenario %s: %s' % (scenario.get('name'), ', '.join(sorted(unknown))))
+    sources = tuple(name for name in buildout_engine.CONSTRAINT_SOURCES if enabled.get(name, True))
+    zonedOpenSpace = tuple(numpy.nonzero(zoneMinLots == 0)[0]) # preserved zones are constraints too
+    return (float(scenario.get('c1Buffer', buildout_engine.C1_BUFFER)),
+            float(scenario.get('c2Buffer', buildout_engine.C2_BUFFER)), sources, zonedOpenSpace)
+
+# Post-erase area of every piece for one constraint setup, 0 where the piece
+# is erased completely
+def erasedAreas(pieces, zoning, layers, addConstraints, setup, zoneMinLots):
+    c1Buffer, c2Buffer, sources, _ = setup
+    setupZoning = zoning.assign(MINLOT=zoneMinLots)
+    constraints = buildout_engine.constraintGeometries(layers, setupZoning, addConstraints, c1Buffer,
+                                                       c2Buffer, sources)
+    if not len(constraints):
+        return pieces.geometry.area.values
+    geoms, dropped = buildout_overlay.erasedGeometries(pieces.geometry.values, constraints.geometry.values)
+    areas = numpy.zeros(len(pieces))
+    areas[~dropped] = shapely.area(geoms[~dropped])
+    return areas
+
+# Sums the (scenarios x pieces) values into (scenarios x parcels)
+def parcelSums(values, parcelIndex, parcelCount):
+    return numpy.array([numpy.bincount(parcelIndex, row, parcelCount) for row in values]).astype('int64')
+
+# The parcel x zoning x sewer x NO3 overlay that every scenario of a
+# municipality starts from: the zoning (with a fresh index), the pieces, the
+# zoning feature of each piece, the parcel pins, the parcel of each piece and
+# the piece areas
+def scenarioOverlay(zoning, layers):
+    zoning = zoning.reset_index(drop=True)
+    numbered = zoning.assign(_ZONE=numpy.arange(len(zoning)))
+    pieces = buildout_overlay.overlayParcels(layers['parcels'], numbered, layers['sewer_service_area'],
+                                             layers['NO3_densities'], ['_ZONE'])
+    pieces = pieces.reset_index(drop=True)
+    zoneOfPiece = pieces['_ZONE'].values.astype('int64')
+    pins, parcelIndex = numpy.unique(pieces['PAMS_PIN'].values.astype(str), return_inverse=True)
+    return zoning, pieces, zoneOfPiece, pins, parcelIndex, pieces.geometry.area.values
+
+# Per-parcel buildout numbers of every scenario for layers already in memory
+# (see buildout_engine.loadMunicipality). Returns a frame indexed by PAMS_PIN
+# with a (scenario, field) column for each of SCENARIO_FIELDS. Parcels that
+# have no buildable area left under a scenario are missing (NA) for it, as
+# they would be missing from that scenario's final result.
+def sweepScenarios(zoning, layers, scenarios, addConstraints=None):
+    return sweepOverlay(scenarioOverlay(zoning, layers), layers, scenarios, addConstraints)
+
+# sweepScenarios on an overlay from scenarioOverlay. The post-erase areas of
+# each constraint setup are kept in erases (any dict-like, by setup) and taken
+# from it when they are already there. pins limits the result to those parcels.
+def sweepOverlay(overlay, layers, scenarios, addConstraints=None, erases=None, pins=None):
+    zoning, pieces, zoneOfPiece, parcelPins, parcelIndex, preArea = overlay
+    zoneMinLots = [scenarioMinLots(zoning, scenario) for scenario in scenarios]
+    minLot = numpy.array([m[zoneOfPiece] for m in zoneMinLots]) # scenarios x pieces
+
+    # one erase per distinct constraint setup
+    postArea = numpy.zeros(minLot.shape)
+    erases = {} if erases is None else erases
+    for n, scenario in enumerate(scenarios):
+        setup = constraintSetup(scenario, zoneMinLots[n])
+        areas = erases.get(setup)
+        if areas is None:
+            areas = erasedAreas(pieces, zoning, layers, addConstraints, setup, zoneMinLots[n])
+            erases[setup] = areas
+        postArea[n] = areas
+
+    if pins is not None:
+        # only the pieces of the parcels asked for are scored
+        wanted = numpy.isin(parcelPins, numpy.asarray(list(pins), dtype=str))
+        chosen = wanted[parcelIndex]
+        pieces, minLot, postArea, preArea = pieces[chosen], minLot[:, chosen], postArea[:, chosen], preArea[chosen]
+        parcelIndex = numpy.cumsum(wanted)[parcelIndex[chosen]] - 1
+        parcelPins = parcelPins[wanted]
+
+    preArea = preArea[numpy.newaxis, :]
+    sepdens = pieces['SEPDENS'].values.astype('float64')[numpy.newaxis, :]
+    isSeptic = (pieces['SYSTEM'].values == 'SEPTIC')[numpy.newaxis, :]
+    czPre = currentZoningArray(minLot, preArea)
+    no3Pre = nitrateArray(minLot, sepdens, preArea, isSeptic, czPre)
+    czPost = currentZoningArray(minLot, postArea)
+    no3Post = nitrateArray(minLot, sepdens, postArea, isSeptic, czPost)
+
+    # pieces that are erased or don't meet the minimum lot size are dropped
+    kept = (postArea > 0) & (postArea >= minLot)
+    present = parcelSums(kept, parcelIndex, len(parcelPins)) > 0
+    sums = dict((field, parcelSums(values * kept, parcelIndex, len(parcelPins)))
+                for field, values in zip(SCENARIO_FIELDS[:4], [czPre, no3Pre, czPost, no3Post]))
+    sums['CANSP_PRE'] = canSplitArray(sums['NO3BO_PRE'], sums['CZBO_PRE'])
+    sums['CANSP_POST'] = canSplitArray(sums['NO3BO_POST'], sums['CZBO_POST'])
+    # Change the 0's to 1's for the buildout numbers
+    for field in SCENARIO_FIELDS[:4]:
+        sums[field][sums[field] == 0] = 1
+
+    columns = {}
+    for n, scenario in enumerate(scenarios):
+        for field in SCENARIO_FIELDS:
+            values = pandas.array(sums[field][n], dtype='Int64')
+            values[~present[n]] = pandas.NA
+            columns[(scenarioName(scenario, n), field)] = values
+    result = pandas.DataFrame(columns, index=pandas.Index(parcelPins, name='PAMS_PIN'))
+    return result[result.notnull().any(axis=1)]
+
+# Loads one municipality and runs the scenarios on it
+def runScenarios(zoningSource, muniName, constraintsWorkspace, scenarios, additionalConstraints='',
+                 cache=None, region=None):
+    zoning, layers, addConstraints = buildout_engine.loadMunicipality(
+        zoningSource, muniName, constraintsWorkspace, additionalConstraints, cache, region)
+    return sweepScenarios(zoning, layers, scenarios, addConstraints)
+
+def loadScenarios(path):
+    with open(path) as scenarioFile:
+        return json.load(scenarioFile)
+
+if __name__ == '__main__':
+    result = runScenarios(sys.argv[1], sys.argv[2], sys.argv[3], loadScenarios(sys.argv[4]))
+    result.columns = ['%s_%s' % column for column in result.columns]
+    result.to_csv(sys.argv[5])
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+################################################################################
+# Pipelined buildout runs
+#
+# Description:
+#   Runs the stages of the open data engine as a dependency graph on an asyncio
+# event loop, with the blocking work done in a thread pool. Each stage starts
+# as soon as the stages it needs are done, so:
+#   - every input layer is read at the same time as the others, as soon as the
+#     zoning has been read (its bounding box limits the reads), and is clipped
+#     once the municipal boundary is known
+#   - the parcel x zoning x sewer x NO3 overlay and the constraint preparation
+#     (stream buffers, urban land use, merge) run side by side, and only join
+#     at the erase
+# Reading, clipping and the shapely operations release the GIL, so on slow or
+# network-mounted data the reads no longer wait for each other.
+#
+# The stages of a pipelined run overlap, so in its run report the stage times
+# add up to more than the wall time of the run.
+#
+# Input system parameters:
+#   sys.argv[1] = zoning GIS data for the town ('file.gpkg|layer' for a
+#                 layer inside a GeoPackage)
+#   sys.argv[2] = the municipality name
+#   sys.argv[3] = the constraints workspace (.gpkg or folder)
+#   sys.argv[4] = the output file (.gpkg, .shp, .parquet or .arrow)
+#   sys.argv[5] = optional additional constraints, separated by ';'
+#   sys.argv[6] = optional run report with the time of each stage (.json or
+#                 .csv)
+################################################################################
+
+import asyncio, sys, time
+from concurrent.futures import ThreadPoolExecutor
+import geopandas, pandas
+
+import buildout_engine, buildout_profile, zoning_rules
+
+class Pipeline(object):
+    # A graph of named stages. A stage is a function called with the results
+    # of the stages it depends on, which have to be added before it.
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.stages = {}
+        self.order = []
+        self.timings = [] # (name, started, seconds), in the order they finished
+        self.wallSeconds = None
+
+    def add(self, name, function, *dependencies):
+        unknown = [dependency for dependency in dependencies if dependency not in self.stages]
+        if unknown:
+            raise ValueError('Stage %s depends on unknown stages: %s' % (name, ', '.join(unknown)))
+        self.stages[name] = (function, dependencies)
+        self.order.append(name)
+
+    async def _runStage(self, name, tasks, loop, executor):
+        function, dependencies = self.stages[name]
+        arguments = [await tasks[dependency] for dependency in dependencies]
+        started = time.time()
+        result = await loop.run_in_executor(executor, function, *arguments)
+        self.timings.append((name, started, time.time() - started))
+        return result
+
+    async def _runAll(self):
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(self.workers) as executor:
+            tasks = {}
+            for name in self.order:
+                tasks[name] = asyncio.ensure_future(self._runStage(name, tasks, loop, executor))
+            try:
+                results = await asyncio.gather(*[tasks[name] for name in self.order])
+            except BaseException:
+                # stages that haven't started yet are not started any more
+                for task in tasks.values():
+                    task.cancel()
+                raise
+        return dict(zip(self.order, results))
+
+    # Runs every stage and returns their results by name
+    def run(self):
+        self.timings = []
+        started = time.time()
+        results = asyncio.run(self._runAll())
+        self.wallSeconds = round(time.time() - started, 4)
+        return results
+
+def _clip(frame, boundary):
+    return geopandas.clip(frame, boundary)
+
+def _merge(*frames):
+    return pandas.concat(frames, ignore_index=True)
+
+# The pipeline of one municipality's run. cache and region are used as in
+# buildout_engine.clipInputs, and with a constraint_mask.MaskStore the
+# statewide constraints come from a mask, as in buildout_engine.openBuildout.
+def buildoutPipeline(zoningSource, muniName, constraintsWorkspace, additionalConstraints='',
+                     cache=None, region=None, maskStore=None, workers=None):
+    names = buildout_engine.INPUTS
+    if maskStore is not None:
+        import constraint_mask
+        names = constraint_mask.RUN_LAYERS
+    pipeline = Pipeline(workers)
+    pipeline.add('read_zoning', lambda: buildout_engine.readLayer(zoningSource))
+    pipeline.add('zoning_rules', lambda: zoning_rules.loadRules(muniName, zoningSource))
+    pipeline.add('minimum_lot_sizes', buildout_engine.minimumLotSizes, 'read_zoning', 'zoning_rules')
+    pipeline.add('boundary', lambda zoning: zoning.geometry.union_all(), 'read_zoning')
+
+    for name in names:
+        source = buildout_engine.layerSource(constraintsWorkspace, name)
+        if cache is not None:
+            pipeline.add('clip_' + name, lambda boundary, source=source: cache.clip(source, boundary, region),
+                         'boundary')
+        else:
+            pipeline.add('read_' + name, lambda zoning, source=source:
+                         buildout_engine.readLayer(source, bbox=tuple(zoning.total_bounds)), 'read_zoning')
+            pipeline.add('clip_' + name, _clip, 'read_' + name, 'boundary')
+    if additionalConstraints:
+        parts = []
+        for n, source in enumerate(additionalConstraints.split(';')):
+            pipeline.add('read_additional_%d' % n, lambda zoning, source=source:
+                         buildout_engine.readLayer(source, bbox=tuple(zoning.total_bounds)), 'read_zoning')
+            pipeline.add('clip_additional_%d' % n, _clip, 'read_additional_%d' % n, 'boundary')
+            parts.append('clip_additional_%d' % n)
+        pipeline.add('additional_constraints', _merge, *parts)
+    else:
+        pipeline.add('additional_constraints', lambda: None)
+    if maskStore is not None:
+        pipeline.add('constraint_mask', lambda zoning: maskStore.mask(constraintsWorkspace,
+                                                                      region or tuple(zoning.total_bounds)),
+                     'read_zoning')
+
+    # the two branches that join at the erase
+    pipeline.add('overlay', buildout_engine.parcelPieces, 'clip_parcels', 'minimum_lot_sizes',
+                 'clip_sewer_service_area', 'clip_NO3_densities')
+    layerStages = ['clip_' + name for name in names]
+    def constraints(zoning, addConstraints, *frames):
+        layers = dict(zip(names, frames))
+        if maskStore is None:
+            return buildout_engine.constraintGeometries(layers, zoning, addConstraints)
+        import constraint_mask
+        return constraint_mask.withMask(frames[-1], layers, zoning, addConstraints)
+    pipeline.add('constraints', constraints, 'minimum_lot_sizes', 'additional_constraints',
+                 *(layerStages + (['constraint_mask'] if maskStore is not None else [])))
+
+    pipeline.add('erase', buildout_engine.erasedPieces, 'overlay', 'constraints')
+    pipeline.add('multi_system', buildout_engine.markMultiSystem, 'erase')
+    pipeline.add('dissolve', buildout_engine.dissolveResult, 'multi_system')
+    return pipeline
+
+# Runs one municipality as a pipeline and returns the final result. The stage
+# times are added to the profiler, if one is given, and the overlay, constraint
+# and erase results are kept in intermediates as in
+# buildout_engine.buildoutFromLayers.
+def pipelinedBuildout(zoningSource, muniName, constraintsWorkspace, additionalConstraints='',
+                      cache=None, region=None, profiler=None, intermediates=None, maskStore=None, workers=None):
+    pipeline = buildoutPipeline(zoningSource, muniName, constraintsWorkspace, additionalConstraints,
+                                cache, region, maskStore, workers)
+    results = pipeline.run()
+    if profiler is not None:
+        for name, _, seconds in sorted(pipeline.timings, key=lambda timing: timing[1]):
+            result = results[name]
+            profiler.record(name, seconds, featuresOut=len(result) if hasattr(result, 'columns') else None)
+    if intermediates is not None:
+        intermediates.update(parcel_pieces=results['overlay'], constraints=results['constraints'],
+                             erased_pieces=results['erase'])
+    return results['dissolve']
+
+if __name__ == '__main__':
+    extraConstraints = sys.argv[5] if len(sys.argv) > 5 else ''
+    runProfiler = buildout_profile.RunProfiler(traceMemory=False) if len(sys.argv) > 6 else None
+    runStarted = time.time()
+    finalResult = pipelinedBuildout(sys.argv[1], sys.argv[2], sys.argv[3], extraConstraints, profiler=runProfiler)
+    wallSeconds = round(time.time() - runStarted, 4)
+    buildout_engine.writeResult(finalResult, sys.argv[4])
+    if runProfiler is not None:
+        runProfiler.write(sys.argv[6], {'municipality': sys.argv[2], 'wall_seconds': wallSeconds})
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+################################################################################
+# Buildout analysis service
+#
+# Description:
+#   A local HTTP service that keeps municipalities loaded between requests, so
+# what-if questions are answered without reading, clipping and overlaying the
+# data again. For each municipality it keeps the clipped layers, the parcel x
+# zoning x sewer x NO3 overlay (see buildout_scenarios.scenarioOverlay) and the
+# post-erase areas of every constraint setup asked for so far. Municipalities
+# and constraint setups are kept in LRU caches of a fixed size. Compiled zoning
+# rules files are kept by zoning_rules itself.
+#
+# Requests and answers are JSON:
+#   GET  /status   - the loaded municipalities and cache counters
+#   POST /buildout - {"municipality": name, "scenarios": [scenario, ...],
+#                     "pins": [PAMS_PIN, ...]} gives the per-parcel buildout
+#                    numbers of each scenario (see buildout_scenarios.py for
+#                    the scenario keys). Without scenarios the current zoning
+#                    is used, without pins every parcel is returned.
+#   POST /load     - {"municipality": name} loads a municipality ahead of time
+#   POST /evict    - {"municipality": name} drops a loaded municipality
+#
+# "Change Zone_ID RR-2 to 40000 sq ft" is the scenario
+#   {"name": "rr2_40000", "minLots": {"RR-2": 40000}}
+# and "rule set X" is {"name": "x", "rules": "x.csv"}.
+#
+# The service only listens on the local machine. BuildoutClient is a client
+# for it, and --self-test runs the service and client on a synthetic
+# municipality (see buildout_benchmark.py).
+#
+# Usage:
+#   python buildout_service.py zoning.gpkg constraints.gpkg --port 8750
+#   python buildout_service.py --self-test
+################################################################################
+
+import argparse, collections, json, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+import pandas
+
+import buildout_engine, buildout_scenarios
+
+DEFAULT_PORT = 8750
+MAX_MUNICIPALITIES = 8 # municipalities kept loaded
+MAX_ERASES = 32 # constraint setups kept for each municipality
+
+class LRUCache(object):
+    # A dict-like cache of at most maxEntries entries that drops the least
+    # recently used one when it is full. It is safe to use from many threads.
+    def __init__(self, maxEntries):
+        self.maxEntries = maxEntries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def keys(self):
+        with self.lock:
+            return list(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def counters(self):
+        return {'entries': len(self), 'maxEntries': self.maxEntries, 'hits': self.hits, 'misses': self.misses}
+
+class WarmMunicipality(object):
+    # Everything the scenario sweep needs for one municipality, kept in memory
+    def __init__(self, name, zoning, layers, addConstraints=None, maxErases=MAX_ERASES):
+        started = time.time()
+        self.name = name
+        self.layers = layers
+        self.addConstraints = addConstraints
+        self.overlay = buildout_scenarios.scenarioOverlay(zoning, layers)
+        self.erases = LRUCache(maxErases)
+        self.loadSeconds = round(time.time() - started, 4)
+
+    def sweep(self, scenarios, pins=None):
+        return buildout_scenarios.sweepOverlay(self.overlay, self.layers, scenarios, self.addConstraints,
+                                               self.erases, pins)
+
+# A loader for AnalysisService that reads municipalities from workspaces the
+# way buildout_batch.py does
+def workspaceLoader(zoningWorkspace, constraintsWorkspace, additionalConstraints='', cache=None):
+    import buildout_batch
+    def load(muniName):
+        zoningSource = buildout_engine.layerSource(zoningWorkspace, buildout_batch.zoningLayer(muniName))
+        return buildout_engine.loadMunicipality(zoningSource, muniName, constraintsWorkspace,
+                                                additionalConstraints, cache)
+    return load
+
+# The per-parcel numbers of a sweepOverlay frame as JSON records:
+# {"PAMS_PIN": pin, "<scenario>": {"CZBO_PRE": ..., ...}, ...}, with None for a
+# parcel that has no buildable area left under a scenario
+def parcelRecords(frame, names):
+    values = dict((column, [None if pandas.isna(value) else int(value) for value in frame[column]])
+                  for column in frame.columns)
+    records = []
+    for n, pin in enumerate(frame.index):
+        record = {'PAMS_PIN': pin}
+        for name in names:
+            record[name] = dict((field, values[(name, field)][n]) for field in buildout_scenarios.SCENARIO_FIELDS)
+        records.append(record)
+    return records
+
+class AnalysisService(object):
+    # loader(muniName) returns the (zoning, layers, addConstraints) of a
+    # municipality, see buildout_engine.loadMunicipality and workspaceLoader
+    def __init__(self, loader, maxMunicipalities=MAX_MUNICIPALITIES, maxErases=MAX_ERASES):
+        self.loader = loader
+        self.maxErases = maxErases
+        self.municipalities = LRUCache(maxMunicipalities)
+        self.loading = threading.Lock()
+        self.requests = 0
+
+    # The loaded municipality, loading it if it isn't
+    def municipality(self, muniName):
+        warm = self.municipalities.get(muniName)
+        if warm is not None:
+            return warm
+        with self.loading:
+            # another request may have loaded it while this one waited
+            warm = self.municipalities.entries.get(muniName)
+            if warm is None:
+                zoning, layers, addConstraints = self.loader(muniName)
+                warm = WarmMunicipality(muniName, zoning, layers, addConstraints, self.maxErases)
+                self.municipalities[muniName] = warm
+        return warm
+
+    def buildout(self, request):
+        started = time.time()
+        self.requests += 1
+        warm = self.municipality(request['municipality'])
+        scenarios = request.get('scenarios') or [{'name': 'current'}]
+        names = [buildout_scenarios.scenarioName(scenario, n) for n, scenario in enumerate(scenarios)]
+        if len(set(names)) != len(names):
+            raise ValueError('Scenario names must be unique')
+        frame = warm.sweep(scenarios, request.get('pins'))
+        return {'municipality': warm.name, 'scenarios': names, 'parcels': parcelRecords(frame, names),
+                'seconds': round(time.time() - started, 4)}
+
+    def load(self, request):
+        started = time.time()
+        warm = self.municipality(request['municipality'])
+        return {'municipality': warm.name, 'pieces': len(warm.overlay[1]), 'loadSeconds': warm.loadSeconds,
+                'seconds': round(time.time() - started, 4)}
+
+    def evict(self, request):
+        return {'municipality': request['municipality'],
+                'evicted': self.municipalities.pop(request['municipality']) is not None}
+
+    def status(self):
+        municipalities = []
+        for muniName in self.municipalities.keys():
+            warm = self.municipalities.entries.get(muniName)
+            if warm is not None:
+                municipalities.append({'municipality': muniName, 'pieces': len(warm.overlay[1]),
+                                       'loadSeconds': warm.loadSeconds, 'erases': warm.erases.counters()})
+        return {'requests': self.requests, 'municipalities': municipalities,
+                'cache': self.municipalities.counters()}
+
+class _Handler(BaseHTTPRequestHandler):
+    def _reply(self, code, answer):
+        body = json.dumps(answer).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, self.server.service.status())
+        else:
+            self._reply(404, {'error': 'Unknown path: %s' % self.path})
+
+    def do_POST(self):
+        service = self.server.service
+        handlers = {'/buildout': service.buildout, '/load': service.load, '/evict': service.evict}
+        if self.path not in handlers:
+            self._reply(404, {'error': 'Unknown path: %s' % self.path})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            answer = handlers[self.path](request)
+        except KeyError as error:
+            self._reply(400, {'error': 'Missing key: %s' % error})
+        except ValueError as error:
+            self._reply(400, {'error': str(error)})
+        except Exception as error:
+            self._reply(500, {'error': '%s: %s' % (type(error).__name__, error)})
+        else:
+            self._reply(200, answer)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# The HTTP server of a service, on the local machine only. Port 0 picks a free
+# port (see server.server_address).
+def makeServer(service, port=DEFAULT_PORT, verbose=False):
+    server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    return server
+
+class BuildoutClient(object):
+    def __init__(self, url='http://127.0.0.1:%d' % DEFAULT_PORT, timeout=600):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _call(self, path, request=None):
+        data = None if request is None else json.dumps(request).encode('utf-8')
+        headers = {'Content-Type': 'application/json'} if data is not None else {}
+        try:
+            with urlopen(Request(self.url + path, data, headers), timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except HTTPError as error:
+            message = json.loads(error.read().decode('utf-8') or '{}').get('error', error.reason)
+            if error.code == 400:
+                raise ValueError(message)
+            raise RuntimeError('Buildout service error %d: %s' % (error.code, message))
+
+    def status(self):
+        return self._call('/status')
+
+    def load(self, municipality):
+        return self._call('/load', {'municipality': municipality})
+
+    def evict(self, municipality):
+        return self._call('/evict', {'municipality': municipality})
+
+    def buildout(self, municipality, scenarios=None, pins=None):
+        request = {'municipality': municipality}
+        if scenarios:
+            request['scenarios'] = scenarios
+        if pins is not None:
+            request['pins'] = list(pins)
+        return self._call('/buildout', request)
+
+# Runs the service on a synthetic municipality and checks the client's answers
+# against a full engine run. Returns True if every check passed.
+def selfTest(parcelCount=2000, seed=0, maxWarmSeconds=1.0):
+    import buildout_benchmark
+    zoning, layers = buildout_benchmark.syntheticMunicipality(parcelCount, 0.1, seed)
+    zoning = buildout_engine.minimumLotSizes(zoning, buildout_benchmark.syntheticRules())
+    expected = buildout_engine.buildoutFromLayers(zoning, layers)
+
+    service = AnalysisService(lambda muniName: (zoning, layers, None))
+    server = makeServer(service, port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = BuildoutClient('http://127.0.0.1:%d' % server.server_address[1])
+    checks = []
+    def check(name, passed, detail=''):
+        checks.append(passed)
+        print('%-4s %s %s' % ('ok' if passed else 'FAIL', name, detail))
+
+    try:
+        loaded = client.load('Synthetic')
+        check('load', loaded['pieces'] > 0, '(%.3fs)' % loaded['seconds'])
+
+        current = client.buildout('Synthetic')
+        parcels = current['parcels']
+        check('parcel count', len(parcels) == len(expected), '%d / %d' % (len(parcels), len(expected)))
+        for field in ['CZBO_POST', 'NO3BO_POST', 'CANSP_POST']:
+            total = sum(record['current'][field] or 0 for record in parcels)
+            check('%s total' % field, total == int(expected[field].sum()), '%d' % total)
+        check('first query time', True, '%.3fs' % current['seconds'])
+
+        # a zoning change and a constraint change, asked for a few parcels
+        pins = [record['PAMS_PIN'] for record in parcels[:25]]
+        whatIf = [{'name': 'current'}, {'name': 'rr_40000', 'minLots': {'RR': 40000}},
+                  {'name': 'no_c2', 'constraints': {'c2_buffers': False}}]
+        answer = client.buildout('Synthetic', whatIf, pins)
+        check('pins', sorted(record['PAMS_PIN'] for record in answer['parcels']) == sorted(pins))
+        again = client.buildout('Synthetic', whatIf, pins)
+        check('repeatable', again['parcels'] == answer['parcels'])
+        check('warm query time', again['seconds'] < maxWarmSeconds, '%.3fs' % again['seconds'])
+
+        try:
+            client.buildout('Synthetic', [{'minLots': {'NO SUCH ZONE': 1}}])
+            check('bad scenario rejected', False)
+        except ValueError as error:
+            check('bad scenario rejected', True, '(%s)' % error)
+        status = client.status()
+        check('status', status['municipalities'][0]['erases']['entries'] == 2,
+              '%d requests' % status['requests'])
+        check('evict', client.evict('Synthetic')['evicted'] and not client.status()['municipalities'])
+    finally:
+        server.shutdown()
+        server.server_close()
+    return all(checks)
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve buildout what-if queries from warm caches.')
+    parser.add_argument('zoningWorkspace', nargs='?')
+    parser.add_argument('constraintsWorkspace', nargs='?')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--constraints', default='', help="additional constraints, separated by ';'")
+    parser.add_argument('--cache', help='folder for the clipped input cache')
+    parser.add_argument('--municipalities', type=int, default=MAX_MUNICIPALITIES,
+                        help='number of municipalities kept loaded')
+    parser.add_argument('--preload', nargs='+', default=[], help='municipalities to load at startup')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--self-test', action='store_true')
+    args = parser.parse_args()
+
+    if args.self_test:
+        sys.exit(0 if selfTest() else 1)
+    if not args.constraintsWorkspace:
+        parser.error('the zoning and constraints workspaces are needed')
+
+    cache = None
+    if args.cache:
+        import clip_cache
+        cache = clip_cache.ClipCache(args.cache)
+    service = AnalysisService(workspaceLoader(args.zoningWorkspace, args.constraintsWorkspace,
+                                              args.constraints, cache), args.municipalities)
+    for muniName in args.preload:
+        print('%s loaded in %.1fs' % (muniName, service.load({'municipality': muniName})['seconds']))
+    server = makeServer(service, args.port, args.verbose)
+    print('Buildout service on http://127.0.0.1:%d' % server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
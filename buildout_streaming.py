@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+################################################################################
+# Streaming buildout runs for large municipalities
+#
+# Description:
+#   Runs the buildout model on a municipality in spatial chunks of parcels so
+# that only one chunk's parcels, overlay pieces and constraint features are in
+# memory at a time. Parcel features are grouped by PAMS_PIN before they are
+# split into chunks, so a parcel whose parts fall on both sides of a tile seam
+# is still run (and dissolved) as a whole. Parcel features without a PAMS_PIN
+# all go in one chunk and are dissolved together, as ArcGIS Dissolve does.
+# Every chunk reads only the part of each input layer around its parcels and
+# its results are appended to the output as soon as they are done.
+#
+# The chunk size comes from a memory budget and an estimate of the memory a
+# parcel needs while it is processed, or can be given directly.
+#
+# Input system parameters:
+#   sys.argv[1] = zoning GIS data for the town
+#   sys.argv[2] = the municipality name
+#   sys.argv[3] = the constraints workspace (parcels must be a .gpkg or .shp
+#                 layer, GeoParquet layers need a bbox covering column, see
+#                 buildout_engine.readLayer)
+#   sys.argv[4] = the output file (.gpkg or .shp)
+#   sys.argv[5] = optional memory budget in MB
+################################################################################
+
+import math, sys, time
+import geopandas, numpy, pandas, pyogrio
+
+import buildout_engine, zoning_rules
+
+DEFAULT_MEMORY_BUDGET = 1024 ** 3 # 1 GB
+MEMORY_OVERHEAD = 40 # memory used while processing a parcel, in multiples of its own size
+SAMPLE_SIZE = 1000 # parcels read to estimate their size
+
+# PAMS_PIN and bounding box of every parcel feature, by feature id, without
+# reading the parcel geometries
+def parcelIndex(parcelSource):
+    path, layer = buildout_engine.splitSource(parcelSource)
+    fids, bounds = pyogrio.read_bounds(path, layer=layer)
+    pins = pyogrio.read_dataframe(path, layer=layer, columns=['PAMS_PIN'], read_geometry=False,
+                                  fid_as_index=True)
+    index = pandas.DataFrame({'XMIN': bounds[0], 'YMIN': bounds[1], 'XMAX': bounds[2], 'YMAX': bounds[3]},
+                             index=pandas.Index(fids, name='FID'))
+    return index.join(pins['PAMS_PIN'])
+
+# Number of parcels per chunk that fits in the memory budget, from the size of
+# a sample of the parcels
+def chunkSizeForBudget(parcelSource, memoryBudget=DEFAULT_MEMORY_BUDGET):
+    path, layer = buildout_engine.splitSource(parcelSource)
+    sample = pyogrio.read_dataframe(path, layer=layer, max_features=SAMPLE_SIZE)
+    if not len(sample):
+        return SAMPLE_SIZE
+    perParcel = (sample.drop(columns=sample.geometry.name).memory_usage(deep=True).sum()
+                 + sample.geometry.to_wkb().map(len).sum()) / float(len(sample))
+    return max(1, int(memoryBudget / (perParcel * MEMORY_OVERHEAD)))
+
+# Splits the parcel features into chunks of about chunkSize features. All the
+# features of a PAMS_PIN go in the same chunk, and chunks are filled tile by
+# tile so they stay spatially compact. Features without a PAMS_PIN are one
+# parcel, as in the dissolve (see buildout_engine.dissolveResult).
+def parcelChunks(index, chunkSize):
+    if not len(index):
+        return []
+    pins = index.groupby('PAMS_PIN', sort=False, dropna=False).agg(
+        XMIN=('XMIN', 'min'), YMIN=('YMIN', 'min'), XMAX=('XMAX', 'max'), YMAX=('YMAX', 'max'),
+        COUNT=('XMIN', 'size'))
+    centerX = (pins['XMIN'] + pins['XMAX']) / 2.0
+    centerY = (pins['YMIN'] + pins['YMAX']) / 2.0
+    width = max(centerX.max() - centerX.min(), 1.0)
+    height = max(centerY.max() - centerY.min(), 1.0)
+    tileSize = math.sqrt(width * height * min(1.0, chunkSize / float(len(index))))
+    column = numpy.floor((centerX - centerX.min()) / tileSize).astype('int64')
+    row = numpy.floor((centerY - centerY.min()) / tileSize).astype('int64')
+    # snake through the tile rows so consecutive tiles are neighbours
+    column = numpy.where(row % 2 == 1, column.max() - column, column)
+    pins = pins.assign(_ROW=row, _COLUMN=column).sort_values(['_ROW', '_COLUMN'])
+
+    chunkOfPin = (pins['COUNT'].cumsum() - 1) // chunkSize
+    chunkOfFeature = index['PAMS_PIN'].map(chunkOfPin)
+    return [group.index.values for _, group in index.groupby(chunkOfFeature, sort=True)]
+
+# The input layers around one chunk of parcels, clipped to the municipality
+def chunkLayers(constraintsWorkspace, parcels, boundary):
+    xmin, ymin, xmax, ymax = parcels.total_bounds
+    # streams outside the chunk still reach it through their buffers
+    reach = max(buildout_engine.C1_BUFFER, buildout_engine.C2_BUFFER)
+    bbox = (xmin - reach, ymin - reach, xmax + reach, ymax + reach)
+    layers = {}
+    for name in buildout_engine.INPUTS:
+        if name == 'parcels':
+            continue
+        source = buildout_engine.layerSource(constraintsWorkspace, name)
+        layers[name] = geopandas.clip(buildout_engine.readLayer(source, bbox=bbox), boundary)
+    layers['parcels'] = geopandas.clip(parcels, boundary)
+    return layers, bbox
+
+# Runs the model chunk by chunk and appends each chunk's result to outputPath.
+# Returns one (chunk, parcel features, result features, seconds) row per chunk.
+def runStreaming(zoningSource, muniName, constraintsWorkspace, outputPath, additionalConstraints='',
+                 memoryBudget=DEFAULT_MEMORY_BUDGET, chunkSize=None):
+    if buildout_engine.splitSource(outputPath)[0].lower().endswith(('.parquet', '.arrow')):
+        raise ValueError('Streaming runs append to their output, which has to be a .gpkg or .shp')
+    # every chunk reads its part of each layer, which only stays within the
+    # budget if the reads are filtered by the chunk's bbox
+    for name in buildout_engine.INPUTS:
+        path = buildout_engine.splitSource(buildout_engine.layerSource(constraintsWorkspace, name))[0]
+        if path.lower().endswith('.parquet') and not buildout_engine.hasBboxCovering(path):
+            raise ValueError('%s has no bbox covering column, write it with buildout_engine.writeLayer '
+                             'or use a .gpkg or .shp' % path)
+    rules = zoning_rules.loadRules(muniName, zoningSource)
+    zoning = buildout_engine.minimumLotSizes(buildout_engine.readLayer(zoningSource), rules)
+    boundary = zoning.geometry.union_all()
+    xmin, ymin, xmax, ymax = boundary.bounds
+
+    parcelSource = buildout_engine.layerSource(constraintsWorkspace, 'parcels')
+    path, layer = buildout_engine.splitSource(parcelSource)
+    index = parcelIndex(parcelSource)
+    index = index[(index['XMAX'] >= xmin) & (index['XMIN'] <= xmax) &
+                  (index['YMAX'] >= ymin) & (index['YMIN'] <= ymax)]
+    if chunkSize is None:
+        chunkSize = chunkSizeForBudget(parcelSource, memoryBudget)
+
+    stats = []
+    written = False
+    for number, fids in enumerate(parcelChunks(index, chunkSize)):
+        started = time.time()
+        parcels = geopandas.read_file(path, layer=layer, fids=fids)
+        layers, bbox = chunkLayers(constraintsWorkspace, parcels, boundary)
+        addConstraints = None
+        if additionalConstraints:
+            frames = [geopandas.clip(buildout_engine.readLayer(source, bbox=bbox), boundary)
+                      for source in additionalConstraints.split(';')]
+            addConstraints = pandas.concat(frames, ignore_index=True)
+
+        result = None
+        if len(layers['parcels']):
+            result = buildout_engine.buildoutFromLayers(zoning, layers, addConstraints)
+        if result is not None and len(result):
+            # the first chunk replaces any earlier output, the rest are appended
+            buildout_engine.writeResult(result, outputPath, append=written)
+            written = True
+        stats.append((number, len(fids), 0 if result is None else len(result), round(time.time() - started, 3)))
+        del parcels, layers, result
+    return stats
+
+if __name__ == '__main__':
+    budget = float(sys.argv[5]) * 1024 ** 2 if len(sys.argv) > 5 else DEFAULT_MEMORY_BUDGET
+    for chunk, parcelCount, featureCount, seconds in runStreaming(sys.argv[1], sys.argv[2], sys.argv[3],
+                                                                 sys.argv[4], memoryBudget=budget):
+        print('chunk %d: %d parcels -> %d results in %.1fs' % (chunk, parcelCount, featureCount, seconds))
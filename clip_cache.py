@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+################################################################################
+# Clip cache for the statewide input layers
+#
+# Description:
+#   Persistent cache of the statewide layers clipped to a municipality. Entries
+# are GeoParquet files named by a hash of the source dataset's fingerprint
+# (path, size and modification time of its files) and the clip geometry, so a
+# changed source or boundary never returns stale data. When a region (e.g. the
+# bounding box of a county) is given, the region extract is cached too and the
+# municipalities in it are clipped from that instead of the statewide data.
+# The least recently used entries are evicted once the cache is over maxBytes.
+################################################################################
+
+import glob, hashlib, os, tempfile
+import geopandas, shapely
+from shapely.geometry import box
+
+import buildout_engine
+
+DEFAULT_MAX_BYTES = 10 * 1024 ** 3 # 10 GB
+
+# Identifies the current version of a source dataset ('path|layer'). Shapefiles
+# include their sidecar files, folders (e.g. file geodatabases) their contents.
+def sourceFingerprint(source):
+    path, layer = buildout_engine.splitSource(source)
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        files = [os.path.join(root, name) for root, dirs, names in os.walk(path) for name in names]
+    else:
+        files = glob.glob(os.path.splitext(path)[0] + '.*')
+    parts = [path, layer or '']
+    for name in sorted(files):
+        stat = os.stat(name)
+        parts.append('%s:%d:%d' % (os.path.basename(name), stat.st_size, int(stat.st_mtime * 1e6)))
+    return '\n'.join(parts)
+
+def geometryKey(geometry):
+    return shapely.to_wkb(shapely.normalize(geometry), hex=True)
+
+class ClipCache(object):
+    def __init__(self, cacheDir, maxBytes=DEFAULT_MAX_BYTES):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def key(self, source, clipGeometry):
+        digest = hashlib.sha1(sourceFingerprint(source).encode('utf-8'))
+        digest.update(geometryKey(clipGeometry).encode('ascii'))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cacheDir, key + '.parquet')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            frame = geopandas.read_parquet(path)
+        except (IOError, OSError):
+            return None
+        os.utime(path, None) # most recently used
+        return frame
+
+    def put(self, key, frame):
+        # written under a temporary name first so other processes never read
+        # a partial file
+        handle, tempPath = tempfile.mkstemp(suffix='.tmp', dir=self.cacheDir)
+        os.close(handle)
+        frame.to_parquet(tempPath)
+        os.replace(tempPath, self.path(key))
+        self.evict()
+
+    # Removes the least recently used entries until the cache fits in maxBytes
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.cacheDir, '*.parquet')):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    # The source layer read for a bounding box (xmin, ymin, xmax, ymax)
+    def extract(self, source, bbox):
+        key = self.key(source, box(*bbox))
+        frame = self.get(key)
+        if frame is None:
+            frame = buildout_engine.readLayer(source, bbox=tuple(bbox))
+            self.put(key, frame)
+        return frame
+
+    # The source layer clipped to boundary. With a region bounding box the clip
+    # is taken from the cached region extract.
+    def clip(self, source, boundary, region=None):
+        key = self.key(source, boundary)
+        frame = self.get(key)
+        if frame is not None:
+            return frame
+        if region is not None:
+            frame = self.extract(source, region)
+        else:
+            frame = buildout_engine.readLayer(source, bbox=boundary.bounds)
+        frame = geopandas.clip(frame, boundary)
+        self.put(key, frame)
+        return frame
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+################################################################################
+# County constraint masks
+#
+# Description:
+#   Builds the union of the statewide constraint layers (urban land use,
+# wetlands, water, state and county open space, preserved farms) once for a
+# region such as a county, instead of merging the overlapping features again
+# for every municipality. The union is cut into square tiles, so the mask is
+# made of small non-overlapping polygons that the erase's STR-tree can pick
+# from cheaply.
+#
+# Masks are stored as GeoParquet in a mask folder, named by a hash of the
+# fingerprints of their source layers (see clip_cache.sourceFingerprint), the
+# region and the build settings, with a JSON file describing them alongside. A
+# changed source layer gives a new mask.
+#
+# The C1/C2 stream buffers, zoned open space and additional constraints depend
+# on the municipality (the streams are clipped to it before they are buffered)
+# and are added to the mask's constraints for each run, see withMask.
+#
+# Input system parameters:
+#   sys.argv[1] = the constraints workspace
+#   sys.argv[2] = the mask folder
+#   sys.argv[3] = the region as 'xmin,ymin,xmax,ymax', or a county name to use
+#                 the bounds of that county's municipalities in sys.argv[4]
+#   sys.argv[4] = the zoning workspace (with a county name only)
+################################################################################
+
+import hashlib, json, os, sys, tempfile
+import geopandas, numpy, pandas, shapely
+
+import buildout_engine, buildout_overlay, clip_cache
+
+MASK_VERSION = 1 # changes when masks are built differently
+MASK_TILE = 5000 # side of the mask tiles, in the units of the data (feet)
+
+# The constraint sources in the mask and the layers they come from
+MASK_SOURCES = ['urban_land_use', 'wetlands', 'nhd_waterbodies', 'openspace_state', 'openspace_county',
+                'preserved_farms']
+MASK_LAYERS = ['Land_Use_Land_Cover_2012', 'wetlands', 'nhd_waterbodies', 'openspace_state', 'openspace_county',
+               'preserved_farms']
+
+# The INPUTS a run still has to read when its constraints come from a mask
+RUN_LAYERS = [name for name in buildout_engine.INPUTS if name not in MASK_LAYERS]
+
+def maskFingerprint(constraintsWorkspace, region, tileSize=MASK_TILE, tolerance=0.0):
+    parts = ['version %d' % MASK_VERSION, 'region %r' % (tuple(float(v) for v in region),),
+             'tile %r' % float(tileSize), 'tolerance %r' % float(tolerance)]
+    for name in MASK_LAYERS:
+        parts.append(clip_cache.sourceFingerprint(buildout_engine.layerSource(constraintsWorkspace, name)))
+    return '\n'.join(parts)
+
+# Square tiles of tileSize covering the region
+def _tiles(region, tileSize):
+    xmin, ymin, xmax, ymax = region
+    xs = numpy.arange(xmin, xmax, tileSize)
+    ys = numpy.arange(ymin, ymax, tileSize)
+    x, y = [a.ravel() for a in numpy.meshgrid(xs, ys)]
+    return shapely.box(x, y, numpy.minimum(x + tileSize, xmax), numpy.minimum(y + tileSize, ymax))
+
+# The mask for layers already read for the region: the union of the MASK_SOURCES
+# cut into tiles, one (multi)polygon per tile that has any constraint. With a
+# tolerance the mask is simplified by that distance.
+def buildMask(layers, region, tileSize=MASK_TILE, tolerance=0.0, crs=None):
+    parts = [numpy.asarray(geoms.values, dtype=object)
+             for _, geoms in buildout_engine.constraintSources(layers, sources=MASK_SOURCES)]
+    geoms, keep = buildout_overlay.polygonal(numpy.concatenate(parts) if parts else numpy.empty(0, dtype=object))
+    geoms = geoms[keep]
+    tiles = _tiles(region, tileSize)
+    if not len(geoms) or not len(tiles):
+        return geopandas.GeoDataFrame(geometry=[], crs=crs)
+
+    # each feature is cut to the tiles it touches and the pieces in each tile
+    # are unioned, so only neighbouring features are ever unioned together
+    tileIndex, geomIndex = buildout_overlay.candidatePairs(tiles, geoms)
+    inside = shapely.within(geoms[geomIndex], tiles[tileIndex])
+    pieces = geoms[geomIndex].copy()
+    pieces[~inside] = shapely.intersection(geoms[geomIndex[~inside]], tiles[tileIndex[~inside]])
+    ids, unions = buildout_overlay.groupedUnion(tileIndex, pieces)
+    if tolerance:
+        unions = shapely.simplify(unions, tolerance)
+    unions, keep = buildout_overlay.polygonal(unions)
+    return geopandas.GeoDataFrame({'TILE': ids[keep]}, geometry=unions[keep], crs=crs)
+
+class MaskStore(object):
+    def __init__(self, maskDir):
+        self.maskDir = maskDir
+        if not os.path.isdir(maskDir):
+            os.makedirs(maskDir)
+
+    def path(self, key):
+        return os.path.join(self.maskDir, key + '.parquet')
+
+    # The mask of a region, built and stored the first time it is asked for
+    def mask(self, constraintsWorkspace, region, tileSize=MASK_TILE, tolerance=0.0):
+        fingerprint = maskFingerprint(constraintsWorkspace, region, tileSize, tolerance)
+        key = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+        try:
+            return geopandas.read_parquet(self.path(key))
+        except (IOError, OSError):
+            pass
+
+        layers = dict((name, buildout_engine.readLayer(buildout_engine.layerSource(constraintsWorkspace, name),
+                                                       bbox=tuple(region)))
+                      for name in MASK_LAYERS)
+        crs = next(iter(layers.values())).crs
+        mask = buildMask(layers, region, tileSize, tolerance, crs)
+        # written under a temporary name first so other processes never read
+        # a partial file
+        handle, tempPath = tempfile.mkstemp(suffix='.tmp', dir=self.maskDir)
+        os.close(handle)
+        mask.to_parquet(tempPath)
+        os.replace(tempPath, self.path(key))
+        with open(os.path.join(self.maskDir, key + '.json'), 'w') as infoFile:
+            json.dump({'fingerprint': fingerprint.split('\n'), 'sources': MASK_SOURCES,
+                       'features': len(mask)}, infoFile, indent=2)
+        return mask
+
+# The constraints of a municipality: the mask polygons near it plus its own
+# stream buffers, zoned open space and additional constraints
+def withMask(mask, layers, zoning, addConstraints=None, c1Buffer=buildout_engine.C1_BUFFER,
+             c2Buffer=buildout_engine.C2_BUFFER):
+    sources = [name for name in buildout_engine.CONSTRAINT_SOURCES if name not in MASK_SOURCES]
+    own = buildout_engine.constraintGeometries(layers, zoning, addConstraints, c1Buffer, c2Buffer, sources)
+    near = mask.geometry.values[mask.sindex.query(shapely.box(*zoning.total_bounds))]
+    geoms = pandas.concat([geopandas.GeoSeries(near, crs=zoning.crs), own.geometry], ignore_index=True)
+    return geopandas.GeoDataFrame(geometry=geoms, crs=zoning.crs)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4:
+        import buildout_batch
+        maskRegion = buildout_batch.countyRegion(sys.argv[3], sys.argv[4])
+        if maskRegion is None:
+            raise ValueError('No zoning was found for the municipalities of %s' % sys.argv[3])
+    else:
+        maskRegion = tuple(float(value) for value in sys.argv[3].split(','))
+    builtMask = MaskStore(sys.argv[2]).mask(sys.argv[1], maskRegion)
+    print('%d mask polygons' % len(builtMask))
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+################################################################################
+# Parcel result cache
+#
+# Description:
+#   Persistent, content-addressed cache of the post-erase pieces of each parcel
+# (geometry, area, SYSTEM, zoning values and buildout numbers), kept in a
+# SQLite file. A parcel's key is a hash of its PAMS_PIN and geometry, of the
+# zoning (Zone_ID, MINLOT, RESDENSITY), sewer service area and NO3 density
+# features that touch it, and of the constraint geometries that touch it. The
+# pieces of a parcel only depend on those, so a parcel whose key is found does
+# not have to be overlaid or erased again. A new data vintage or rules edit
+# only misses on the parcels it actually changes.
+#
+# Parcels are the rows of the parcels layer with the same PAMS_PIN, and a
+# parcel that is erased completely is cached with no pieces. Entries are
+# evicted least recently used first once the cache is over maxBytes.
+#
+# See buildout_engine.buildoutFromLayers(..., parcelCache=ParcelCache(path)).
+################################################################################
+
+import hashlib, os, sqlite3, time
+import geopandas, numpy, pandas, shapely
+
+import buildout_overlay
+
+CACHE_VERSION = 1 # changes whenever the pieces would be calculated differently
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3 # 2 GB
+QUERY_CHUNK = 500 # keys per SQLite query
+
+# Columns of the cached pieces, besides the geometry
+PIECE_COLUMNS = ['PAMS_PIN', 'Zone_ID', 'MINLOT', 'RESDENSITY', 'SYSTEM', 'SEPDENS', 'AREA',
+                 'CZBO_PRE', 'NO3BO_PRE', 'CZBO_POST', 'NO3BO_POST']
+NUMBER_COLUMNS = {'MINLOT': 'float64', 'RESDENSITY': 'float64', 'SEPDENS': 'float64', 'AREA': 'float64',
+                  'CZBO_PRE': 'int64', 'NO3BO_PRE': 'int64', 'CZBO_POST': 'int64', 'NO3BO_POST': 'int64'}
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS parcels (key BLOB PRIMARY KEY, bytes INTEGER NOT NULL, used REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS parcels_used ON parcels (used);
+CREATE TABLE IF NOT EXISTS pieces (key BLOB NOT NULL, %s, geometry BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS pieces_key ON pieces (key);
+''' % ', '.join(PIECE_COLUMNS)
+
+# A digest of each feature's geometry and attribute values
+def featureDigests(frame, columns=()):
+    wkb = shapely.to_wkb(numpy.asarray(frame.geometry.values, dtype=object))
+    values = [frame[column].tolist() for column in columns]
+    return [hashlib.sha1(geometry + repr([column[n] for column in values]).encode('utf-8')).digest()
+            for n, geometry in enumerate(wkb)]
+
+# The text of a PAMS_PIN that parcels are keyed by. Parcels without a pin are
+# all keyed as 'None', whichever null they hold.
+def pinText(pin):
+    return 'None' if pandas.isna(pin) else str(pin)
+
+# The cache key of every parcel. Returns the PAMS_PINs and their keys, in the
+# order the pins first appear in parcels. The zoning, sewer and NO3 features
+# are taken in layer order (it can decide which feature a piece takes its
+# values from), constraints in any order (they are unioned).
+def parcelKeys(parcels, zoning, sewerArea, no3Densities, constraints, zoningColumns=buildout_overlay.ZONING_COLUMNS):
+    parcelGeoms = numpy.asarray(parcels.geometry.values, dtype=object)
+    rowPins = [pinText(pin) for pin in parcels['PAMS_PIN'].values]
+    parts = [[pin.encode('utf-8'), geometry] for pin, geometry in zip(rowPins, shapely.to_wkb(parcelGeoms))]
+    for layer, columns, ordered in [(zoning, zoningColumns, True), (sewerArea, [], True),
+                                    (no3Densities, ['SEPDENS'], True), (constraints, [], False)]:
+        digests = featureDigests(layer, columns)
+        rowIndex, layerIndex = buildout_overlay.candidatePairs(
+            parcelGeoms, numpy.asarray(layer.geometry.values, dtype=object))
+        touching = [[] for _ in parcelGeoms]
+        for row, feature in zip(rowIndex.tolist(), layerIndex.tolist()):
+            touching[row].append(feature if ordered else digests[feature])
+        for row, features in enumerate(touching):
+            features.sort() # layer order, or digest order for the constraints
+            if ordered:
+                features = [digests[feature] for feature in features]
+            parts[row].append(b'|' + b''.join(features))
+
+    keys = {}
+    order = []
+    for pin, rowParts in zip(rowPins, parts):
+        if pin not in keys:
+            keys[pin] = hashlib.sha1(('version %d' % CACHE_VERSION).encode('utf-8'))
+            order.append(pin)
+        keys[pin].update(b''.join(rowParts))
+    return order, [keys[pin].digest() for pin in order]
+
+def _chunks(values, size=QUERY_CHUNK):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+class ParcelCache(object):
+    def __init__(self, path, maxBytes=DEFAULT_MAX_BYTES):
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        # batch runs share the file between processes, so writers wait for
+        # each other instead of failing
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript(_SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    # The cached pieces of the given keys as a GeoDataFrame with PIECE_COLUMNS,
+    # and a mask of the keys that were not in the cache
+    def get(self, keys, crs=None):
+        found = set()
+        rows = []
+        now = time.time()
+        with self.connection:
+            for chunk in _chunks(list(keys)):
+                marks = ','.join('?' * len(chunk))
+                found.update(key for key, in self.connection.execute(
+                    'SELECT key FROM parcels WHERE key IN (%s)' % marks, chunk))
+                rows.extend(self.connection.execute(
+                    'SELECT %s, geometry FROM pieces WHERE key IN (%s)' % (', '.join(PIECE_COLUMNS), marks), chunk))
+                # most recently used
+                self.connection.execute('UPDATE parcels SET used = ? WHERE key IN (%s)' % marks, [now] + chunk)
+        missing = numpy.array([key not in found for key in keys], dtype=bool)
+        self.hits += len(found)
+        self.misses += int(missing.sum())
+
+        columns = list(zip(*rows)) if rows else [[]] * (len(PIECE_COLUMNS) + 1)
+        frame = {}
+        for name, values in zip(PIECE_COLUMNS, columns):
+            if name in NUMBER_COLUMNS:
+                # SQLite keeps NaN as NULL
+                values = numpy.array([numpy.nan if value is None else value for value in values],
+                                     dtype=NUMBER_COLUMNS[name])
+            frame[name] = values
+        geometry = shapely.from_wkb(numpy.asarray(columns[-1], dtype=object))
+        return geopandas.GeoDataFrame(frame, geometry=geometry, crs=crs), missing
+
+    # Stores the post-erase pieces of the parcels (pins and keys as given by
+    # parcelKeys)
+    def put(self, pins, keys, pieces):
+        areas = pieces.geometry.area.values
+        wkb = shapely.to_wkb(numpy.asarray(pieces.geometry.values, dtype=object))
+        keyOfPin = dict(zip(pins, keys))
+        sizes = dict((key, len(key)) for key in keys)
+        rows = []
+        values = [pieces[name].tolist() if name in pieces else [None] * len(pieces)
+                  for name in PIECE_COLUMNS if name != 'AREA']
+        for n, pin in enumerate(pieces['PAMS_PIN'].tolist()):
+            key = keyOfPin[pinText(pin)]
+            row = [column[n] for column in values]
+            row.insert(PIECE_COLUMNS.index('AREA'), float(areas[n]))
+            rows.append([key] + row + [wkb[n]])
+            sizes[key] += len(wkb[n]) + 8 * len(PIECE_COLUMNS)
+        now = time.time()
+        with self.connection:
+            for chunk in _chunks(list(keys)):
+                self.connection.execute('DELETE FROM pieces WHERE key IN (%s)' % ','.join('?' * len(chunk)), chunk)
+            self.connection.executemany('INSERT OR REPLACE INTO parcels VALUES (?, ?, ?)',
+                                        [(key, sizes[key], now) for key in keys])
+            self.connection.executemany('INSERT INTO pieces VALUES (%s)' % ','.join('?' * (len(PIECE_COLUMNS) + 2)),
+                                        rows)
+        self.evict()
+
+    def totalBytes(self):
+        return self.connection.execute('SELECT COALESCE(SUM(bytes), 0) FROM parcels').fetchone()[0]
+
+    # Removes the least recently used parcels until the cache fits in maxBytes
+    def evict(self):
+        total = self.totalBytes()
+        if total <= self.maxBytes:
+            return
+        stale = []
+        for key, size in self.connection.execute('SELECT key, bytes FROM parcels ORDER BY used'):
+            if total <= self.maxBytes:
+                break
+            stale.append(key)
+            total -= size
+        with self.connection:
+            for chunk in _chunks(stale):
+                marks = ','.join('?' * len(chunk))
+                self.connection.execute('DELETE FROM pieces WHERE key IN (%s)' % marks, chunk)
+                self.connection.execute('DELETE FROM parcels WHERE key IN (%s)' % marks, chunk)
@@ -0,0 +1,16 @@
+import os, sys
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import buildout_benchmark, zoning_rules
+
+# The synthetic municipalities of buildout_benchmark.py have their own zones,
+# which loadRules returns whatever municipality is asked for
+@pytest.fixture
+def syntheticRules(monkeypatch):
+    rules = buildout_benchmark.syntheticRules()
+    monkeypatch.setattr(zoning_rules, 'loadRules', lambda muniName, zoningPath=None, rulesDir=None: rules)
+    return rules
@@ -0,0 +1,39 @@
+# Synthetic municipalities (see buildout_benchmark.syntheticMunicipality) as
+# workspaces on disk, and comparison of final results
+import os
+import numpy, pandas, shapely
+
+import buildout_benchmark, buildout_engine
+
+def municipality(parcelCount=400, constraintDensity=0.5, seed=1):
+    return buildout_benchmark.syntheticMunicipality(parcelCount, constraintDensity, seed)
+
+# Writes the layers to a folder workspace (GeoParquet, the parcels as
+# parcelFormat) and the zoning next to them. Returns the zoning source.
+def writeWorkspace(folder, zoning, layers, parcelFormat='.parquet'):
+    for name, frame in layers.items():
+        buildout_engine.writeLayer(frame, os.path.join(folder, name + (parcelFormat if name == 'parcels' else
+                                                                         '.parquet')))
+    zoningSource = os.path.join(folder, 'zoning.parquet')
+    buildout_engine.writeLayer(zoning, zoningSource)
+    return zoningSource
+
+# The model run on the layers in memory, as buildout_engine.openBuildout does
+def fullRun(zoning, layers, rules):
+    zoning = buildout_engine.minimumLotSizes(zoning, rules)
+    return buildout_engine.buildoutFromLayers(zoning, buildout_engine.clipLayers(layers, zoning.geometry.union_all()))
+
+def _ordered(result):
+    return result.sort_values(['PAMS_PIN', 'SYSTEM']).reset_index(drop=True)
+
+# Asserts that two final results have the same parcels, values and shapes
+def assertSameResult(actual, expected):
+    actual, expected = _ordered(actual), _ordered(expected)
+    pandas.testing.assert_frame_equal(actual[buildout_engine.RESULT_FIELDS].drop(columns='THINNESS'),
+                                      expected[buildout_engine.RESULT_FIELDS].drop(columns='THINNESS'),
+                                      check_dtype=False)
+    numpy.testing.assert_allclose(actual['THINNESS'].values, expected['THINNESS'].values, rtol=1e-6)
+    actualGeoms = numpy.asarray(actual.geometry.values, dtype=object)
+    expectedGeoms = numpy.asarray(expected.geometry.values, dtype=object)
+    difference = shapely.area(shapely.symmetric_difference(actualGeoms, expectedGeoms))
+    assert (difference <= 1e-6 * shapely.area(expectedGeoms) + 1e-6).all()
@@ -0,0 +1,106 @@
+# The array buildout functions of buildout_analysis.py against the scalar ones
+import itertools, math
+import numpy, pytest
+
+import buildout_analysis
+
+MIN_LOTS = [0, 5000, 10000, 43560, 87120]
+SEPTIC_DENSITIES = [0.25, 1, 2.5]
+SYSTEMS = ['SEPTIC', 'SEWER']
+
+# Areas around the split limits of a lot: twice the minimum lot and twice the
+# septic density (in sq. feet), and exact multiples of both
+def boundaryAreas(minLot, septicDensity):
+    septicSqFt = septicDensity * 43560
+    areas = [0, 1, minLot, 10 * minLot, 10 * septicSqFt, 1e7]
+    for limit in (2 * minLot, 2 * septicSqFt, 3 * minLot, 3 * septicSqFt):
+        areas += [limit - 1, limit - 1e-6, limit, limit + 1e-6, limit + 1]
+    return [area for area in areas if area >= 0]
+
+def grid():
+    rows = []
+    for minLot, septicDensity, system in itertools.product(MIN_LOTS, SEPTIC_DENSITIES, SYSTEMS):
+        rows += [(minLot, septicDensity, area, system) for area in boundaryAreas(minLot, septicDensity)]
+    return [numpy.array(column) for column in zip(*rows)]
+
+def test_current_zoning_array_matches_scalar():
+    minLot, _, area, _ = grid()
+    expected = [buildout_analysis.currentZoning_BO(m, a) for m, a in zip(minLot, area)]
+    assert buildout_analysis.currentZoningArray(minLot, area).tolist() == expected
+
+def test_nitrate_array_matches_scalar():
+    minLot, septicDensity, area, system = grid()
+    isSeptic = system == 'SEPTIC'
+    cz = buildout_analysis.currentZoningArray(minLot, area)
+    expected = [buildout_analysis.nitrate_BO(m, d, a, s, c)
+                for m, d, a, s, c in zip(minLot, septicDensity, area, isSeptic, cz.tolist())]
+    assert buildout_analysis.nitrateArray(minLot, septicDensity, area, isSeptic, cz).tolist() == expected
+
+def test_can_split_array_matches_scalar():
+    values = numpy.array(list(itertools.product([0, 1, 2, 5], repeat=2)))
+    expected = [buildout_analysis.canSplit(no3, cz) for no3, cz in values]
+    assert buildout_analysis.canSplitArray(values[:, 0], values[:, 1]).tolist() == expected
+
+def test_buildout_arrays_match_scalar():
+    minLot, septicDensity, area, system = grid()
+    cz, no3, split = buildout_analysis.buildoutArrays(minLot, septicDensity, area, system)
+    for n in range(len(minLot)):
+        expectedCz = buildout_analysis.currentZoning_BO(minLot[n], area[n])
+        expectedNo3 = buildout_analysis.nitrate_BO(minLot[n], septicDensity[n], area[n], system[n] == 'SEPTIC',
+                                                   expectedCz)
+        assert (cz[n], no3[n], split[n]) == (expectedCz, expectedNo3,
+                                             buildout_analysis.canSplit(expectedNo3, expectedCz))
+
+def test_zero_septic_density_raises_like_scalar():
+    with pytest.raises(ZeroDivisionError):
+        buildout_analysis.nitrate_BO(5000, 0, 50000, True, 10)
+    with pytest.raises(ZeroDivisionError):
+        buildout_analysis.nitrateArray([5000], [0], [50000], numpy.array([True]), [10])
+
+# The 'SEWER/SEPTIC' labelling of the model before multiSystemPins: for every
+# row not labelled yet, select the rows of its pin and label all of them if
+# they have more than one system
+def cursorMultiSystem(rows):
+    rows = [list(row) for row in rows]
+    for row in rows:
+        if row[1] != 'SEWER/SEPTIC':
+            selection = [other for other in rows if other[0] == row[0]]
+            if len(set(other[1] for other in selection)) > 1:
+                for other in selection:
+                    other[1] = 'SEWER/SEPTIC'
+    return rows
+
+def test_multi_system_pins_match_cursor_loop():
+    random = numpy.random.RandomState(3)
+    pins = ['%04d-%d' % (random.randint(50), random.randint(3)) for _ in range(400)]
+    rows = list(zip(pins, random.choice(SYSTEMS + ['SEWER'], len(pins)).tolist()))
+    multiPins = buildout_analysis.multiSystemPins(rows)
+    labelled = [[pin, 'SEWER/SEPTIC' if pin in multiPins else system] for pin, system in rows]
+    assert 0 < len(multiPins) < len(set(pins))
+    assert labelled == cursorMultiSystem(rows)
+
+# The final result fields of one dissolved row as the model's cursor loops set
+# them before finalResultArrays: the can split flags from the summed numbers,
+# then the 0's changed to 1's, then the thinness ratio
+def cursorFinalResult(CZ_pre, NO3_pre, CZ_post, NO3_post, shapeArea, shapeLength):
+    row = {'NO3BO_POST': NO3_post, 'NO3BO_PRE': NO3_pre, 'CZBO_POST': CZ_post, 'CZBO_PRE': CZ_pre}
+    row['CANSP_PRE'] = buildout_analysis.canSplit(row['NO3BO_PRE'], row['CZBO_PRE'])
+    row['CANSP_POST'] = buildout_analysis.canSplit(row['NO3BO_POST'], row['CZBO_POST'])
+    for field in ['CZBO_PRE', 'CZBO_POST', 'NO3BO_PRE', 'NO3BO_POST']:
+        if row[field] == 0:
+            row[field] = 1
+    row['THINNESS'] = 4 * math.pi * shapeArea / (shapeLength ** (2))
+    return row
+
+def test_final_result_arrays_match_cursor_loops():
+    # every combination of 0, 1 and 2 buildout numbers, so the can split flags
+    # see the 0's before they become 1's
+    numbers = numpy.array(list(itertools.product([0, 1, 2], repeat=4)))
+    random = numpy.random.RandomState(13)
+    shapeArea = random.uniform(1, 1e6, len(numbers))
+    shapeLength = numpy.sqrt(shapeArea) * random.uniform(4, 40, len(numbers))
+    values = buildout_analysis.finalResultArrays(numbers[:, 0], numbers[:, 1], numbers[:, 2], numbers[:, 3],
+                                                 shapeArea, shapeLength)
+    for n, (CZ_pre, NO3_pre, CZ_post, NO3_post) in enumerate(numbers.tolist()):
+        expected = cursorFinalResult(CZ_pre, NO3_pre, CZ_post, NO3_post, float(shapeArea[n]), float(shapeLength[n]))
+        assert dict((field, values[field][n].item()) for field in expected) == expected
@@ -0,0 +1,45 @@
+# An incremental re-run after edits gives the same result as a full run
+import geopandas, pandas, shapely
+
+import buildout_engine, buildout_incremental
+import synthetic
+
+def test_incremental_rerun_matches_full_run(tmp_path, syntheticRules):
+    zoning, layers = synthetic.municipality(400, 0.5, seed=1)
+    # a second, buffered stream that the edits below drop again
+    swqs = layers['swqs']
+    second = swqs.assign(ANTIDEG='C2', geometry=swqs.geometry.translate(0, -(swqs.total_bounds[1] / 2)))
+    layers['swqs'] = geopandas.GeoDataFrame(pandas.concat([swqs, second], ignore_index=True), crs=zoning.crs)
+    zoningSource = synthetic.writeWorkspace(str(tmp_path), zoning, layers)
+    output = str(tmp_path / 'result.parquet')
+    _, pins = buildout_incremental.runIncremental(zoningSource, 'Synthetic', str(tmp_path), output)
+    assert pins is None
+
+    # a new wetland over a few parcels, one stream less and two parcels merged
+    # into one PAMS_PIN
+    xmin, ymin, xmax, ymax = layers['parcels'].total_bounds
+    centre = shapely.Point((xmin + xmax) / 2, (ymin + ymax) / 2).buffer((xmax - xmin) / 15)
+    layers['wetlands'] = geopandas.GeoDataFrame(
+        pandas.concat([layers['wetlands'], geopandas.GeoDataFrame(geometry=[centre], crs=zoning.crs)],
+                      ignore_index=True), crs=zoning.crs)
+    layers['swqs'] = layers['swqs'].iloc[:1]
+    parcels = layers['parcels'].copy()
+    parcels.loc[parcels.index[1], 'PAMS_PIN'] = parcels['PAMS_PIN'].iloc[0]
+    layers['parcels'] = parcels
+    synthetic.writeWorkspace(str(tmp_path), zoning, layers)
+
+    result, pins = buildout_incremental.runIncremental(zoningSource, 'Synthetic', str(tmp_path), output)
+    assert pins and len(pins) < len(parcels)
+    full, _ = buildout_incremental.runIncremental(zoningSource, 'Synthetic', str(tmp_path),
+                                                  str(tmp_path / 'full.parquet'))
+    synthetic.assertSameResult(result, full)
+    synthetic.assertSameResult(buildout_engine.readLayer(output), full)
+
+def test_unchanged_rerun_recomputes_nothing(tmp_path, syntheticRules):
+    zoning, layers = synthetic.municipality(100, 0.5, seed=2)
+    zoningSource = synthetic.writeWorkspace(str(tmp_path), zoning, layers)
+    output = str(tmp_path / 'result.gpkg')
+    first, _ = buildout_incremental.runIncremental(zoningSource, 'Synthetic', str(tmp_path), output)
+    second, pins = buildout_incremental.runIncremental(zoningSource, 'Synthetic', str(tmp_path), output)
+    assert pins == set()
+    synthetic.assertSameResult(second, first)
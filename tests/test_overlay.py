@@ -0,0 +1,97 @@
+# buildout_overlay's identity and overlayParcels against geopandas.overlay on
+# a small synthetic municipality
+import geopandas, numpy, pandas, shapely
+
+import buildout_overlay
+
+CRS = 'EPSG:3424'
+
+# 5 x 4 parcels of 100 ft, a few of them cut diagonally, and one parcel away
+# from everything
+def fixture():
+    geoms, pins = [], []
+    for i in range(5):
+        for j in range(4):
+            box = shapely.box(i * 100, j * 100, i * 100 + 100, j * 100 + 100)
+            if (i + j) % 3 == 0:
+                cut = shapely.Polygon([(i * 100, j * 100), (i * 100 + 100, j * 100), (i * 100, j * 100 + 100)])
+                geoms += [cut, box.difference(cut)]
+                pins += ['%d-%d-A' % (i, j), '%d-%d-B' % (i, j)]
+            else:
+                geoms.append(box)
+                pins.append('%d-%d' % (i, j))
+    geoms.append(shapely.box(1000, 1000, 1100, 1100))
+    pins.append('outside')
+    parcels = geopandas.GeoDataFrame({'PAMS_PIN': pins}, geometry=geoms, crs=CRS)
+
+    # zoning leaves the top row and the far parcel out
+    zoning = geopandas.GeoDataFrame({'Zone_ID': ['R-1', 'R-2', 'AG'], 'MINLOT': [10000.0, 20000.0, 43560.0],
+                                     'RESDENSITY': [4.0, 2.0, numpy.nan]},
+                                    geometry=[shapely.Polygon([(0, 0), (230, 0), (170, 330), (0, 330)]),
+                                              shapely.Polygon([(230, 0), (400, 0), (400, 330), (170, 330)]),
+                                              shapely.box(400, 0, 500, 330)], crs=CRS)
+    sewerArea = geopandas.GeoDataFrame({'SEWER_ID': [1]}, geometry=[shapely.Point(150, 150).buffer(120)], crs=CRS)
+    no3Densities = geopandas.GeoDataFrame({'SEPDENS': [1.5, 3.0]},
+                                          geometry=[shapely.box(-50, -50, 260, 450), shapely.box(260, -50, 470, 450)],
+                                          crs=CRS)
+    return parcels, zoning, sewerArea, no3Densities
+
+# geopandas.overlay, keeping only polygons like the model's overlays do
+def geopandasOverlay(frame, layer, how):
+    return geopandas.overlay(frame, layer, how=how, keep_geom_type=True)
+
+# Summed areas by the key columns (missing values included)
+def groupedAreas(frame, keys):
+    table = pandas.DataFrame(dict((key, frame[key].astype(object).where(frame[key].notna(), 'NULL').values)
+                                  for key in keys))
+    table['AREA'] = frame.geometry.area.values
+    return table.groupby(keys)['AREA'].sum().round(6).to_dict()
+
+def assertSameAreas(actual, expected):
+    assert set(actual) == set(expected)
+    for key in expected:
+        assert abs(actual[key] - expected[key]) < 1e-6 * max(1.0, expected[key]), key
+
+def test_identity_matches_geopandas_identity():
+    parcels, zoning, _, _ = fixture()
+    geoms, columns, inside = buildout_overlay.identity(
+        numpy.asarray(parcels.geometry.values, dtype=object),
+        {'PAMS_PIN': numpy.asarray(parcels['PAMS_PIN'].values, dtype=object)}, zoning, buildout_overlay.ZONING_COLUMNS)
+    result = geopandas.GeoDataFrame(columns, geometry=geoms, crs=CRS)
+    expected = geopandasOverlay(parcels, zoning, 'identity')
+    keys = ['PAMS_PIN', 'Zone_ID', 'MINLOT', 'RESDENSITY']
+    assertSameAreas(groupedAreas(result, keys), groupedAreas(expected, keys))
+
+    # the parts outside the zoning are the difference of the parcels and the zoning
+    outside = geopandas.GeoDataFrame({'PAMS_PIN': columns['PAMS_PIN'][~inside]}, geometry=geoms[~inside], crs=CRS)
+    difference = geopandasOverlay(parcels, zoning, 'difference')
+    assertSameAreas(groupedAreas(outside, ['PAMS_PIN']), groupedAreas(difference, ['PAMS_PIN']))
+
+def test_identity_without_outside_matches_intersection():
+    parcels, zoning, _, _ = fixture()
+    geoms, columns, inside = buildout_overlay.identity(
+        numpy.asarray(parcels.geometry.values, dtype=object),
+        {'PAMS_PIN': numpy.asarray(parcels['PAMS_PIN'].values, dtype=object)}, zoning, ['Zone_ID'], False)
+    assert inside.all()
+    result = geopandas.GeoDataFrame(columns, geometry=geoms, crs=CRS)
+    expected = geopandasOverlay(parcels, zoning, 'intersection')
+    assertSameAreas(groupedAreas(result, ['PAMS_PIN', 'Zone_ID']), groupedAreas(expected, ['PAMS_PIN', 'Zone_ID']))
+
+def test_overlay_parcels_matches_geopandas():
+    parcels, zoning, sewerArea, no3Densities = fixture()
+    result = buildout_overlay.overlayParcels(parcels, zoning, sewerArea, no3Densities)
+
+    # the model's identities: zoning and NO3 drop what is outside them, the
+    # sewer service area keeps it as SEPTIC
+    expected = geopandasOverlay(parcels, zoning, 'identity')
+    expected = expected[expected['Zone_ID'].notna()]
+    expected = geopandasOverlay(expected, sewerArea, 'identity')
+    expected['SYSTEM'] = numpy.where(expected['SEWER_ID'].notna(), 'SEWER', 'SEPTIC')
+    expected = geopandasOverlay(expected, no3Densities, 'identity')
+    expected = expected[expected['SEPDENS'].notna()]
+
+    keys = ['PAMS_PIN', 'Zone_ID', 'MINLOT', 'RESDENSITY', 'SYSTEM', 'SEPDENS']
+    assert list(result.columns) == keys[:4] + ['SYSTEM', 'SEPDENS', 'geometry']
+    assertSameAreas(groupedAreas(result, keys), groupedAreas(expected, keys))
+    assert 'outside' not in set(result['PAMS_PIN'])
+    assert set(shapely.get_type_id(result.geometry.values)) <= set(buildout_overlay.POLYGON_TYPES)
@@ -0,0 +1,76 @@
+# Runs with a parcel_cache.ParcelCache give the same result as runs without,
+# and an edit only misses on the parcels it touches
+import pytest, shapely, shapely.affinity
+
+import buildout_engine, parcel_cache
+import synthetic
+
+# The zoning with its minimum lot sizes and the clipped layers of a synthetic
+# municipality, with one parcel in the result left without a PAMS_PIN
+def municipality(rules):
+    zoning, layers = synthetic.municipality(300, 0.5, seed=4)
+    zoning = buildout_engine.minimumLotSizes(zoning, rules)
+    layers = buildout_engine.clipLayers(layers, zoning.geometry.union_all())
+    pin = buildout_engine.buildoutFromLayers(zoning, layers)['PAMS_PIN'].iloc[0]
+    parcels = layers['parcels'].copy()
+    parcels.loc[parcels['PAMS_PIN'] == pin, 'PAMS_PIN'] = None
+    layers['parcels'] = parcels
+    return zoning, layers
+
+def pinCount(parcels):
+    return parcels['PAMS_PIN'].nunique(dropna=False)
+
+def test_warm_run_matches_cold_run(tmp_path, syntheticRules):
+    zoning, layers = municipality(syntheticRules)
+    expected = buildout_engine.buildoutFromLayers(zoning, layers)
+    assert expected['PAMS_PIN'].isna().sum() == 1
+    count = pinCount(layers['parcels'])
+    path = str(tmp_path / 'parcels.sqlite')
+
+    cache = parcel_cache.ParcelCache(path)
+    cold = buildout_engine.buildoutFromLayers(zoning, layers, parcelCache=cache)
+    assert (cache.hits, cache.misses) == (0, count)
+    warm = buildout_engine.buildoutFromLayers(zoning, layers, parcelCache=cache)
+    assert (cache.hits, cache.misses) == (count, count)
+    cache.close()
+    # and from the file, in a new process
+    cache = parcel_cache.ParcelCache(path)
+    reopened = buildout_engine.buildoutFromLayers(zoning, layers, parcelCache=cache)
+    assert (cache.hits, cache.misses) == (count, 0)
+    cache.close()
+
+    for result in [cold, warm, reopened]:
+        synthetic.assertSameResult(result, expected)
+
+# Moves one wetland. Returns the edited layers and the geometries it touches.
+def moveWetland(zoning, layers, rules):
+    wetlands = layers['wetlands'].copy()
+    old = wetlands.geometry.iloc[0]
+    new = shapely.affinity.translate(old, 150, 150)
+    wetlands.loc[wetlands.index[0], wetlands.geometry.name] = new
+    return zoning, dict(layers, wetlands=wetlands), [old, new]
+
+# Rezones one R-2 feature to R-1
+def rezone(zoning, layers, rules):
+    zoning = zoning.drop(columns=['MINLOT', 'RESDENSITY'])
+    feature = zoning.index[zoning['Zone_ID'] == 'R-2'][0]
+    zoning.loc[feature, 'Zone_ID'] = 'R-1'
+    return buildout_engine.minimumLotSizes(zoning, rules), layers, [zoning.geometry[feature]]
+
+@pytest.mark.parametrize('edit', [moveWetland, rezone])
+def test_edit_misses_only_touched_parcels(tmp_path, syntheticRules, edit):
+    zoning, layers = municipality(syntheticRules)
+    path = str(tmp_path / 'parcels.sqlite')
+    cache = parcel_cache.ParcelCache(path)
+    buildout_engine.buildoutFromLayers(zoning, layers, parcelCache=cache)
+    cache.close()
+
+    zoning, layers, touching = edit(zoning, layers, syntheticRules)
+    parcels = layers['parcels']
+    touched = pinCount(parcels[parcels.intersects(shapely.union_all(touching))])
+    assert 0 < touched < pinCount(parcels)
+    cache = parcel_cache.ParcelCache(path)
+    result = buildout_engine.buildoutFromLayers(zoning, layers, parcelCache=cache)
+    assert (cache.hits, cache.misses) == (pinCount(parcels) - touched, touched)
+    cache.close()
+    synthetic.assertSameResult(result, buildout_engine.buildoutFromLayers(zoning, layers))
@@ -0,0 +1,64 @@
+# The lattice points of buildout_point_generation.py against a fishnet built
+# point by point, as the ArcMap tool's CreateFishnet label points clipped to
+# each zone
+import numpy, shapely
+
+import buildout_engine, buildout_point_generation
+import synthetic
+
+# The label points of a fishnet of sqrt(minLot) cells from the lower left of the
+# zone's extent, one at a time, kept if they are inside the zone
+def referenceFishnet(geometry, minLot):
+    points = []
+    if minLot <= 0:
+        return points
+    spacing = minLot ** 0.5
+    xmin, ymin, xmax, ymax = geometry.bounds
+    column = 0
+    while column == 0 or xmin + column * spacing < xmax:
+        row = 0
+        while row == 0 or ymin + row * spacing < ymax:
+            point = shapely.Point(xmin + (column + 0.5) * spacing, ymin + (row + 0.5) * spacing)
+            if geometry.contains(point):
+                points.append((point.x, point.y))
+            row += 1
+        column += 1
+    return points
+
+# The dissolved zones of the synthetic zoning and a few odd shapes: a zone with
+# a hole, a multipart zone, a zone thinner than one cell and a zone with no
+# minimum lot size
+def zones(rules):
+    zoning = buildout_engine.minimumLotSizes(synthetic.municipality(200, 0.5, seed=5)[0], rules)
+    zoning = zoning.dissolve(by=['Zone_ID', 'MINLOT'], as_index=False)
+    geoms = list(zoning.geometry.values) + [
+        shapely.box(0, 0, 1000, 800).difference(shapely.box(200, 200, 700, 500)),
+        shapely.MultiPolygon([shapely.box(5000, 0, 5400, 400), shapely.box(5600, 130, 6100, 390)]),
+        shapely.box(0, 2000, 3000, 2040),
+        shapely.box(0, 3000, 500, 3500)]
+    minLots = list(zoning['MINLOT'].values) + [10000.0, 5000.0, 43560.0, 0.0]
+    return geoms, numpy.array(minLots, dtype='float64')
+
+def test_fishnet_points_match_reference(syntheticRules):
+    geoms, minLots = zones(syntheticRules)
+    x, y, zoneIndex = buildout_point_generation.fishnetPoints(geoms, minLots)
+    assert len(x) > 1000
+    for n, (geometry, minLot) in enumerate(zip(geoms, minLots)):
+        inZone = zoneIndex == n
+        assert sorted(zip(x[inZone].tolist(), y[inZone].tolist())) == sorted(referenceFishnet(geometry, minLot))
+
+def test_lattice_blocks_give_the_same_points(syntheticRules, monkeypatch):
+    geoms, minLots = zones(syntheticRules)
+    expected = buildout_point_generation.fishnetPoints(geoms, minLots)
+    monkeypatch.setattr(buildout_point_generation, 'LATTICE_BLOCK', 7)
+    for actual, wanted in zip(buildout_point_generation.fishnetPoints(geoms, minLots), expected):
+        assert actual.tolist() == wanted.tolist()
+
+def test_generated_point_counts_match_reference(syntheticRules):
+    zoning = buildout_engine.minimumLotSizes(synthetic.municipality(200, 0.5, seed=5)[0], syntheticRules)
+    points = buildout_point_generation.generatePoints(zoning, seed=1, keepInside=True)
+    zones = zoning.dissolve(by=['Zone_ID', 'MINLOT'], as_index=False)
+    counts = points.groupby('Zone_ID').size()
+    for zoneID, geometry, minLot in zip(zones['Zone_ID'], zones.geometry, zones['MINLOT']):
+        assert counts.get(zoneID, 0) == len(referenceFishnet(geometry, minLot))
+    assert points.crs == zoning.crs
@@ -0,0 +1,45 @@
+# Streaming runs give the same result as a run on the whole municipality
+import numpy, pandas
+
+import buildout_engine, buildout_streaming
+import synthetic
+
+def _index(pins, xmin):
+    xmin = numpy.asarray(xmin, dtype=float)
+    return pandas.DataFrame({'XMIN': xmin, 'YMIN': 0.0, 'XMAX': xmin + 1, 'YMAX': 1.0, 'PAMS_PIN': pins},
+                            index=pandas.Index(range(len(pins)), name='FID'))
+
+def _chunkOf(chunks):
+    return dict((fid, number) for number, fids in enumerate(chunks) for fid in fids)
+
+def test_parcel_split_across_tiles_is_one_chunk():
+    pins = ['P%d' % n for n in range(100)]
+    # P0 has a second feature at the far end of the municipality
+    index = _index(pins + ['P0'], list(range(100)) + [99])
+    chunks = buildout_streaming.parcelChunks(index, 10)
+    assert len(chunks) > 5
+    chunkOf = _chunkOf(chunks)
+    assert sorted(chunkOf) == list(range(101))
+    assert chunkOf[0] == chunkOf[100]
+
+def test_parcels_without_pin_are_one_chunk():
+    pins = ['P%d' % n for n in range(100)]
+    pins[3] = pins[60] = pins[97] = None
+    chunkOf = _chunkOf(buildout_streaming.parcelChunks(_index(pins, range(100)), 10))
+    assert sorted(chunkOf) == list(range(100))
+    assert chunkOf[3] == chunkOf[60] == chunkOf[97]
+
+def test_chunked_run_matches_full_run(tmp_path, syntheticRules):
+    zoning, layers = synthetic.municipality(400, 0.5, seed=3)
+    # two parcels far apart lose their PAMS_PIN
+    pins = sorted(synthetic.fullRun(zoning, layers, syntheticRules)['PAMS_PIN'])
+    parcels = layers['parcels'].copy()
+    parcels.loc[parcels['PAMS_PIN'].isin([pins[0], pins[-1]]), 'PAMS_PIN'] = None
+    layers['parcels'] = parcels
+    zoningSource = synthetic.writeWorkspace(str(tmp_path), zoning, layers, parcelFormat='.gpkg')
+    output = str(tmp_path / 'result.gpkg')
+    stats = buildout_streaming.runStreaming(zoningSource, 'Synthetic', str(tmp_path), output, chunkSize=30)
+    assert len(stats) > 5
+    expected = synthetic.fullRun(zoning, layers, syntheticRules)
+    assert expected['PAMS_PIN'].isna().sum() == 1
+    synthetic.assertSameResult(buildout_engine.readLayer(output), expected)
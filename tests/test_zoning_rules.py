@@ -0,0 +1,46 @@
+# Municipality lookup in the zoning rules registry
+import pytest
+
+import zoning_rules
+
+REGISTRY = '''MUNICIPALITY,COUNTY,RULES,MATCH
+Carneys Point Township,Salem,,CARNEY;CP
+Hopewell Township,Cumberland,,HOPEWELL
+Hopewell Township,Mercer,,HOPEWELL_MERCER
+Hopewell Borough,Mercer,,HOPEWELL_BORO
+Oldmans Township,Salem,,OLDMAN
+'''
+
+@pytest.fixture
+def rulesDir(tmp_path):
+    (tmp_path / zoning_rules.INDEX_FILE).write_text(REGISTRY)
+    return str(tmp_path)
+
+def municipality(rulesDir, muniName, zoningPath=None):
+    entry = zoning_rules.findMunicipality(muniName, zoningPath, rulesDir)
+    return entry and (entry['MUNICIPALITY'], entry['COUNTY'])
+
+def test_registered_names(rulesDir):
+    assert municipality(rulesDir, 'carneys point township') == ('Carneys Point Township', 'Salem')
+    assert municipality(rulesDir, 'Hopewell Borough', 'zoning.gpkg|Hopewell_Borough') == ('Hopewell Borough', 'Mercer')
+    assert municipality(rulesDir, '', 'zoning.gpkg|Oldmans_Township') == ('Oldmans Township', 'Salem')
+
+def test_name_prefix_in_whole_words(rulesDir):
+    assert municipality(rulesDir, 'Carneys Point', 'zoning.gpkg') == ('Carneys Point Township', 'Salem')
+    assert municipality(rulesDir, 'O', 'zoning.gpkg') is None
+    assert municipality(rulesDir, 'Carneys Poi', 'zoning.gpkg') is None
+
+def test_match_text_only_in_the_dataset_path(rulesDir):
+    assert municipality(rulesDir, 'out', '/data/CARNEY_zoning.gpkg') == ('Carneys Point Township', 'Salem')
+    assert municipality(rulesDir, 'Hopewell Village', 'zoning.gpkg') is None
+    # MATCH is case sensitive, as in the ArcMap tool
+    assert municipality(rulesDir, 'out', '/data/carney_zoning.gpkg') is None
+
+def test_ambiguous_lookups_raise(rulesDir):
+    # two registered Hopewell Townships
+    with pytest.raises(ValueError):
+        municipality(rulesDir, 'Hopewell Township')
+    with pytest.raises(ValueError):
+        municipality(rulesDir, 'Hopewell')
+    with pytest.raises(ValueError):
+        municipality(rulesDir, 'out', '/data/HOPEWELL_MERCER.gpkg')
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+################################################################################
+# Zoning rules registry
+#
+# Description:
+#   Loads the per-municipality zoning rules in the zoning_rules folder
+# (Zone_ID -> minimum lot size, residential density and preserved flag) and
+# compiles each rules file once into a hashed lookup with array columns, so the
+# values for a whole zoning layer are found in one pass. See
+# zoning_rules/README.md for the file layout.
+################################################################################
+
+import csv, os, re
+import numpy
+
+RULES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zoning_rules')
+INDEX_FILE = 'index.csv'
+
+_compiled = {} # rules files that have already been compiled, by path
+
+def densityFromMinLot(minLot):
+    minLot = numpy.asarray(minLot, dtype='float64')
+    # preserved land (minLot == 0) keeps a density of 0
+    with numpy.errstate(divide='ignore'):
+        return numpy.where(minLot != 0, 1.0 / minLot, 0.0)
+
+class ZoningRules(object):
+    # Compiled rules for one municipality. zones is None when the municipality's
+    # zoning data already carries MINLOT, in which case only RESDENSITY is
+    # calculated.
+    def __init__(self, municipality, zones=None, minLots=None, densities=None, preserved=None):
+        self.municipality = municipality
+        self.zones = zones
+        if zones is None:
+            return
+        self.index = dict((zone, i) for i, zone in enumerate(zones))
+        self.preserved = numpy.asarray(preserved, dtype='bool')
+        self.minLots = numpy.where(self.preserved, 0.0, numpy.asarray(minLots, dtype='float64'))
+        densities = numpy.asarray(densities, dtype='float64')
+        self.densities = numpy.where(numpy.isnan(densities), densityFromMinLot(self.minLots), densities)
+        self.densities[self.preserved] = 0.0
+
+    def usesExistingMinLot(self):
+        return self.zones is None
+
+    # Positions of the given Zone_IDs in the rules, -1 for unknown zones
+    def lookup(self, zoneIds):
+        index = self.index
+        return numpy.array([index.get(zone, -1) for zone in zoneIds], dtype='int64')
+
+    # (MINLOT, RESDENSITY) for one Zone_ID, None for an unknown zone
+    def values(self, zoneId):
+        i = self.index.get(zoneId)
+        if i is None:
+            return None
+        return float(self.minLots[i]), float(self.densities[i])
+
+    # MINLOT and RESDENSITY arrays for a column of Zone_IDs, NaN for unknown
+    # zones. Municipalities without a rules file pass their existing MINLOT
+    # values in existingMinLots.
+    def apply(self, zoneIds, existingMinLots=None):
+        if self.usesExistingMinLot():
+            minLots = numpy.asarray(existingMinLots, dtype='float64')
+            return minLots, densityFromMinLot(minLots)
+        positions = self.lookup(zoneIds)
+        known = positions >= 0
+        minLots = numpy.where(known, self.minLots[positions], numpy.nan)
+        densities = numpy.where(known, self.densities[positions], numpy.nan)
+        return minLots, densities
+
+def _float(value):
+    value = (value or '').strip()
+    return float(value) if value else numpy.nan
+
+# Reads and compiles one rules file
+def compileRules(path, municipality=''):
+    if path in _compiled:
+        return _compiled[path]
+    zones, minLots, densities, preserved = [], [], [], []
+    with open(path) as rulesFile:
+        for row in csv.DictReader(rulesFile):
+            zones.append(row['Zone_ID'].strip())
+            minLot = float(row['MINLOT'])
+            minLots.append(minLot)
+            densities.append(_float(row.get('RESDENSITY')))
+            flag = (row.get('PRESERVED') or '').strip()
+            preserved.append(flag == '1' if flag else minLot == 0)
+    rules = ZoningRules(municipality, zones, minLots, densities, preserved)
+    _compiled[path] = rules
+    return rules
+
+def loadRegistry(rulesDir=RULES_DIR):
+    with open(os.path.join(rulesDir, INDEX_FILE)) as indexFile:
+        return [dict((key, (value or '').strip()) for key, value in row.items())
+                for row in csv.DictReader(indexFile)]
+
+# Name of the zoning layer in a zoning dataset path: the layer of a
+# 'file.gpkg|layer' source, or the file or feature class name
+def _layerName(zoningPath):
+    path, _, layer = zoningPath.partition('|')
+    return layer or os.path.splitext(re.split(r'[\\/]', path.rstrip('\\/'))[-1])[0]
+
+def _plainName(name):
+    return ' '.join(name.replace('_', ' ').lower().split())
+
+# The one entry in matches, None if there are none. Several entries raise a
+# ValueError rather than picking one of them.
+def _uniqueEntry(matches, what):
+    entries = dict(('%s (%s)' % (entry['MUNICIPALITY'], entry['COUNTY']), entry) for entry in matches)
+    if len(entries) > 1:
+        raise ValueError('%s matches more than one registered municipality: %s'
+                         % (what, ', '.join(sorted(entries))))
+    return list(entries.values())[0] if entries else None
+
+# Finds the registry entry for a municipality name, or for the zoning dataset
+# path if the name isn't registered:
+#   - the name or zoning layer name is a registered name
+#   - the name or zoning layer name is the start of one registered name, in
+#     whole words ('Carneys Point' for Carneys Point Township)
+#   - the MATCH text of one entry is in the zoning dataset path, case and all
+#     (the way the ArcMap tool recognised it)
+# Names are compared ignoring case and with '_' as a space.
+# A name or path that fits several municipalities raises a ValueError.
+def findMunicipality(muniName, zoningPath=None, rulesDir=RULES_DIR):
+    registry = loadRegistry(rulesDir)
+    names = [_plainName(name) for name in [muniName, _layerName(zoningPath) if zoningPath else None] if name]
+    for name in names:
+        entry = _uniqueEntry([entry for entry in registry if _plainName(entry['MUNICIPALITY']) == name], repr(name))
+        if entry is not None:
+            return entry
+    for name in names:
+        entry = _uniqueEntry([entry for entry in registry
+                              if _plainName(entry['MUNICIPALITY']).startswith(name + ' ')], repr(name))
+        if entry is not None:
+            return entry
+    if zoningPath:
+        return _uniqueEntry([entry for entry in registry
+                             if any(text and text in zoningPath for text in entry['MATCH'].split(';'))],
+                            repr(zoningPath))
+    return None
+
+# Returns the compiled ZoningRules for a municipality, see findMunicipality
+def loadRules(muniName, zoningPath=None, rulesDir=RULES_DIR):
+    entry = findMunicipality(muniName, zoningPath, rulesDir)
+    if entry is None:
+        raise ValueError('No zoning rules are registered for %s (%s)' % (muniName, zoningPath))
+    if not entry['RULES']:
+        return ZoningRules(entry['MUNICIPALITY'])
+    return compileRules(os.path.join(rulesDir, entry['RULES']), entry['MUNICIPALITY'])
+
+def municipalitiesInCounty(county, rulesDir=RULES_DIR):
+    return [entry['MUNICIPALITY'] for entry in loadRegistry(rulesDir)
+            if entry['COUNTY'].lower() == county.strip().lower()]